@@ -1,27 +1,43 @@
-import json
-from datetime import datetime
 from collections import OrderedDict
+from algorithms.expiry import ExpiryTracker, STALE, EXPIRED
+from algorithms.sizing import json_size
+from algorithms.snapshot import dump_counters, load_counters
 from log import setup_log
 
 arc_logger = setup_log("arc_cache")
 
 
+# Adaptive Replacement Cache (Megiddo & Modha). T1/T2 hold the cached values, B1/B2 are "ghost" lists that only
+# remember the keys recently evicted from T1/T2. A miss that hits a ghost list tells us which side was too small,
+# so p (the target size of T1) moves towards it. T1 + T2 <= capacity and T1 + T2 + B1 + B2 <= 2 * capacity.
 class ARCCache:
-    def __init__(self, capacity: int):
+    policy = "ARC"  # snapshot format
+    on_evict = None  # callback(key, value, remaining ttl, own ttl) for entries evicted to make room (not ghosts)
+
+    def __init__(self, capacity: int, log_events: bool = True, default_ttl: float = None, stale_ttl: float = 0,
+                 max_bytes: int = None, sizer=json_size):
         self.capacity = capacity
-        self.p = 0  # adaptive parameter, balances use between LRU-like (T1) and LFU-like (T2) caches
-        self.T1 = OrderedDict()  # cache for recently accessed items (LRU behavior)
-        self.T2 = OrderedDict()  # cache for frequently accessed items (LFU behavior)
-        self.B1 = OrderedDict()  # tracks recently evicted items from T1
-        self.B2 = OrderedDict()  # tracks recently evicted items from T2
-        self.cache = {}  # combined view of all cache entries (T1, T2, B1, B2)
+        self.log_events = log_events  # set to False to skip all logging (e.g. offline trace replay)
+        self.p = 0  # adaptive parameter, target size of T1 (the rest of the capacity is for T2)
+        self.T1 = OrderedDict()  # items accessed once recently (LRU behavior)
+        self.T2 = OrderedDict()  # items accessed at least twice recently (LFU behavior)
+        self.B1 = OrderedDict()  # keys recently evicted from T1 (values are not kept)
+        self.B2 = OrderedDict()  # keys recently evicted from T2 (values are not kept)
+        self.expiry = ExpiryTracker(default_ttl, stale_ttl)  # expiry times of entries with a ttl
+        self.max_bytes = max_bytes  # optional memory budget on top of the item count, None = count only
+        self.sizer = sizer  # value -> weight in bytes, only used with max_bytes
+        self.weights = {}  # key -> weight of its value (T1/T2 only), only with max_bytes
+        self.resident_bytes = 0
         self.accesses = 0
         self.hits = 0
         self.misses = 0
+        self.evictions = 0  # entries removed to make room (moved to a ghost list or dropped)
+        self.expirations = 0  # entries removed because their ttl ran out
 
     def log_event(self, event_type, key, extra=None):
+        if not self.log_events:
+            return
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
             "event_type": event_type,
             "key": key,
             "cache_size": len(self.T1) + len(self.T2),
@@ -29,82 +45,211 @@ class ARCCache:
         }
         if extra:  # if extra is not None, extra is a dictionary for any additional stuff we might want to log
             log_entry.update(extra)
-        arc_logger.info(json.dumps(log_entry))  # log the event
+        arc_logger.info(log_entry)  # log the event
 
     def get(self, key: int):
         self.accesses += 1  # increment the total number of accesses
+        if key in self.expiry.deadlines:  # only entries with a ttl need checking
+            state = self.expiry.state(key)
+            if state == EXPIRED:
+                self.remove(key)
+                self.expirations += 1
+            elif state == STALE:
+                self.expiry.refresh(key)  # served below, refreshed in the background
         if key in self.T1:  # if key is in T1, (promote it to T2)
             value = self.T1.pop(key)  # remove from T1 (pop, removes from the dictionary)
             self.T2[key] = value  # promote to T2 due to repeated access
-            self.cache[key] = (value, 'T2')  # update unified cache view
             self.hits += 1  # increment the number of hits
-            #self.log_event("hit", key, {"sub_cache": "T1 to T2"})  # log the event
             return value
         elif key in self.T2:  # if key is in T2, (move it to the end of T2)
-            value = self.T2[key]  # get the value
             self.T2.move_to_end(key)  # reinforce its status by marking it as recently used within T2
-            self.cache[key] = (value, 'T2')  # update cache view
             self.hits += 1
-            #self.log_event("hit", key, {"sub_cache": "T2"})
-            return value
-        else:
+            return self.T2[key]
+        else:  # not cached, a ghost hit in B1/B2 is handled when the value is put
             self.misses += 1
             self.log_event("miss", key)  # log the event, cache miss (not found in T1 or T2)
             return "Not Found"
 
-    def put(self, key: int, value: int):
-        if key in self.T1 or key in self.T2:  # if key is already in cache (T1 or T2)
-            self.get(key)  # update the key's position in the cache
-            self.cache[key] = (value, 'T1' if key in self.T1 else 'T2')  # update unified cache view
-            #self.log_event("update", key)  # log the event
+    def put(self, key: int, value: any, ttl: float = None):
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if weight > self.max_bytes:  # could never fit, don't cache it (and drop the old value)
+                if key in self.T1 or key in self.T2:
+                    self.remove(key)
+                return
+
+        self.insert(key, value)
+        self.expiry.set(key, ttl)  # ttl overrides the default ttl for this entry
+
+        if self.max_bytes is not None:
+            self.resident_bytes += weight - self.weights.get(key, 0)
+            self.weights[key] = weight
+            while self.resident_bytes > self.max_bytes:
+                self.shrink(keep=key)
+
+    # Swap in the refreshed value of a stale entry and start its ttl over, without the promotion to T2 a put
+    # would do. False if the key left the cache meanwhile or the new value does not fit in the budget any more.
+    def refresh(self, key, value):
+        source = self.T1 if key in self.T1 else self.T2 if key in self.T2 else None
+        if source is None:
+            return False
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if self.resident_bytes - self.weights[key] + weight > self.max_bytes:
+                self.remove(key)
+                return False
+            self.resident_bytes += weight - self.weights[key]
+            self.weights[key] = weight
+        source[key] = value
+        self.expiry.renew(key)
+        return True
+
+    def insert(self, key, value):
+        if key in self.T1 or key in self.T2:  # already cached, update the value and treat it as a repeated access
+            self.T1.pop(key, None)
+            self.T2[key] = value
+            self.T2.move_to_end(key)
+            return
+
+        if key in self.B1:  # ghost hit in B1, T1 was too small: grow its target
+            self.p = min(self.capacity, self.p + max(len(self.B2) / len(self.B1), 1))
+            self.replace(key)
+            del self.B1[key]
+            self.T2[key] = value  # seen twice now, goes straight to T2
             return
 
-        self.evict_if_needed()  # evict an entry if the cache is full
+        if key in self.B2:  # ghost hit in B2, T2 was too small: shrink the target of T1
+            self.p = max(0, self.p - max(len(self.B1) / len(self.B2), 1))
+            self.replace(key)
+            del self.B2[key]
+            self.T2[key] = value
+            return
 
+        # completely new key, make room while keeping the directory within 2 * capacity
+        if len(self.T1) + len(self.B1) >= self.capacity:
+            if len(self.T1) < self.capacity:
+                self.B1.popitem(last=False)  # forget the oldest T1 ghost
+                self.replace(key)
+            else:  # T1 alone fills the cache and B1 is empty, drop its LRU item without a ghost
+                evicted_key, evicted_value = self.T1.popitem(last=False)
+                self.pass_on(evicted_key, evicted_value)
+                self.forget(evicted_key)
+                self.evictions += 1
+        else:
+            directory_size = len(self.T1) + len(self.T2) + len(self.B1) + len(self.B2)
+            if directory_size >= 2 * self.capacity:
+                self.B2.popitem(last=False)  # forget the oldest T2 ghost
+            if directory_size >= self.capacity:
+                self.replace(key)
         self.T1[key] = value
-        self.cache[key] = (value, 'T1')  # Add to unified cache view
-        #self.log_event("add", key, {"sub_cache": "T1"})
-
-    def evict_if_needed(self):
-        # Decide which entry to evict based on the full state of cache and ghost lists (B1, B2)
-        if len(self.T1) + len(self.B1) >= self.capacity:  # if the cache is full (T1 + B1)
-            if len(self.T1) < self.capacity:  # if T1 is not full, evict from B1
-                evicted_key, _ = self.B1.popitem(last=False)  # evict the least recently used item from B1
-                self.replace()  # replace the evicted item from B1 with an item from T2
-                #self.log_event("evict", evicted_key, {"sub_cache": "B1"})  # log the event (eviction from B1)
-            else:  # if T1 is full, evict from T1
-                evicted_key, _ = self.T1.popitem(last=False)  # evict the least recently used item from T1
-                del self.cache[evicted_key]  # remove the evicted item from the unified cache view
-                #self.log_event("evict", evicted_key, {"sub_cache": "T1"})  # log the event (eviction from T1)
-
-    # Replace the evicted item from T1 with an item from T2 or vice versa
-    def replace(self):
-        if len(self.T1) > 0 and (len(self.T1) > self.p or (len(self.B2) > 0 and len(self.T1) == self.p)):  # if T1 is larger than p (adaptive parameter) or B2 is not empty and T1 is equal to p
-            evicted_key, evicted_value = self.T1.popitem(last=False)  # evict the least recently used item from T1
-            self.B1[evicted_key] = evicted_value  # add the evicted item to B1
-            del self.cache[evicted_key]  # remove the evicted item from the unified cache view
-            #self.log_event("replace", evicted_key, {"sub_cache": "T1 to B1"})
-        else:  # if T2 is larger than p or B1 is not empty and T2 is equal to p
-            evicted_key, evicted_value = self.T2.popitem(last=False)  # evict the least recently used item from T2
-            self.B2[evicted_key] = evicted_value  # add the evicted item to B2
-            del self.cache[evicted_key]  # remove the evicted item from the unified cache view
-            #self.log_event("replace", evicted_key, {"sub_cache": "T2 to B2"})
+
+    # Evict the LRU item of T1 or T2 (depending on p) into its ghost list, only when the cache is full
+    def replace(self, key):
+        if len(self.T1) + len(self.T2) < self.capacity:
+            return
+        if self.T1 and (len(self.T1) > self.p or (key in self.B2 and len(self.T1) == self.p) or not self.T2):
+            evicted_key, evicted_value = self.T1.popitem(last=False)
+            self.B1[evicted_key] = None
+        else:
+            evicted_key, evicted_value = self.T2.popitem(last=False)
+            self.B2[evicted_key] = None
+        self.pass_on(evicted_key, evicted_value)
+        self.forget(evicted_key)
+        self.evictions += 1
+
+    # Evict one more item (into its ghost list) for the byte budget, same choice as replace() but the cache
+    # does not have to be full. keep is the item just put, it fits on its own so another item is always left.
+    def shrink(self, keep):
+        if self.T1 and (len(self.T1) > self.p or not self.T2):
+            source, ghosts = self.T1, self.B1
+        else:
+            source, ghosts = self.T2, self.B2
+        evicted_key = next(iter(source))
+        if evicted_key == keep:  # keep is the only item of that list, take the other one
+            source, ghosts = (self.T2, self.B2) if source is self.T1 else (self.T1, self.B1)
+            evicted_key = next(iter(source))
+        self.pass_on(evicted_key, source.pop(evicted_key))
+        ghosts[evicted_key] = None
+        self.forget(evicted_key)
+        self.evictions += 1
+
+    # The value of an evicted entry goes to the next tier, if there is one (while its ttl is still known)
+    def pass_on(self, key, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value, self.expiry.remaining(key), self.expiry.ttls.get(key))
+
+    # Drop an entry without leaving a ghost, it was not evicted for lack of room
+    def remove(self, key):
+        if key in self.T1:
+            del self.T1[key]
+        else:
+            del self.T2[key]
+        self.forget(key)
+
+    # Drop the bookkeeping of a key that left the cache
+    def forget(self, key):
+        self.expiry.discard(key)
+        if self.weights:
+            self.resident_bytes -= self.weights.pop(key, 0)
+
+    # Remove up to limit entries whose ttl (and stale window) ran out, returns how many were removed
+    def expire(self, limit: int = 100):
+        keys = self.expiry.due(limit)
+        for key in keys:
+            self.remove(key)
+        self.expirations += len(keys)
+        return len(keys)
+
+    # Full state for a snapshot: settings, counters and p, then (list, key, value, remaining ttl) for T1 and T2 and
+    # (list, key, None, None) for the ghosts in B1 and B2, every list from least to most recently used
+    def dump_state(self):
+        meta = {"policy": self.policy, "capacity": self.capacity, "max_bytes": self.max_bytes, "counters": dump_counters(self),
+                "p": self.p}
+        remaining = self.expiry.remaining
+        entries = [("T1", key, value, remaining(key)) for key, value in self.T1.items()]
+        entries += [("T2", key, value, remaining(key)) for key, value in self.T2.items()]
+        entries += [("B1", key, None, None) for key in self.B1]
+        entries += [("B2", key, None, None) for key in self.B2]
+        return meta, entries
+
+    # Restore a dump_state() into this empty cache, entries whose ttl ran out while we were down are left out
+    def load_state(self, meta, entries, elapsed=0):
+        load_counters(self, meta["counters"])
+        self.p = meta["p"]
+        lists = {"T1": self.T1, "T2": self.T2, "B1": self.B1, "B2": self.B2}
+        for name, key, value, remaining in entries:
+            if name in ("B1", "B2"):
+                lists[name][key] = None
+            elif self.expiry.restore(key, remaining, elapsed):
+                lists[name][key] = value
+                if self.max_bytes is not None:
+                    self.weights[key] = self.sizer(value)
+                    self.resident_bytes += self.weights[key]
+
+    # Only T1/T2 count, a ghost in B1/B2 has no value
+    def contains(self, key):
+        return key in self.T1 or key in self.T2
 
     def calculate_statistics(self):
         hit_ratio = self.hits / self.accesses if self.accesses > 0 else 0
         miss_ratio = self.misses / self.accesses if self.accesses > 0 else 0
         cache_size = len(self.T1) + len(self.T2)
-        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": cache_size}
+        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": cache_size,
+                "evictions": self.evictions, "expirations": self.expirations, "resident_bytes": self.resident_bytes, "p": self.p,
+                "t1_size": len(self.T1), "t2_size": len(self.T2), "b1_size": len(self.B1), "b2_size": len(self.B2)}
 
-    def log_metrics(self, event_type, key, latency):
+    def log_metrics(self, event_type, key, latency, extra=None):
+        if not self.log_events:
+            return
         hit_rate = self.hits / self.accesses if self.accesses > 0 else 0
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
             "event_type": event_type,
             "key": key,
             "latency": latency,
             "hit_rate": hit_rate,
-            "cache_size": len(self.cache),
+            "cache_size": len(self.T1) + len(self.T2),
             "capacity": self.capacity
         }
-        arc_logger.info(json.dumps(log_entry))  # log metrics
+        if extra:  # e.g. the hit/miss counts of a batch request
+            log_entry.update(extra)
+        arc_logger.info(log_entry)  # log metrics
@@ -0,0 +1,60 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+# asyncio front of a ShardedCache for the async endpoints. The shards stay guarded by their thread locks (the sync
+# endpoints, the expiry sweeper and the snapshot thread use those), so a coroutine first queues for the shard on an
+# asyncio lock, which lets only one coroutine per shard go for the thread lock. That one takes it right away when
+# it is free; if a thread holds it, the wait happens on a worker thread instead of blocking the event loop.
+class AsyncShardedCache:
+    def __init__(self, cache):
+        self.cache = cache
+        self.name = cache.name
+        self.metrics = cache.metrics
+        self.locks = [asyncio.Lock() for _ in cache.shards]
+        self.contended = 0  # shard accesses that found the thread lock taken and waited for it off the event loop
+
+    @asynccontextmanager
+    async def shard(self, index):
+        async with self.locks[index]:
+            lock = self.cache.locks[index]
+            if not lock.acquire(blocking=False):
+                self.contended += 1
+                acquiring = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+                try:
+                    await asyncio.shield(acquiring)
+                except asyncio.CancelledError:  # the worker thread still gets the lock, give it back when it does
+                    acquiring.add_done_callback(lambda _: lock.release())
+                    raise
+            try:
+                yield self.cache.shards[index]
+            finally:
+                lock.release()
+
+    async def get(self, key):
+        async with self.shard(self.cache.shard_index(key)) as shard:
+            return shard.get(key)
+
+    async def put(self, key, value, ttl=None, remaining=None):
+        async with self.shard(self.cache.shard_index(key)) as shard:
+            shard.put(key, value, ttl)
+            if remaining is not None and key in shard.expiry.deadlines:
+                shard.expiry.set_remaining(key, remaining)
+
+    # Same as ShardedCache.get_many/put_many, each shard is entered once
+    async def get_many(self, keys):
+        results = {}
+        for index, shard_keys in self.cache.group_by_shard(keys).items():
+            async with self.shard(index) as shard:
+                for key in shard_keys:
+                    results[key] = shard.get(key)
+        return results
+
+    async def put_many(self, items, ttl=None):
+        for index, shard_keys in self.cache.group_by_shard(items).items():
+            async with self.shard(index) as shard:
+                for key in shard_keys:
+                    shard.put(key, items[key], ttl)
+
+    def log_metrics(self, event_type, key, latency, extra=None):
+        self.cache.log_metrics(event_type, key, latency, extra)
@@ -0,0 +1,489 @@
+from array import array
+from algorithms.expiry import ExpiryTracker, STALE, EXPIRED
+from algorithms.sizing import json_size
+from algorithms.snapshot import dump_counters, load_counters
+from algorithms.lru_cache import lru_logger
+from algorithms.lfu_cache import lfu_logger
+
+# Memory-lean versions of LRUCache and LFUCache with the same eviction order and the same interface.
+# Entries live in preallocated slots: the keys and values in two lists, the links between them in array('i')s
+# (4 bytes per link, not Python objects), and one dict maps each key to its slot. That avoids the OrderedDict
+# node per entry, and for LFU the tuple per entry and the OrderedDict per frequency: CompactLFUCache needs about
+# half the memory of LFUCache. CPython's OrderedDict is already compact C code, so CompactLRUCache is about the
+# same size as LRUCache and slower, it is there for the same layout on both. See analysis/compare_engines.py.
+
+NONE = -1  # no slot
+
+
+class CompactLRUCache:
+    policy = "LRU"  # snapshot format, the same as LRUCache so either can load the other's snapshot
+    on_evict = None  # callback(key, value, remaining ttl, own ttl) for entries evicted to make room
+
+    def __init__(self, capacity: int, log_events: bool = True, default_ttl: float = None, stale_ttl: float = 0,
+                 max_bytes: int = None, sizer=json_size):
+        self.capacity = capacity
+        self.log_events = log_events  # set to False to skip all logging (e.g. offline trace replay)
+        self.slots = {}  # key -> slot
+        self.keys = [None] * capacity
+        self.values = [None] * capacity
+        # recency list through the slots, slot `capacity` is the sentinel:
+        # next[sentinel] is the least recently used entry and prev[sentinel] the most recently used
+        self.sentinel = capacity
+        self.prev = array("i", [capacity]) * (capacity + 1)
+        self.next = array("i", [capacity]) * (capacity + 1)
+        self.free = array("i", range(capacity - 1, -1, -1))  # unused slots, taken from the end
+        self.expiry = ExpiryTracker(default_ttl, stale_ttl)  # expiry times of entries with a ttl
+        self.max_bytes = max_bytes  # optional memory budget on top of the item count, None = count only
+        self.sizer = sizer  # value -> weight in bytes, only used with max_bytes
+        self.weights = {}  # key -> weight of its value, only with max_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.accesses = 0
+        self.evictions = 0  # entries removed to make room
+        self.expirations = 0  # entries removed because their ttl ran out
+
+    def log_event(self, event_type, key, extra=None):
+        if not self.log_events:
+            return
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "cache_size": len(self.slots),
+            "capacity": self.capacity
+        }
+        if extra:
+            log_entry.update(extra)
+        lru_logger.info(log_entry)
+
+    def unlink(self, slot):
+        prev, next = self.prev[slot], self.next[slot]
+        self.next[prev] = next
+        self.prev[next] = prev
+
+    def append(self, slot):  # link as the most recently used
+        last = self.prev[self.sentinel]
+        self.next[last] = slot
+        self.prev[slot] = last
+        self.next[slot] = self.sentinel
+        self.prev[self.sentinel] = slot
+
+    def get(self, key):
+        self.accesses += 1
+        if key in self.expiry.deadlines:  # only entries with a ttl need checking
+            state = self.expiry.state(key)
+            if state == EXPIRED:
+                self.remove(key)
+                self.expirations += 1
+            elif state == STALE:
+                self.expiry.refresh(key)  # served below, refreshed in the background
+        slot = self.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            return "Not Found"
+        self.hits += 1
+        prev, next, sentinel = self.prev, self.next, self.sentinel  # unlink() + append() inlined, this is the hot path
+        after = next[slot]
+        if after != sentinel:  # not already the most recently used
+            before = prev[slot]
+            next[before] = after
+            prev[after] = before
+            last = prev[sentinel]
+            next[last] = slot
+            prev[slot] = last
+            next[slot] = sentinel
+            prev[sentinel] = slot
+        return self.values[slot]
+
+    def put(self, key, value, ttl: float = None):
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if weight > self.max_bytes:  # could never fit, don't cache it (and drop the old value)
+                if key in self.slots:
+                    self.remove(key)
+                return
+
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.unlink(slot)
+        else:
+            if len(self.slots) >= self.capacity:
+                self.evict()
+            slot = self.free.pop()
+            self.slots[key] = slot
+            self.keys[slot] = key
+        self.append(slot)
+        self.values[slot] = value
+        self.expiry.set(key, ttl)  # ttl overrides the default ttl for this entry
+
+        if self.max_bytes is not None:
+            self.resident_bytes += weight - self.weights.get(key, 0)
+            self.weights[key] = weight
+            while self.resident_bytes > self.max_bytes:  # the new item is the most recently used and fits on its own
+                self.evict()
+
+    # Swap in the refreshed value of a stale entry and start its ttl over, its slot stays where it is in the recency list.
+    # False if the key left the cache meanwhile or the new value does not fit in the budget any more.
+    def refresh(self, key, value):
+        slot = self.slots.get(key)
+        if slot is None:
+            return False
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if self.resident_bytes - self.weights[key] + weight > self.max_bytes:
+                self.remove(key)
+                return False
+            self.resident_bytes += weight - self.weights[key]
+            self.weights[key] = weight
+        self.values[slot] = value
+        self.expiry.renew(key)
+        return True
+
+    def evict(self):
+        slot = self.next[self.sentinel]  # least recently used
+        evicted_key = self.keys[slot]
+        if self.on_evict is not None:
+            expiry = self.expiry
+            self.on_evict(evicted_key, self.values[slot], expiry.remaining(evicted_key), expiry.ttls.get(evicted_key))
+        self.remove(evicted_key)
+        self.evictions += 1
+        self.log_event("evict", evicted_key, {"evicted_key": evicted_key})
+
+    def remove(self, key):
+        slot = self.slots.pop(key)
+        self.unlink(slot)
+        self.keys[slot] = self.values[slot] = None
+        self.free.append(slot)
+        self.forget(key)
+
+    # Drop the bookkeeping of a key that left the cache
+    def forget(self, key):
+        self.expiry.discard(key)
+        if self.weights:
+            self.resident_bytes -= self.weights.pop(key, 0)
+
+    # Remove up to limit entries whose ttl (and stale window) ran out, returns how many were removed
+    def expire(self, limit: int = 100):
+        keys = self.expiry.due(limit)
+        for key in keys:
+            self.remove(key)
+        self.expirations += len(keys)
+        return len(keys)
+
+    # Full state for a snapshot, same layout as LRUCache.dump_state()
+    def dump_state(self):
+        meta = {"policy": self.policy, "capacity": self.capacity, "max_bytes": self.max_bytes, "counters": dump_counters(self)}
+        remaining = self.expiry.remaining
+        entries = []
+        slot = self.next[self.sentinel]
+        while slot != self.sentinel:  # least to most recently used
+            key = self.keys[slot]
+            entries.append((key, self.values[slot], remaining(key)))
+            slot = self.next[slot]
+        return meta, entries
+
+    # Restore a dump_state() into this empty cache, entries whose ttl ran out while we were down are left out
+    def load_state(self, meta, entries, elapsed=0):
+        load_counters(self, meta["counters"])
+        for key, value, remaining in entries:
+            if self.expiry.restore(key, remaining, elapsed):
+                slot = self.free.pop()
+                self.slots[key] = slot
+                self.keys[slot] = key
+                self.values[slot] = value
+                self.append(slot)
+                if self.max_bytes is not None:
+                    self.weights[key] = self.sizer(value)
+                    self.resident_bytes += self.weights[key]
+
+    # Whether key is cached, without counting an access or touching the list (used by the prefetcher)
+    def contains(self, key):
+        return key in self.slots
+
+    def calculate_statistics(self):
+        hit_ratio = self.hits / self.accesses if self.accesses > 0 else 0
+        miss_ratio = self.misses / self.accesses if self.accesses > 0 else 0
+        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": len(self.slots),
+                "evictions": self.evictions, "expirations": self.expirations, "resident_bytes": self.resident_bytes}
+
+    def log_metrics(self, event_type, key, latency, extra=None):
+        if not self.log_events:
+            return
+        hit_rate = self.hits / self.accesses if self.accesses > 0 else 0
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "latency": latency,
+            "hit_rate": hit_rate,
+            "cache_size": len(self.slots),
+            "capacity": self.capacity
+        }
+        if extra:
+            log_entry.update(extra)
+        lru_logger.info(log_entry)
+
+
+# One frequency of CompactLFUCache: the slots with that access count, oldest first. The nodes form a list
+# sorted by frequency, so the least frequently used entry is always at the head of the first node (O(1) LFU).
+class FrequencyNode:
+    __slots__ = ("freq", "head", "tail", "prev", "next")
+
+    def __init__(self, freq, prev=None, next=None):
+        self.freq = freq
+        self.head = NONE
+        self.tail = NONE
+        self.prev = prev
+        self.next = next
+
+
+class CompactLFUCache:
+    policy = "LFU"  # snapshot format, the same as LFUCache
+    on_evict = None
+
+    def __init__(self, capacity: int, log_events: bool = True, default_ttl: float = None, stale_ttl: float = 0,
+                 max_bytes: int = None, sizer=json_size):
+        self.capacity = capacity
+        self.log_events = log_events  # set to False to skip all logging (e.g. offline trace replay)
+        self.slots = {}  # key -> slot
+        self.keys = [None] * capacity
+        self.values = [None] * capacity
+        self.nodes = [None] * capacity  # slot -> its FrequencyNode
+        self.prev = array("i", [NONE]) * capacity  # links between the slots of the same frequency
+        self.next = array("i", [NONE]) * capacity
+        self.free = array("i", range(capacity - 1, -1, -1))  # unused slots, taken from the end
+        self.root = FrequencyNode(0)  # sentinel of the frequency list, root.next has the lowest frequency
+        self.root.prev = self.root.next = self.root
+        self.expiry = ExpiryTracker(default_ttl, stale_ttl)  # expiry times of entries with a ttl
+        self.max_bytes = max_bytes  # optional memory budget on top of the item count, None = count only
+        self.sizer = sizer  # value -> weight in bytes, only used with max_bytes
+        self.weights = {}  # key -> weight of its value, only with max_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.accesses = 0
+        self.evictions = 0  # entries removed to make room
+        self.expirations = 0  # entries removed because their ttl ran out
+
+    def log_event(self, event_type, key, extra=None):
+        if not self.log_events:
+            return
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "cache_size": len(self.slots),
+            "capacity": self.capacity
+        }
+        if extra:
+            log_entry.update(extra)
+        lfu_logger.info(log_entry)
+
+    def add_node(self, freq, prev):  # new frequency node right after prev
+        node = FrequencyNode(freq, prev, prev.next)
+        prev.next.prev = node
+        prev.next = node
+        return node
+
+    def attach(self, slot, node):  # append slot as the newest entry of node
+        self.nodes[slot] = node
+        self.prev[slot] = node.tail
+        self.next[slot] = NONE
+        if node.tail == NONE:
+            node.head = slot
+        else:
+            self.next[node.tail] = slot
+        node.tail = slot
+
+    def detach(self, slot):  # take slot out of its node, dropping the node when it empties
+        node = self.nodes[slot]
+        prev, next = self.prev[slot], self.next[slot]
+        if prev == NONE:
+            node.head = next
+        else:
+            self.next[prev] = next
+        if next == NONE:
+            node.tail = prev
+        else:
+            self.prev[next] = prev
+        if node.head == NONE:
+            node.prev.next = node.next
+            node.next.prev = node.prev
+        return node
+
+    def get(self, key):
+        self.accesses += 1
+        if key in self.expiry.deadlines:  # only entries with a ttl need checking
+            state = self.expiry.state(key)
+            if state == EXPIRED:
+                self.remove(key)
+                self.expirations += 1
+            elif state == STALE:
+                self.expiry.refresh(key)  # served below, refreshed in the background
+        slot = self.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            self.log_event("miss", key)
+            return "Not Found"
+        self.hits += 1
+        self.increment_freq(slot)
+        return self.values[slot]
+
+    # Move a slot to the next frequency, creating that node if it does not exist yet
+    def increment_freq(self, slot):
+        node = self.nodes[slot]
+        next = node.next
+        if next is self.root or next.freq != node.freq + 1:
+            next = self.add_node(node.freq + 1, node)
+        self.detach(slot)
+        self.attach(slot, next)
+
+    def put(self, key, value, ttl: float = None):
+        weight = 0
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if weight > self.max_bytes:  # could never fit, don't cache it (and drop the old value)
+                if key in self.slots:
+                    self.remove(key)
+                return
+
+        slot = self.slots.get(key)
+        if slot is not None:  # key already exists in cache
+            self.values[slot] = value
+            self.increment_freq(slot)  # not counted as a hit, it is a write
+            self.expiry.set(key, ttl)
+            if self.max_bytes is not None:
+                self.resident_bytes += weight - self.weights[key]
+                self.weights[key] = weight
+                while self.resident_bytes > self.max_bytes:  # the value grew, make room without evicting the key itself
+                    self.evict(keep=key)
+            return
+
+        # make room for the item count and the byte budget, the new key is not in the cache yet so it is never picked
+        while self.slots and (len(self.slots) >= self.capacity or
+                              (self.max_bytes is not None and self.resident_bytes + weight > self.max_bytes)):
+            self.evict()
+
+        slot = self.free.pop()
+        self.slots[key] = slot
+        self.keys[slot] = key
+        self.values[slot] = value
+        first = self.root.next
+        if first is self.root or first.freq != 1:
+            first = self.add_node(1, self.root)
+        self.attach(slot, first)
+        self.expiry.set(key, ttl)  # ttl overrides the default ttl for this entry
+        if self.max_bytes is not None:
+            self.weights[key] = weight
+            self.resident_bytes += weight
+
+    # Swap in the refreshed value of a stale entry and start its ttl over, its slot keeps its frequency.
+    # False if the key left the cache meanwhile or the new value does not fit in the budget any more.
+    def refresh(self, key, value):
+        slot = self.slots.get(key)
+        if slot is None:
+            return False
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if self.resident_bytes - self.weights[key] + weight > self.max_bytes:
+                self.remove(key)
+                return False
+            self.resident_bytes += weight - self.weights[key]
+            self.weights[key] = weight
+        self.values[slot] = value
+        self.expiry.renew(key)
+        return True
+
+    def evict(self, keep=None):
+        node = self.root.next
+        slot = node.head  # least frequently used (least recently used among ties)
+        if self.keys[slot] == keep:  # only when keep's value grew, take the next least frequently used item instead
+            slot = self.next[slot]
+            while slot == NONE:
+                node = node.next
+                slot = node.head
+        evicted_key = self.keys[slot]
+        freq = self.nodes[slot].freq
+        if self.on_evict is not None:
+            expiry = self.expiry
+            self.on_evict(evicted_key, self.values[slot], expiry.remaining(evicted_key), expiry.ttls.get(evicted_key))
+        self.remove(evicted_key)
+        self.evictions += 1
+        self.log_event("evict", evicted_key, {"evicted_freq": freq})
+
+    def remove(self, key):
+        slot = self.slots.pop(key)
+        self.detach(slot)
+        self.keys[slot] = self.values[slot] = self.nodes[slot] = None
+        self.free.append(slot)
+        self.forget(key)
+
+    # Drop the bookkeeping of a key that left the cache
+    def forget(self, key):
+        self.expiry.discard(key)
+        if self.weights:
+            self.resident_bytes -= self.weights.pop(key, 0)
+
+    # Remove up to limit entries whose ttl (and stale window) ran out, returns how many were removed
+    def expire(self, limit: int = 100):
+        keys = self.expiry.due(limit)
+        for key in keys:
+            self.remove(key)
+        self.expirations += len(keys)
+        return len(keys)
+
+    # Full state for a snapshot, same layout as LFUCache.dump_state()
+    def dump_state(self):
+        meta = {"policy": self.policy, "capacity": self.capacity, "max_bytes": self.max_bytes, "counters": dump_counters(self)}
+        remaining = self.expiry.remaining
+        entries = []
+        node = self.root.next
+        while node is not self.root:  # by increasing frequency, oldest first within a frequency
+            slot = node.head
+            while slot != NONE:
+                key = self.keys[slot]
+                entries.append((key, self.values[slot], remaining(key), node.freq))
+                slot = self.next[slot]
+            node = node.next
+        return meta, entries
+
+    # Restore a dump_state() into this empty cache, entries whose ttl ran out while we were down are left out
+    def load_state(self, meta, entries, elapsed=0):
+        load_counters(self, meta["counters"])
+        for key, value, remaining, freq in entries:
+            if self.expiry.restore(key, remaining, elapsed):
+                slot = self.free.pop()
+                self.slots[key] = slot
+                self.keys[slot] = key
+                self.values[slot] = value
+                last = self.root.prev  # entries come by increasing frequency, so only the last node can match
+                if last is self.root or last.freq != freq:
+                    last = self.add_node(freq, last)
+                self.attach(slot, last)
+                if self.max_bytes is not None:
+                    self.weights[key] = self.sizer(value)
+                    self.resident_bytes += self.weights[key]
+
+    # Is key cached? Unlike get this leaves its frequency alone
+    def contains(self, key):
+        return key in self.slots
+
+    def calculate_statistics(self):
+        hit_ratio = self.hits / self.accesses if self.accesses > 0 else 0
+        miss_ratio = self.misses / self.accesses if self.accesses > 0 else 0
+        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": len(self.slots),
+                "evictions": self.evictions, "expirations": self.expirations, "resident_bytes": self.resident_bytes}
+
+    def log_metrics(self, event_type, key, latency, extra=None):
+        if not self.log_events:
+            return
+        hit_rate = self.hits / self.accesses if self.accesses > 0 else 0
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "latency": latency,
+            "hit_rate": hit_rate,
+            "cache_size": len(self.slots),
+            "capacity": self.capacity
+        }
+        if extra:
+            log_entry.update(extra)
+        lfu_logger.info(log_entry)
@@ -0,0 +1,203 @@
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+# L2 tier behind a cache: entries evicted from the in-memory cache (L1) are appended to a segment file on local disk
+# and indexed in memory (key -> offset, length, expiry, ttl), so a later miss can read them back instead of going to the
+# origin. An entry lives in one tier at a time: reading it from L2 removes it here and the caller puts it back into
+# L1. Replaced and removed entries leave garbage in the file, which the writer thread compacts away by copying
+# the live records into a new segment once garbage is more than compact_ratio of the file.
+# put() is called by the policies under the shard lock, on the event loop thread for the async endpoints, so it only
+# parks the entry in a pending map: a writer thread pickles and writes it, and take() finds it there until then.
+# The lock only guards the maps and counters, file reads and writes happen outside it: a writer reserves the end of
+# the file under the lock and publishes the record after writing it, a reader pins the segment it reads from so
+# compaction does not close it meanwhile. Writes pause while the writer thread compacts, so the switch to the new
+# segment has nothing to copy (evictions keep going to the pending map).
+# The file is scratch space for one process: it is unlinked right after it is created, a restart starts empty
+# (CACHE_SNAPSHOT_PATH is what keeps the cache across restarts).
+class DiskTier:
+    def __init__(self, name, directory=None, max_bytes=1 << 30, compact_ratio=0.5, compact_min_bytes=1 << 20,
+                 max_pending=10000):
+        self.name = name
+        self.directory = directory or tempfile.gettempdir()
+        self.max_bytes = max_bytes  # live bytes kept, the oldest entries are dropped beyond it
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes  # smaller files are not worth compacting
+        self.index = {}  # key -> (offset, length, expires or None, ttl), in the order the entries were written
+        self.pending = {}  # key -> (value, expires or None, ttl) evicted but not written yet, oldest first
+        self.max_pending = max_pending  # the oldest pending entries are dropped beyond it when the disk falls behind
+        self.lock = threading.Lock()
+        self.fd = self.new_segment()
+        self.pins = {}  # fd -> reads in progress outside the lock, a replaced segment is closed after the last one
+        self.size = 0  # end of the segment file
+        self.live_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0  # entries dropped for max_bytes
+        self.expirations = 0
+        self.compactions = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.run, name=f"l2-writer-{name}", daemon=True)
+        self.writer.start()
+
+    def new_segment(self):
+        fd, path = tempfile.mkstemp(prefix=f"{self.name}-", suffix=".seg", dir=self.directory)
+        os.unlink(path)  # the space is freed when the fd is closed, even if the process is killed
+        return fd
+
+    # Queue an entry evicted from L1 for writing, remaining is what is left of its ttl in seconds (None = no ttl) and
+    # ttl the ttl it was put with (None = the cache's default), kept so it gets the same ttl again in L1
+    def put(self, key, value, remaining=None, ttl=None):
+        expires = time.time() + remaining if remaining is not None else None
+        with self.lock:
+            self.drop(key)
+            self.pending.pop(key, None)  # to the end, pending keeps the eviction order
+            self.pending[key] = (value, expires, ttl)
+            if len(self.pending) > self.max_pending:
+                del self.pending[next(iter(self.pending))]
+                self.evictions += 1
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.write_pending()
+            if self.needs_compaction():
+                self.compact()
+
+    # Pickle and append the pending entries, each stays pending (take() finds it there) until its record is written.
+    # One that was taken, discarded or put again meanwhile is not published, its bytes are garbage.
+    def write_pending(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                if not self.pending:
+                    return
+                key, queued = next(iter(self.pending.items()))
+            record = pickle.dumps(queued[0], protocol=pickle.HIGHEST_PROTOCOL)
+            with self.lock:
+                if self.pending.get(key) is not queued:
+                    continue
+                offset = self.size  # reserved, only this thread appends
+                self.size += len(record)
+            os.pwrite(self.fd, record, offset)
+            with self.lock:
+                if self.pending.get(key) is not queued:
+                    continue
+                del self.pending[key]
+                self.index[key] = (offset, len(record), queued[1], queued[2])
+                self.live_bytes += len(record)
+                self.writes += 1
+                while self.live_bytes > self.max_bytes and self.index:
+                    self.drop(next(iter(self.index)))
+                    self.evictions += 1
+
+    # Read and remove an entry, returns (value, remaining ttl, ttl it was put with) or None. An entry past
+    # ttl + stale_ttl is a miss.
+    def take(self, key, stale_ttl=0):
+        with self.lock:
+            queued = self.pending.get(key)
+            entry = self.index.get(key)
+            if queued is None and entry is None:
+                self.misses += 1
+                return None
+            expires = queued[1] if queued is not None else entry[2]
+            remaining = expires - time.time() if expires is not None else None
+            if remaining is not None and remaining + stale_ttl <= 0:
+                self.pending.pop(key, None)
+                self.drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            if queued is not None:  # not written yet, no disk read
+                del self.pending[key]
+                return queued[0], remaining, queued[2]
+            self.drop(key)  # gone from the index before the read, a put() of the key meanwhile writes a new record
+            fd = self.fd
+            self.pins[fd] = self.pins.get(fd, 0) + 1
+        try:
+            record = os.pread(fd, entry[1], entry[0])
+        finally:
+            with self.lock:
+                self.unpin(fd)
+        return pickle.loads(record), remaining, entry[3]
+
+    # Done reading fd (under the lock), close it if compaction replaced it and this was its last reader
+    def unpin(self, fd):
+        self.pins[fd] -= 1
+        if self.pins[fd] == 0:
+            del self.pins[fd]
+            if fd != self.fd:
+                os.close(fd)
+
+    # A write to L1 makes the copy here outdated
+    def discard(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+            self.drop(key)
+
+    def drop(self, key):
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.live_bytes -= entry[1]
+
+    def needs_compaction(self):
+        with self.lock:
+            return self.size >= self.compact_min_bytes and self.size - self.live_bytes > self.compact_ratio * self.size
+
+    # Copy the live records to a new segment without holding the lock, then switch over under it. Runs on the writer
+    # thread, so nothing is appended meanwhile: the index can only lose entries (taken, discarded, put again), which
+    # are left behind.
+    def compact(self):
+        with self.lock:
+            copied = dict(self.index)
+            old_fd = self.fd
+        new_fd = self.new_segment()
+        new_size = 0
+        moved = {}  # key -> offset in the new segment, for the entries in copied
+        for key, (offset, length, expires, ttl) in copied.items():
+            os.pwrite(new_fd, os.pread(old_fd, length, offset), new_size)
+            moved[key] = new_size
+            new_size += length
+
+        with self.lock:
+            index = {}
+            for key, entry in self.index.items():  # keeps the write order
+                index[key] = (moved[key],) + entry[1:]
+            self.index = index
+            self.fd = new_fd
+            self.size = new_size
+            self.live_bytes = sum(entry[1] for entry in index.values())
+            self.compactions += 1
+            if old_fd not in self.pins:  # else the last take() reading it closes it
+                os.close(old_fd)
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.writer.join(timeout=5)
+        with self.lock:
+            os.close(self.fd)
+
+    def statistics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.index) + len(self.pending),
+                "pending": len(self.pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups > 0 else 0,
+                "live_bytes": self.live_bytes,
+                "file_bytes": self.size,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "compactions": self.compactions,
+            }
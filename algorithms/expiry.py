@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import threading
+import time
+
+FRESH = "fresh"
+STALE = "stale"  # expired but inside the stale-while-revalidate window, still served while it is refreshed
+EXPIRED = "expired"
+
+
+# Expiry times of the entries of one cache. The policies keep their own data structures,
+# they ask this class whether an entry is still usable and which entries are due for removal.
+class ExpiryTracker:
+    def __init__(self, default_ttl=None, stale_ttl=0, clock=time.monotonic):
+        self.default_ttl = default_ttl  # seconds, None means entries never expire unless put with a ttl
+        self.stale_ttl = stale_ttl  # seconds an expired entry may still be served while one refresh runs
+        self.clock = clock
+        self.deadlines = {}  # key -> time it expires, only keys that have a ttl
+        self.ttls = {}  # key -> ttl it was put with, only keys put with their own ttl instead of the default
+        self.heap = []  # (deadline, sequence, key), pairs for overwritten/removed keys are skipped when popped
+        self.sequence = itertools.count()  # tie breaker so keys never get compared
+        self.refreshing = set()  # stale keys a refresh was already requested for
+        self.on_stale = None  # called with the key the first time a stale entry is served
+
+    def set(self, key, ttl=None):
+        if ttl is None:
+            self.ttls.pop(key, None)
+            ttl = self.default_ttl
+        else:
+            self.ttls[key] = ttl
+        self.refreshing.discard(key)
+        if ttl is None:
+            self.deadlines.pop(key, None)
+            return
+        self.schedule(key, self.clock() + ttl)
+
+    # Let key expire in remaining seconds but keep the ttl it was put with for its refreshes, for an entry that used
+    # up part of its ttl outside the cache (L2 tier, prefetch area). A negative remaining makes it stale right away.
+    def set_remaining(self, key, remaining):
+        self.refreshing.discard(key)
+        self.schedule(key, self.clock() + remaining)
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.sequence), key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:  # mostly outdated pairs, rebuild it from the live deadlines
+            self.heap = [(deadline, next(self.sequence), key) for key, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def discard(self, key):
+        self.deadlines.pop(key, None)
+        self.ttls.pop(key, None)
+        self.refreshing.discard(key)
+
+    # Start the ttl of a refreshed entry over, with the ttl it was put with
+    def renew(self, key):
+        self.set(key, self.ttls.get(key))
+
+    def state(self, key):
+        deadline = self.deadlines.get(key)
+        if deadline is None:
+            return FRESH
+        now = self.clock()
+        if now < deadline:
+            return FRESH
+        if now < deadline + self.stale_ttl:
+            return STALE
+        return EXPIRED
+
+    # Seconds until key expires (negative once it did), None if it has no ttl. Deadlines are on the monotonic
+    # clock, so snapshots save this instead.
+    def remaining(self, key):
+        deadline = self.deadlines.get(key)
+        return None if deadline is None else deadline - self.clock()
+
+    # Re-apply a remaining ttl from a snapshot taken elapsed seconds ago, False if the entry is past its stale window
+    def restore(self, key, remaining, elapsed):
+        if remaining is None:
+            return True
+        ttl = remaining - elapsed
+        if ttl + self.stale_ttl <= 0:
+            return False
+        self.set(key, ttl)  # a negative ttl makes it stale right away, served once more and refreshed
+        self.ttls.pop(key, None)  # not the ttl it was put with, ShardedCache restores those from the snapshot meta
+        return True
+
+    # Ask for one background refresh of a stale key
+    def refresh(self, key):
+        if key not in self.refreshing and self.on_stale is not None:
+            self.refreshing.add(key)
+            self.on_stale(key)
+
+    # Keys past their stale window, at most limit of them so a sweep never scans the whole cache
+    def due(self, limit):
+        now = self.clock()
+        keys = []
+        while self.heap and len(keys) < limit and self.heap[0][0] + self.stale_ttl <= now:
+            deadline, _, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]  # a key set twice with the same deadline has two pairs, return it once
+                keys.append(key)
+        return keys
+
+
+# Background thread that removes expired entries a few at a time, entries are also expired lazily on get
+class ExpirySweeper(threading.Thread):
+    def __init__(self, caches, interval=1.0, limit=100):
+        super().__init__(name="expiry-sweeper", daemon=True)
+        self.caches = caches
+        self.interval = interval
+        self.limit = limit  # most entries removed per cache per sweep
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for cache in self.caches:
+                cache.expire(self.limit)
+
+    def stop(self):
+        self.stopped.set()
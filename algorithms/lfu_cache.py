@@ -1,24 +1,38 @@
-import json
-from datetime import datetime
 from collections import OrderedDict, defaultdict
+from algorithms.expiry import ExpiryTracker, STALE, EXPIRED
+from algorithms.sizing import json_size
+from algorithms.snapshot import dump_counters, load_counters
 from log import setup_log
 
 lfu_logger = setup_log("lfu_cache")
 
 
 class LFUCache:
-    def __init__(self, capacity: int):
+    policy = "LFU"  # snapshot format
+    on_evict = None  # callback(key, value, remaining ttl, own ttl) for entries evicted to make room
+
+    def __init__(self, capacity: int, log_events: bool = True, default_ttl: float = None, stale_ttl: float = 0,
+                 max_bytes: int = None, sizer=json_size):
         self.capacity = capacity
+        self.log_events = log_events  # set to False to skip all logging (e.g. offline trace replay)
         self.cache = {}  # Key to {value, frequency}
         self.freq = defaultdict(OrderedDict)  # defaultdict is a dictionary that provides a default value for a key
         self.min_freq = 0  # minimum frequency of all keys in the cache (start at 0, use to track the least frequently used item)
+        self.expiry = ExpiryTracker(default_ttl, stale_ttl)  # expiry times of entries with a ttl
+        self.max_bytes = max_bytes  # optional memory budget on top of the item count, None = count only
+        self.sizer = sizer  # value -> weight in bytes, only used with max_bytes
+        self.weights = {}  # key -> weight of its value, only with max_bytes
+        self.resident_bytes = 0
         self.hits = 0
         self.misses = 0
         self.accesses = 0
+        self.evictions = 0  # entries removed to make room
+        self.expirations = 0  # entries removed because their ttl ran out
 
     def log_event(self, event_type, key, extra=None):
+        if not self.log_events:
+            return
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
             "event_type": event_type,
             "key": key,
             "cache_size": len(self.cache),
@@ -26,61 +40,167 @@ class LFUCache:
         }
         if extra:  # if extra is not None, extra is a dictionary for any additional stuff we might want to log
             log_entry.update(extra)
-        lfu_logger.info(json.dumps(log_entry))
+        lfu_logger.info(log_entry)
 
     def get(self, key: int):
         self.accesses += 1
+        if key in self.expiry.deadlines:  # only entries with a ttl need checking
+            state = self.expiry.state(key)
+            if state == EXPIRED:
+                self.remove(key)
+                self.expirations += 1
+            elif state == STALE:
+                self.expiry.refresh(key)  # served below, refreshed in the background
         if key not in self.cache:  # cache miss! key (item) not found in cache
             self.misses += 1
             self.log_event("miss", key)
             return "Not Found"
         else:  # cache hit!
             self.hits += 1
-            value, freq = self.cache[key]  # get value and frequency of key
-            del self.freq[freq][key]  # remove key from current frequency
-            if not self.freq[freq]:  # if freq is not
-                del self.freq[freq]
-                if self.min_freq == freq:
-                    self.min_freq += 1
-
-            new_freq = freq + 1
-            self.freq[new_freq][key] = None
-            self.cache[key] = (value, new_freq)  # update frequency of key
-
-            #self.log_event("hit", key, {"new_freq": new_freq})
+            value = self.increment_freq(key)
+            #self.log_event("hit", key)
             return value
 
-    def put(self, key: int, value: int):
+    # Move a key to the next frequency bucket, returns its value
+    def increment_freq(self, key):
+        value, freq = self.cache[key]  # get value and frequency of key
+        del self.freq[freq][key]  # remove key from current frequency
+        if not self.freq[freq]:  # if freq is not
+            del self.freq[freq]
+            if self.min_freq == freq:
+                self.min_freq += 1
+
+        new_freq = freq + 1
+        self.freq[new_freq][key] = None
+        self.cache[key] = (value, new_freq)  # update frequency of key
+        return value
+
+    def put(self, key: int, value: int, ttl: float = None):
+        weight = 0
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if weight > self.max_bytes:  # could never fit, don't cache it (and drop the old value)
+                if key in self.cache:
+                    self.remove(key)
+                return
+
         if key in self.cache:  # key already exists in cache
             _, freq = self.cache[key]
             self.cache[key] = (value, freq)
-            self.get(key)  # update frequency of key
+            self.increment_freq(key)  # update frequency of key (not counted as a hit, it is a write)
+            self.expiry.set(key, ttl)
+            if self.max_bytes is not None:
+                self.resident_bytes += weight - self.weights[key]
+                self.weights[key] = weight
+                while self.resident_bytes > self.max_bytes:  # the value grew, make room without evicting the key itself
+                    self.evict(keep=key)
             return
 
-        if len(self.cache) >= self.capacity:  # if the cache is full
-            if self.min_freq in self.freq and self.freq[self.min_freq]:  # check if self.freq[self.min_freq] is not empty
-                evict_key, _ = self.freq[self.min_freq].popitem(last=False)  # remove the least frequently used item
-                if not self.freq[self.min_freq]:  # if the frequency is empty
-                    del self.freq[self.min_freq]  # remove the frequency
-                del self.cache[evict_key]  # remove the key from the cache
-                self.log_event("evict", evict_key, {"evicted_freq": self.min_freq})  # log the eviction
+        # make room for the item count and the byte budget, the new key is not in the cache yet so it is never picked
+        while self.cache and (len(self.cache) >= self.capacity or
+                              (self.max_bytes is not None and self.resident_bytes + weight > self.max_bytes)):
+            self.evict()
 
         self.cache[key] = (value, 1)
         self.freq[1][key] = None
-        self.min_freq = 1 if len(self.cache) == 0 else self.min_freq
+        self.min_freq = 1  # a newly added key always has the lowest frequency
+        self.expiry.set(key, ttl)  # ttl overrides the default ttl for this entry
+        if self.max_bytes is not None:
+            self.weights[key] = weight
+            self.resident_bytes += weight
         # self.log_event("add", key, {"initial_freq": 1})
 
+    # Swap in the refreshed value of a stale entry and start its ttl over, its frequency stays as it is.
+    # False if the key left the cache meanwhile or the new value does not fit in the budget any more.
+    def refresh(self, key, value):
+        if key not in self.cache:
+            return False
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if self.resident_bytes - self.weights[key] + weight > self.max_bytes:
+                self.remove(key)
+                return False
+            self.resident_bytes += weight - self.weights[key]
+            self.weights[key] = weight
+        self.cache[key] = (value, self.cache[key][1])
+        self.expiry.renew(key)
+        return True
+
+    def evict(self, keep=None):
+        if self.min_freq not in self.freq:  # the lowest frequency was emptied by an earlier eviction in the same put
+            self.min_freq = min(self.freq)
+        evict_key = next(iter(self.freq[self.min_freq]))  # least frequently used item (least recently used among ties)
+        if evict_key == keep:  # only when keep's value grew, take the next least frequently used item instead
+            evict_key = next(candidate for freq in sorted(self.freq) for candidate in self.freq[freq] if candidate != keep)
+        value, freq = self.cache.pop(evict_key)  # remove the key from the cache
+        del self.freq[freq][evict_key]
+        if not self.freq[freq]:  # if the frequency is empty
+            del self.freq[freq]  # remove the frequency
+        if self.on_evict is not None:
+            self.on_evict(evict_key, value, self.expiry.remaining(evict_key), self.expiry.ttls.get(evict_key))
+        self.forget(evict_key)
+        self.evictions += 1
+        self.log_event("evict", evict_key, {"evicted_freq": freq})  # log the eviction
+
+    def remove(self, key):
+        _, freq = self.cache.pop(key)
+        del self.freq[freq][key]
+        if not self.freq[freq]:
+            del self.freq[freq]
+            if self.min_freq == freq:  # the lowest bucket is gone, find the next one
+                self.min_freq = min(self.freq) if self.freq else 0
+        self.forget(key)
+
+    # Drop the bookkeeping of a key that left the cache
+    def forget(self, key):
+        self.expiry.discard(key)
+        if self.weights:
+            self.resident_bytes -= self.weights.pop(key, 0)
+
+    # Remove up to limit entries whose ttl (and stale window) ran out, returns how many were removed
+    def expire(self, limit: int = 100):
+        keys = self.expiry.due(limit)
+        for key in keys:
+            self.remove(key)
+        self.expirations += len(keys)
+        return len(keys)
+
+    # Full state for a snapshot: settings and counters, then (key, value, remaining ttl, frequency)
+    # by increasing frequency, oldest first within a frequency
+    def dump_state(self):
+        meta = {"policy": self.policy, "capacity": self.capacity, "max_bytes": self.max_bytes, "counters": dump_counters(self)}
+        remaining = self.expiry.remaining
+        return meta, [(key, self.cache[key][0], remaining(key), freq) for freq in sorted(self.freq) for key in self.freq[freq]]
+
+    # Restore a dump_state() into this empty cache, entries whose ttl ran out while we were down are left out
+    def load_state(self, meta, entries, elapsed=0):
+        load_counters(self, meta["counters"])
+        for key, value, remaining, freq in entries:
+            if self.expiry.restore(key, remaining, elapsed):
+                self.cache[key] = (value, freq)
+                self.freq[freq][key] = None
+                if self.max_bytes is not None:
+                    self.weights[key] = self.sizer(value)
+                    self.resident_bytes += self.weights[key]
+        self.min_freq = min(self.freq) if self.freq else 0
+
+    # Is key cached? Unlike get this leaves its frequency alone
+    def contains(self, key):
+        return key in self.cache
+
     def calculate_statistics(self):
         hit_ratio = self.hits / self.accesses if self.accesses > 0 else 0
         miss_ratio = self.misses / self.accesses if self.accesses > 0 else 0
         cache_size = len(self.cache)
-        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": cache_size}
+        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": cache_size,
+                "evictions": self.evictions, "expirations": self.expirations, "resident_bytes": self.resident_bytes}
 
 
-    def log_metrics(self, event_type, key, latency):
+    def log_metrics(self, event_type, key, latency, extra=None):
+        if not self.log_events:
+            return
         hit_rate = self.hits / self.accesses if self.accesses > 0 else 0
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
             "event_type": event_type,
             "key": key,
             "latency": latency,
@@ -88,4 +208,6 @@ class LFUCache:
             "cache_size": len(self.cache),
             "capacity": self.capacity
         }
-        lfu_logger.info(json.dumps(log_entry))  # log metrics
+        if extra:  # e.g. the hit/miss counts of a batch request
+            log_entry.update(extra)
+        lfu_logger.info(log_entry)  # log metrics
@@ -1,22 +1,36 @@
-import json
 from collections import OrderedDict
-from datetime import datetime
+from algorithms.expiry import ExpiryTracker, STALE, EXPIRED
+from algorithms.sizing import json_size
+from algorithms.snapshot import dump_counters, load_counters
 from log import setup_log
 
 lru_logger = setup_log("lru_cache")
 
 
 class LRUCache:
-    def __init__(self, capacity: int):
+    policy = "LRU"  # snapshot format
+    on_evict = None  # callback(key, value, remaining ttl, own ttl) for entries evicted to make room, e.g. the L2 tier
+
+    def __init__(self, capacity: int, log_events: bool = True, default_ttl: float = None, stale_ttl: float = 0,
+                 max_bytes: int = None, sizer=json_size):
         self.capacity = capacity
+        self.log_events = log_events  # set to False to skip all logging (e.g. offline trace replay)
         self.cache = OrderedDict()  # use an OrderedDict to keep track of the order of items in the cache as they are accessed (most recently used items are at the end)
+        self.expiry = ExpiryTracker(default_ttl, stale_ttl)  # expiry times of entries with a ttl
+        self.max_bytes = max_bytes  # optional memory budget on top of the item count, None = count only
+        self.sizer = sizer  # value -> weight in bytes, only used with max_bytes
+        self.weights = {}  # key -> weight of its value, only with max_bytes
+        self.resident_bytes = 0
         self.hits = 0
         self.misses = 0
         self.accesses = 0
+        self.evictions = 0  # entries removed to make room
+        self.expirations = 0  # entries removed because their ttl ran out
 
     def log_event(self, event_type, key, extra=None):
+        if not self.log_events:
+            return
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
             "event_type": event_type,
             "key": key,
             "cache_size": len(self.cache),
@@ -24,13 +38,20 @@ class LRUCache:
         }
         if extra:  # if extra is not None, extra is a dictionary for any additional stuff we might want to log
             log_entry.update(extra)
-        lru_logger.info(json.dumps(log_entry))
+        lru_logger.info(log_entry)
 
     def get(self, key: int):
         self.accesses += 1
         if self.accesses % 100 == 0:  # every 100 accesses, log statistics
             stats = self.calculate_statistics()
             #self.log_event("access_stats", None, stats)
+        if key in self.expiry.deadlines:  # only entries with a ttl need checking
+            state = self.expiry.state(key)
+            if state == EXPIRED:
+                self.remove(key)
+                self.expirations += 1
+            elif state == STALE:
+                self.expiry.refresh(key)  # served below, refreshed in the background
         if key not in self.cache:  # cache miss
             self.misses += 1
             #self.log_event("miss", key)
@@ -41,27 +62,105 @@ class LRUCache:
             #self.log_event("hit", key)
             return self.cache[key]
 
-    def put(self, key: int, value: any):
+    def put(self, key: int, value: any, ttl: float = None):
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if weight > self.max_bytes:  # could never fit, don't cache it (and drop the old value)
+                if key in self.cache:
+                    self.remove(key)
+                return
+
         if key in self.cache:
             self.cache.move_to_end(key)
             #self.log_event("update", key)
         else:
             if len(self.cache) >= self.capacity:  # if the cache is full
-                popped_item = self.cache.popitem(last=False)  # remove the least recently used item
-                self.log_event("evict", popped_item[0], {"evicted_key": popped_item[0]})
+                self.evict()
             #self.log_event("add", key)
         self.cache[key] = value
+        self.expiry.set(key, ttl)  # ttl overrides the default ttl for this entry
+
+        if self.max_bytes is not None:
+            self.resident_bytes += weight - self.weights.get(key, 0)
+            self.weights[key] = weight
+            while self.resident_bytes > self.max_bytes:  # the new item is the most recently used and fits on its own, so it is never evicted here
+                self.evict()
+
+    # Swap in the refreshed value of a stale entry and start its ttl over. Unlike put it keeps its place: a
+    # background refresh is not an access. False if the key left the cache meanwhile or the value outgrew the budget.
+    def refresh(self, key, value):
+        if key not in self.cache:
+            return False
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if self.resident_bytes - self.weights[key] + weight > self.max_bytes:  # no room without evicting, let the next miss fetch it
+                self.remove(key)
+                return False
+            self.resident_bytes += weight - self.weights[key]
+            self.weights[key] = weight
+        self.cache[key] = value  # an OrderedDict keeps the position of an existing key
+        self.expiry.renew(key)
+        return True
+
+    def evict(self):
+        popped_item = self.cache.popitem(last=False)  # remove the least recently used item
+        if self.on_evict is not None:  # before forget, which drops its ttl
+            key = popped_item[0]
+            self.on_evict(key, popped_item[1], self.expiry.remaining(key), self.expiry.ttls.get(key))
+        self.forget(popped_item[0])
+        self.evictions += 1
+        self.log_event("evict", popped_item[0], {"evicted_key": popped_item[0]})
+
+    def remove(self, key):
+        del self.cache[key]
+        self.forget(key)
+
+    # Drop the bookkeeping of a key that left the cache
+    def forget(self, key):
+        self.expiry.discard(key)
+        if self.weights:
+            self.resident_bytes -= self.weights.pop(key, 0)
+
+    # Remove up to limit entries whose ttl (and stale window) ran out, returns how many were removed
+    def expire(self, limit: int = 100):
+        keys = self.expiry.due(limit)
+        for key in keys:
+            self.remove(key)
+        self.expirations += len(keys)
+        return len(keys)
+
+    # Full state for a snapshot: settings and counters, then (key, value, remaining ttl) from least to most recently used
+    def dump_state(self):
+        meta = {"policy": self.policy, "capacity": self.capacity, "max_bytes": self.max_bytes, "counters": dump_counters(self)}
+        remaining = self.expiry.remaining
+        return meta, [(key, value, remaining(key)) for key, value in self.cache.items()]
+
+    # Restore a dump_state() into this empty cache, entries whose ttl ran out while we were down are left out
+    def load_state(self, meta, entries, elapsed=0):
+        load_counters(self, meta["counters"])
+        for key, value, remaining in entries:
+            if self.expiry.restore(key, remaining, elapsed):
+                self.cache[key] = value
+                if self.max_bytes is not None:
+                    self.weights[key] = self.sizer(value)
+                    self.resident_bytes += self.weights[key]
+
+    # Membership only (for the prefetcher): no access is counted and the key keeps its place
+    def contains(self, key):
+        return key in self.cache
 
     def calculate_statistics(self):
         hit_ratio = self.hits / self.accesses if self.accesses > 0 else 0  # calculate hit ratio (hits / total accesses if there are any accesses)
         miss_ratio = self.misses / self.accesses if self.accesses > 0 else 0  # calculate miss ratio (misses / total accesses if there are any accesses)
         cache_size = len(self.cache) # get the current size of the cache
-        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": cache_size}
+        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": cache_size,
+                "evictions": self.evictions, "expirations": self.expirations, "resident_bytes": self.resident_bytes}
 
-    def log_metrics(self, event_type, key, latency):
+    def log_metrics(self, event_type, key, latency, extra=None):
+        if not self.log_events:
+            return
         hit_rate = self.hits / self.accesses if self.accesses > 0 else 0
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
             "event_type": event_type,
             "key": key,
             "latency": latency,
@@ -69,5 +168,7 @@ class LRUCache:
             "cache_size": len(self.cache),
             "capacity": self.capacity
         }
-        lru_logger.info(json.dumps(log_entry))
+        if extra:  # e.g. the hit/miss counts of a batch request
+            log_entry.update(extra)
+        lru_logger.info(log_entry)
 
@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+
+# In-process latency histograms and hit counters of a cache, read by the /metrics endpoint.
+# Recording never takes a lock: every thread records into its own counters (FastAPI runs the sync endpoints on a
+# threadpool of a fixed size) and a reader adds up the counters of all threads.
+
+# HDR style buckets over integer nanoseconds: every power of two is split into SUB_BUCKETS linear buckets, so a
+# value is known to within 1/SUB_BUCKETS (about 6%) from 1 ns up to MAX_NANOS with a few hundred buckets
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_BITS = 36
+MAX_NANOS = (1 << MAX_BITS) - 1  # about 69 s, slower operations are counted in the last bucket
+BUCKETS = (MAX_BITS - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+QUANTILES = (0.5, 0.99, 0.999)
+HIT_RATIO_WINDOWS = tuple(int(seconds) for seconds in os.getenv("METRICS_WINDOWS", "10,60").split(","))  # rolling hit ratios, in seconds
+
+# (operation, result) of the histograms every cache keeps
+OPERATIONS = (("get", "hit"), ("get", "miss"), ("fill", ""), ("put", ""), ("batch_get", ""), ("batch_put", ""),
+              ("l2", "hit"), ("l2", "miss"))
+
+
+def bucket_index(nanos):
+    if nanos < 2 * SUB_BUCKETS:  # the first buckets are one nanosecond wide
+        return nanos
+    if nanos > MAX_NANOS:
+        nanos = MAX_NANOS
+    shift = nanos.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (nanos >> shift)
+
+
+# Highest value (in seconds) counted in a bucket
+def bucket_upper(index):
+    if index < 2 * SUB_BUCKETS:
+        return (index + 1) / 1e9
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    return ((index - (shift << SUB_BUCKET_BITS) + 1) << shift) / 1e9
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        self.counts[bucket_index(int(seconds * 1e9))] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    # Latency at quantile q (upper bound of its bucket), None (NaN in /metrics) if nothing was recorded
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bucket_upper(index)
+        return bucket_upper(BUCKETS - 1)
+
+
+# Counters of one thread: a histogram per operation and hits/misses per second over the longest window
+class ThreadRecorder:
+    def __init__(self, window):
+        self.histograms = {operation: LatencyHistogram() for operation in OPERATIONS}
+        self.window = window
+        self.seconds = [-1] * window  # second each slot currently counts
+        self.hits = [0] * window
+        self.misses = [0] * window
+
+    def count(self, hits, misses):
+        second = int(time.monotonic())
+        slot = second % self.window
+        if self.seconds[slot] != second:  # the slot still holds an older second, start it over
+            self.seconds[slot] = second
+            self.hits[slot] = 0
+            self.misses[slot] = 0
+        self.hits[slot] += hits
+        self.misses[slot] += misses
+
+
+class CacheMetrics:
+    def __init__(self, windows=HIT_RATIO_WINDOWS):
+        self.windows = windows
+        self.recorders = {}  # thread id -> ThreadRecorder, a thread id reused after a thread ended just continues its counters
+        self.lock = threading.Lock()  # only taken when a thread records for the first time
+
+    def recorder(self):
+        recorder = self.recorders.get(threading.get_ident())
+        if recorder is None:
+            with self.lock:
+                recorder = self.recorders[threading.get_ident()] = ThreadRecorder(max(self.windows))
+        return recorder
+
+    def record_get(self, seconds, hit):
+        recorder = self.recorder()
+        recorder.histograms[("get", "hit" if hit else "miss")].record(seconds)
+        recorder.count(1 if hit else 0, 0 if hit else 1)
+
+    def record_batch(self, seconds, hits, misses):
+        recorder = self.recorder()
+        recorder.histograms[("batch_get", "")].record(seconds)
+        recorder.count(hits, misses)
+
+    # lookup in the L2 tier after an L1 miss
+    def record_l2(self, seconds, hit):
+        self.recorder().histograms[("l2", "hit" if hit else "miss")].record(seconds)
+
+    # fill (origin fetch of a miss, including waiting for a coalesced one), put and batch_put
+    def record(self, operation, seconds):
+        self.recorder().histograms[(operation, "")].record(seconds)
+
+    # Histograms of all threads added up, (operation, result) -> LatencyHistogram
+    def histograms(self):
+        merged = {operation: LatencyHistogram() for operation in OPERATIONS}
+        for recorder in list(self.recorders.values()):
+            for operation, histogram in recorder.histograms.items():
+                merged[operation].merge(histogram)
+        return merged
+
+    # Hit ratio over the last few seconds for every window, None when there were no lookups
+    def hit_ratios(self):
+        now = int(time.monotonic())
+        totals = {window: [0, 0] for window in self.windows}
+        for recorder in list(self.recorders.values()):
+            for second, hits, misses in zip(recorder.seconds, recorder.hits, recorder.misses):
+                for window, total in totals.items():
+                    if 0 <= now - second < window:
+                        total[0] += hits
+                        total[1] += misses
+        return {window: hits / (hits + misses) if hits + misses else None for window, (hits, misses) in totals.items()}
+
+
+def format_labels(labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items() if value != "") + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value is not None else "NaN"
+
+
+# Prometheus text exposition of the caches (name -> ShardedCache), one family of lines per metric
+def prometheus_text(caches):
+    families = {
+        "cache_latency_seconds": ("summary", "Latency of cache operations", []),
+        "cache_hit_ratio": ("gauge", "Hit ratio over a rolling window (or the lifetime of the process)", []),
+        "cache_evictions_total": ("counter", "Entries removed to make room", []),
+        "cache_expirations_total": ("counter", "Entries removed because their ttl ran out", []),
+        "cache_resident_bytes": ("gauge", "Bytes of the cached values (with CACHE_MAX_BYTES)", []),
+        "cache_entries": ("gauge", "Entries in the cache", []),
+        "cache_capacity": ("gauge", "Entries the cache can hold", []),
+    }
+    for name, cache in caches.items():
+        for (operation, result), histogram in cache.metrics.histograms().items():
+            labels = {"cache": name, "operation": operation, "result": result}
+            lines = families["cache_latency_seconds"][2]
+            for q in QUANTILES:
+                lines.append(f"cache_latency_seconds{format_labels({**labels, 'quantile': q})} {format_value(histogram.quantile(q))}")
+            lines.append(f"cache_latency_seconds_sum{format_labels(labels)} {format_value(histogram.sum)}")
+            lines.append(f"cache_latency_seconds_count{format_labels(labels)} {histogram.count}")
+
+        stats = cache.calculate_statistics()
+        ratios = {f"{window}s": ratio for window, ratio in cache.metrics.hit_ratios().items()}
+        ratios["lifetime"] = stats["hit_ratio"]
+        for window, ratio in ratios.items():
+            families["cache_hit_ratio"][2].append(f"cache_hit_ratio{format_labels({'cache': name, 'window': window})} {format_value(ratio)}")
+        labels = format_labels({"cache": name})
+        families["cache_evictions_total"][2].append(f"cache_evictions_total{labels} {stats.get('evictions', 0)}")
+        families["cache_expirations_total"][2].append(f"cache_expirations_total{labels} {stats.get('expirations', 0)}")
+        families["cache_resident_bytes"][2].append(f"cache_resident_bytes{labels} {stats.get('resident_bytes', 0)}")
+        families["cache_entries"][2].append(f"cache_entries{labels} {stats.get('cache_size', 0)}")
+        families["cache_capacity"][2].append(f"cache_capacity{labels} {cache.capacity}")
+
+    output = []
+    for metric, (metric_type, help_text, lines) in families.items():
+        output.append(f"# HELP {metric} {help_text}")
+        output.append(f"# TYPE {metric} {metric_type}")
+        output.extend(lines)
+    return "\n".join(output) + "\n"
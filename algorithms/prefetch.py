@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Prefetching beside a cache. Every requested key teaches it two things: the stride between consecutive numeric
+# keys (1, 2, 3 -> 4, 5) and which key tends to follow which (a bounded successor table). The keys it predicts
+# are loaded from the origin on a background executor into a prefetch area of their own, so a wrong guess never
+# evicts anything from the cache. A prefetched entry only moves into the cache when it is actually requested, with
+# what is left of the ttl it got when it was loaded.
+class Prefetcher:
+    def __init__(self, cache, load, executor, area_size=64, depth=2, table_size=10000, successors=4, min_count=2,
+                 ttl=None):
+        self.cache = cache  # ShardedCache, predictions it already holds are not loaded again
+        self.load = load  # key -> cache entry or None, called on the executor
+        self.executor = executor
+        self.area = OrderedDict()  # key -> (prefetched entry, expiry time or None), oldest dropped first when full
+        self.area_size = area_size
+        self.ttl = ttl  # seconds, the cache's default ttl (None = prefetched entries never expire)
+        self.depth = depth  # keys predicted ahead by the stride, and successors taken per key
+        self.table = OrderedDict()  # key -> {next key: times seen}, least recently updated key dropped first
+        self.table_size = table_size
+        self.successors = successors  # next keys remembered per key
+        self.min_count = min_count  # times a successor has to be seen before it is prefetched
+        self.pending = set()  # keys being loaded
+        self.invalidated = set()  # pending keys written while they loaded, their loaded value is thrown away
+        self.previous = None
+        self.previous_number = None
+        self.stride = None
+        self.lock = threading.Lock()
+        self.issued = 0  # entries loaded into the area
+        self.useful = 0  # prefetched entries that were requested
+        self.wasted = 0  # prefetched entries dropped without being requested (area full or expired)
+        self.misses = 0  # cache misses the area could not serve either
+
+    # Called for every request, after the cache lookup: learn from the key and start loading what comes next
+    def access(self, key):
+        with self.lock:
+            predictions = [prediction for prediction in self.learn(key)
+                           if prediction != key and prediction not in self.area and prediction not in self.pending]
+            self.pending.update(predictions)
+        for prediction in predictions:
+            self.executor.submit(self.fetch, prediction)
+
+    def learn(self, key):
+        if self.previous is not None and self.previous != key:
+            counts = self.table.get(self.previous)
+            if counts is None:
+                counts = self.table[self.previous] = {}
+                if len(self.table) > self.table_size:
+                    self.table.popitem(last=False)
+            else:
+                self.table.move_to_end(self.previous)
+            counts[key] = counts.get(key, 0) + 1
+            if len(counts) > self.successors:  # make room by forgetting the weakest other successor
+                del counts[min((successor for successor in counts if successor != key), key=counts.get)]
+
+        predictions = []
+        number = int(key) if key.isdecimal() else None  # isdigit() is also true for "²", which int() rejects
+        stride = number - self.previous_number if number is not None and self.previous_number is not None else None
+        if stride and stride == self.stride:  # the same step twice in a row, keep going
+            predictions.extend(str(number + stride * step) for step in range(1, self.depth + 1) if number + stride * step > 0)
+        counts = self.table.get(key)
+        if counts:
+            likely = sorted((successor for successor, count in counts.items() if count >= self.min_count),
+                            key=counts.get, reverse=True)
+            predictions.extend(likely[:self.depth])
+        self.previous = key
+        self.previous_number = number
+        self.stride = stride
+        return list(dict.fromkeys(predictions))
+
+    # The load runs without the lock, a write to key meanwhile (invalidate) is seen under the lock before storing it
+    def fetch(self, key):
+        entry = None
+        try:
+            if not self.cache.contains(key):
+                entry = self.load(key)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+                if key in self.invalidated:  # loaded from before the write, serving it would undo the write
+                    self.invalidated.discard(key)
+                    entry = None
+                if entry is not None:
+                    self.area[key] = (entry, time.monotonic() + self.ttl if self.ttl is not None else None)
+                    self.area.move_to_end(key)
+                    self.issued += 1
+                    if len(self.area) > self.area_size:
+                        self.area.popitem(last=False)
+                        self.wasted += 1
+
+    # On a cache miss: (prefetched entry, remaining ttl) for key or None (the caller puts it into the cache)
+    def take(self, key):
+        with self.lock:
+            entry, expires = self.area.pop(key, (None, None))
+            remaining = expires - time.monotonic() if expires is not None else None
+            if remaining is not None and remaining <= 0:  # loaded too long ago, the origin may have changed since
+                entry = None
+                self.wasted += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self.useful += 1
+            return entry, remaining
+
+    # A write makes a prefetched copy outdated, and a copy still loading too
+    def invalidate(self, key):
+        with self.lock:
+            self.area.pop(key, None)
+            if key in self.pending:
+                self.invalidated.add(key)
+
+    # accuracy: share of the prefetched entries that were used, coverage: share of the misses they served
+    def statistics(self):
+        with self.lock:
+            return {
+                "issued": self.issued,
+                "useful": self.useful,
+                "wasted": self.wasted,
+                "accuracy": self.useful / self.issued if self.issued > 0 else 0,
+                "coverage": self.useful / (self.useful + self.misses) if self.useful + self.misses > 0 else 0,
+                "area_size": len(self.area),
+                "pending": len(self.pending),
+                "table_size": len(self.table),
+            }
@@ -0,0 +1,147 @@
+import threading
+import zlib
+from algorithms.metrics import CacheMetrics
+
+
+# Spreads keys over several independent instances of one cache policy, each behind its own lock.
+# The policies themselves are not thread safe and FastAPI runs the sync endpoints on a threadpool,
+# so every call into a shard happens while holding that shard's lock.
+class ShardedCache:
+    def __init__(self, cache_class, capacity: int, shards: int = 1, max_bytes: int = None, **kwargs):
+        shards = max(1, min(shards, capacity))  # every shard needs room for at least one item
+        self.name = cache_class.__name__  # used in the app log instead of ShardedCache
+        self.capacity = capacity
+        self.shards = []
+        for index in range(shards):
+            shard_capacity = capacity // shards + (1 if index < capacity % shards else 0)  # split the capacity as evenly as possible
+            if max_bytes is not None:  # the byte budget is split the same way
+                kwargs["max_bytes"] = max_bytes // shards + (1 if index < max_bytes % shards else 0)
+            self.shards.append(cache_class(capacity=shard_capacity, **kwargs))
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.metrics = CacheMetrics()  # latency histograms and rolling hit ratios for /metrics, recorded by the endpoints
+
+    # crc32 rather than hash(): str hashes are salted per process, a snapshot must find its keys in the same shards
+    def shard_index(self, key):
+        if len(self.shards) == 1:
+            return 0
+        return zlib.crc32(str(key).encode("utf-8")) % len(self.shards)
+
+    def get(self, key):
+        index = self.shard_index(key)
+        with self.locks[index]:
+            return self.shards[index].get(key)
+
+    # remaining: seconds left of the ttl of an entry that spent part of it outside the cache (ExpiryTracker.set_remaining)
+    def put(self, key, value, ttl=None, remaining=None):
+        index = self.shard_index(key)
+        with self.locks[index]:
+            shard = self.shards[index]
+            shard.put(key, value, ttl)
+            if remaining is not None and key in shard.expiry.deadlines:
+                shard.expiry.set_remaining(key, remaining)
+
+    # Store a refreshed value without counting an access, False if the key is no longer cached
+    def refresh(self, key, value):
+        index = self.shard_index(key)
+        with self.locks[index]:
+            return self.shards[index].refresh(key, value)
+
+    def contains(self, key):
+        index = self.shard_index(key)
+        with self.locks[index]:
+            return self.shards[index].contains(key)
+
+    # Look up several keys taking each shard's lock once, returns key -> value (or "Not Found")
+    def get_many(self, keys):
+        results = {}
+        for index, shard_keys in self.group_by_shard(keys).items():
+            shard = self.shards[index]
+            with self.locks[index]:
+                for key in shard_keys:
+                    results[key] = shard.get(key)
+        return results
+
+    def put_many(self, items, ttl=None):
+        for index, shard_keys in self.group_by_shard(items).items():
+            shard = self.shards[index]
+            with self.locks[index]:
+                for key in shard_keys:
+                    shard.put(key, items[key], ttl)
+
+    def group_by_shard(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.shard_index(key), []).append(key)
+        return groups
+
+    # Incremental expiry sweep, at most limit entries per shard and one shard lock at a time
+    def expire(self, limit=100):
+        removed = 0
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                removed += shard.expire(limit)
+        return removed
+
+    # callback(cache, key) is called when a stale entry is served, to refresh it in the background
+    def set_on_stale(self, callback):
+        for shard in self.shards:
+            shard.expiry.on_stale = lambda key: callback(self, key)
+
+    # callback(key, value, remaining ttl, ttl it was put with or None for the default) is called (under the shard's
+    # lock) for every entry evicted to make room
+    def set_on_evict(self, callback):
+        for shard in self.shards:
+            shard.on_evict = callback
+
+    # (meta, entries) of every shard for a snapshot, None if the policy has no snapshots.
+    # Each shard is locked only while its entries are copied, the file is written afterwards.
+    # The entries carry their remaining ttl, the meta the ttls entries were put with (for their refreshes).
+    def dump_state(self):
+        if not hasattr(self.shards[0], "dump_state"):
+            return None
+        states = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                meta, entries = shard.dump_state()
+                meta["ttls"] = dict(shard.expiry.ttls)
+                states.append((meta, entries))
+        return states
+
+    # Whether the shard metas of a snapshot were taken with these settings (policy, number of shards and the capacity
+    # and byte budget of each). Checked for all shards before any is loaded, a cache is never left half warm.
+    def accepts_state(self, metas):
+        return len(metas) == len(self.shards) and all(
+            meta.get("policy") == getattr(shard, "policy", None) and meta.get("capacity") == shard.capacity and
+            meta.get("max_bytes") == shard.max_bytes for meta, shard in zip(metas, self.shards))
+
+    # Load one shard from a snapshot accepts_state() accepted
+    def load_shard_state(self, index, meta, entries, elapsed=0):
+        shard = self.shards[index]
+        with self.locks[index]:
+            shard.load_state(meta, entries, elapsed)
+            deadlines = shard.expiry.deadlines
+            shard.expiry.ttls = {key: ttl for key, ttl in meta.get("ttls", {}).items() if key in deadlines}
+
+    # Merge the statistics of all shards: counters and sizes are summed, ratios are recomputed from the totals
+    def calculate_statistics(self):
+        hits = misses = accesses = 0
+        stats = {}
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard_stats = shard.calculate_statistics()
+                hits += shard.hits
+                misses += shard.misses
+                accesses += shard.accesses
+            for name, value in shard_stats.items():
+                if name.endswith("_ratio") or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                stats[name] = stats.get(name, 0) + value
+        merged = {"hit_ratio": hits / accesses if accesses > 0 else 0, "miss_ratio": misses / accesses if accesses > 0 else 0}
+        merged.update(stats)
+        merged["shards"] = len(self.shards)
+        return merged
+
+    # Metrics are logged by the shard that owns the key, so hit_rate and cache_size in the log are per shard.
+    # No lock, logging only reads the counters and should not hold up other requests.
+    def log_metrics(self, event_type, key, latency, extra=None):
+        self.shards[self.shard_index(key)].log_metrics(event_type, key, latency, extra)
@@ -0,0 +1,341 @@
+import fcntl
+import mmap
+import os
+import pickle
+import threading
+import time
+import zlib
+from algorithms.expiry import ExpiryTracker
+from log import setup_log
+
+shared_logger = setup_log("shared_cache")
+
+MAGIC = b"SHMCLK02"
+KEY_BYTES = 64  # longest key (utf-8) that can be cached
+EMPTY = -1  # free position of the hash table
+
+# int64 counters after the magic, shared by every process that maps the file
+CAPACITY, SLOT_BYTES, TABLE_SIZE, HAND, FREE_TOP, SIZE, HITS, MISSES, ACCESSES, EVICTIONS, EXPIRATIONS, RESIDENT, SWEEP = range(13)
+HEADER_FIELDS = 13
+
+# per-slot arrays that follow the header and the hash table: (name, struct format)
+SLOT_ARRAYS = [("free", "i"), ("hashes", "I"), ("used", "B"), ("ref", "B"), ("key_len", "H"), ("value_len", "I"),
+               ("fresh_until", "d"), ("stale_until", "d"), ("ttl", "d")]
+ITEM_SIZES = {"i": 4, "I": 4, "B": 1, "H": 2, "d": 8}
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+# Offsets of the regions of a cache file and its total size
+def layout(capacity, slot_bytes):
+    table_size = 1
+    while table_size < 2 * capacity:  # load factor <= 0.5 keeps the probe sequences short
+        table_size *= 2
+    offsets = {"table": 8 + 8 * HEADER_FIELDS}
+    offset = align(offsets["table"] + 4 * table_size)
+    for name, fmt in SLOT_ARRAYS:
+        offsets[name] = offset
+        offset = align(offset + ITEM_SIZES[fmt] * capacity)
+    offsets["data"] = offset
+    return table_size, offsets, offset + capacity * (KEY_BYTES + slot_bytes)
+
+
+# A threading lock for the threads of this process plus flock() on the file for the other processes
+class ProcessLock:
+    def __init__(self, fd):
+        self.fd = fd
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+# LRU-like cache in a memory mapped file (put it in /dev/shm) so every uvicorn worker on the machine shares one resident
+# set. Fixed size slots hold the key and the pickled value, an open addressing hash table maps keys to slots and
+# CLOCK (a reference bit per slot and a rotating hand) approximates LRU eviction without moving anything on a hit.
+# Same interface as LRUCache; values that do not fit in a slot are not cached, so memory is capacity * slot_bytes
+# and max_bytes/sizer are ignored. The file is created by the first process and attached to by the others, its name
+# gets the format and geometry appended to path.
+class SharedMemoryCache:
+    def __init__(self, capacity: int, log_events: bool = True, default_ttl: float = None, stale_ttl: float = 0,
+                 max_bytes: int = None, sizer=None, path: str = "/dev/shm/cache", slot_bytes: int = 1024):
+        self.capacity = capacity
+        self.log_events = log_events
+        self.slot_bytes = slot_bytes
+        # The format and geometry are part of the file name: workers started with other settings (e.g. a rolling
+        # restart that changes the capacity or SHARED_CACHE_SLOT_BYTES) get a file of their own instead of resizing
+        # the one the running workers have mapped. Files of old settings stay until deleted (or a reboot for /dev/shm).
+        self.path = f"{path}-{MAGIC.decode('ascii').lower()}-{capacity}x{slot_bytes}"
+        # ttl settings, the stale refresh callback and the keys this process asked to refresh,
+        # the deadlines themselves are in the shared slots
+        self.expiry = ExpiryTracker(default_ttl, stale_ttl, clock=time.time)
+        self.table_size, self.offsets, size = layout(capacity, slot_bytes)
+        self.stride = KEY_BYTES + slot_bytes
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = ProcessLock(self.fd)
+        with self.lock:
+            header = os.pread(self.fd, 8 + 8 * 3, 0)
+            expected = MAGIC + capacity.to_bytes(8, "little") + slot_bytes.to_bytes(8, "little") + self.table_size.to_bytes(8, "little")
+            file_size = os.fstat(self.fd).st_size
+            # the magic is written last by initialize(), a file without it was never used by anyone
+            fresh_file = file_size == 0 or (file_size == size and header[:8] != MAGIC)
+            foreign = not fresh_file and (file_size != size or header != expected)
+            if not foreign:
+                if file_size == 0:
+                    os.ftruncate(self.fd, size)  # zero filled
+                self.mm = mmap.mmap(self.fd, size)
+                self.map_views()
+                if fresh_file:
+                    self.initialize()
+        if foreign:  # never resized in place, other processes may have it mapped
+            os.close(self.fd)
+            raise ValueError(f"{self.path} is not a shared cache of capacity {capacity} with {slot_bytes} byte slots, "
+                             f"delete it if no worker uses it")
+
+    def map_views(self):
+        view = memoryview(self.mm)
+        self.counters = view[8:8 + 8 * HEADER_FIELDS].cast("q")
+        self.table = view[self.offsets["table"]:self.offsets["table"] + 4 * self.table_size].cast("i")
+        for name, fmt in SLOT_ARRAYS:
+            start = self.offsets[name]
+            setattr(self, name, view[start:start + ITEM_SIZES[fmt] * self.capacity].cast(fmt))
+
+    def initialize(self):
+        self.counters[CAPACITY] = self.capacity
+        self.counters[SLOT_BYTES] = self.slot_bytes
+        self.counters[TABLE_SIZE] = self.table_size
+        start = self.offsets["table"]
+        self.mm[start:start + 4 * self.table_size] = b"\xff" * (4 * self.table_size)  # every position EMPTY (-1)
+        for slot in range(self.capacity):  # free stack, slot 0 on top
+            self.free[slot] = self.capacity - 1 - slot
+        self.counters[FREE_TOP] = self.capacity
+        self.mm[0:8] = MAGIC  # last, so a process that died halfway leaves a file the next one initializes again
+
+    # Statistics are shared too, so ShardedCache and /stats see the totals of all processes
+    @property
+    def hits(self):
+        return self.counters[HITS]
+
+    @property
+    def misses(self):
+        return self.counters[MISSES]
+
+    @property
+    def accesses(self):
+        return self.counters[ACCESSES]
+
+    def log_event(self, event_type, key, extra=None):
+        if not self.log_events:
+            return
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "cache_size": self.counters[SIZE],
+            "capacity": self.capacity
+        }
+        if extra:
+            log_entry.update(extra)
+        shared_logger.info(log_entry)
+
+    def key_at(self, slot):
+        start = self.offsets["data"] + slot * self.stride
+        return self.mm[start:start + self.key_len[slot]]
+
+    # Position of key in the hash table and its slot, or the empty position where it would go and -1
+    def find(self, key_bytes, key_hash):
+        mask = self.table_size - 1
+        position = key_hash & mask
+        while True:
+            slot = self.table[position]
+            if slot == EMPTY:
+                return position, -1
+            if self.hashes[slot] == key_hash and self.key_at(slot) == key_bytes:
+                return position, slot
+            position = (position + 1) & mask
+
+    def get(self, key):
+        key_bytes = str(key).encode("utf-8")
+        key_hash = zlib.crc32(key_bytes)  # hash() is salted per process, the table is shared
+        stale = False
+        with self.lock:
+            self.counters[ACCESSES] += 1
+            position, slot = self.find(key_bytes, key_hash)
+            if slot >= 0 and self.stale_until[slot]:  # only entries with a ttl need checking
+                now = time.time()
+                if now >= self.stale_until[slot]:
+                    self.remove_at(position, slot)
+                    self.counters[EXPIRATIONS] += 1
+                    slot = -1
+                else:
+                    stale = now >= self.fresh_until[slot]
+            if slot < 0:
+                self.counters[MISSES] += 1
+                return "Not Found"
+            self.counters[HITS] += 1
+            self.ref[slot] = 1  # second chance when the hand comes round
+            start = self.offsets["data"] + slot * self.stride + KEY_BYTES
+            data = self.mm[start:start + self.value_len[slot]]
+        if stale:
+            self.expiry.refresh(key)  # served below, refreshed in the background (once per process)
+        return pickle.loads(data)
+
+    def put(self, key, value, ttl: float = None):
+        key_bytes = str(key).encode("utf-8")
+        key_hash = zlib.crc32(key_bytes)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        ttl = self.expiry.default_ttl if ttl is None else ttl
+        self.expiry.refreshing.discard(key)
+        with self.lock:
+            position, slot = self.find(key_bytes, key_hash)
+            if len(key_bytes) > KEY_BYTES or len(data) > self.slot_bytes:  # does not fit, don't cache it (and drop the old value)
+                if slot >= 0:
+                    self.remove_at(position, slot)
+                return
+            if slot >= 0:  # update in place
+                self.counters[RESIDENT] -= self.value_len[slot]
+                self.ref[slot] = 1
+            else:
+                slot = self.allocate()
+                position, _ = self.find(key_bytes, key_hash)  # eviction may have moved table entries
+                self.table[position] = slot
+                self.hashes[slot] = key_hash
+                self.used[slot] = 1
+                self.ref[slot] = 0
+                self.key_len[slot] = len(key_bytes)
+                start = self.offsets["data"] + slot * self.stride
+                self.mm[start:start + len(key_bytes)] = key_bytes
+                self.counters[SIZE] += 1
+            start = self.offsets["data"] + slot * self.stride + KEY_BYTES
+            self.mm[start:start + len(data)] = data
+            self.value_len[slot] = len(data)
+            self.counters[RESIDENT] += len(data)
+            if ttl is None:
+                self.fresh_until[slot] = self.stale_until[slot] = 0
+            else:
+                self.ttl[slot] = ttl  # kept for refresh
+                self.fresh_until[slot] = time.time() + ttl
+                self.stale_until[slot] = self.fresh_until[slot] + self.expiry.stale_ttl
+
+    # Overwrite the value of a stale entry with its refreshed one and start its ttl over, leaving the reference
+    # bit alone (a background refresh is not an access). False if the key is gone or the value no longer fits.
+    def refresh(self, key, value):
+        key_bytes = str(key).encode("utf-8")
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.expiry.refreshing.discard(key)
+        with self.lock:
+            position, slot = self.find(key_bytes, zlib.crc32(key_bytes))
+            if slot < 0:
+                return False
+            if len(data) > self.slot_bytes:
+                self.remove_at(position, slot)
+                return False
+            start = self.offsets["data"] + slot * self.stride + KEY_BYTES
+            self.mm[start:start + len(data)] = data
+            self.counters[RESIDENT] += len(data) - self.value_len[slot]
+            self.value_len[slot] = len(data)
+            if self.stale_until[slot]:
+                self.fresh_until[slot] = time.time() + self.ttl[slot]
+                self.stale_until[slot] = self.fresh_until[slot] + self.expiry.stale_ttl
+            return True
+
+    # A free slot, evicting with CLOCK when there is none: the hand clears reference bits until it finds an unreferenced slot
+    def allocate(self):
+        if self.counters[FREE_TOP] == 0:
+            while True:
+                hand = self.counters[HAND]
+                self.counters[HAND] = (hand + 1) % self.capacity
+                if self.ref[hand]:
+                    self.ref[hand] = 0
+                    continue
+                evicted_key = self.key_at(hand).decode("utf-8")
+                position, _ = self.find(self.key_at(hand), self.hashes[hand])
+                self.remove_at(position, hand)
+                self.counters[EVICTIONS] += 1
+                self.log_event("evict", evicted_key, {"evicted_key": evicted_key})
+                break
+        self.counters[FREE_TOP] -= 1
+        return self.free[self.counters[FREE_TOP]]
+
+    # Free a slot and delete its table position, later entries of the probe sequence are shifted back (no tombstones)
+    def remove_at(self, position, slot):
+        mask = self.table_size - 1
+        hole = position
+        current = position
+        while True:
+            current = (current + 1) & mask
+            moved = self.table[current]
+            if moved == EMPTY:
+                break
+            home = self.hashes[moved] & mask
+            if (hole < current and (home <= hole or home > current)) or (hole > current and home <= hole and home > current):
+                self.table[hole] = moved  # its home is not between the hole and its position, it can move up
+                hole = current
+        self.table[hole] = EMPTY
+        self.used[slot] = 0
+        self.counters[RESIDENT] -= self.value_len[slot]
+        self.counters[SIZE] -= 1
+        self.free[self.counters[FREE_TOP]] = slot
+        self.counters[FREE_TOP] += 1
+        self.expiry.refreshing.discard(self.key_at(slot).decode("utf-8"))
+
+    # Remove up to limit entries whose ttl (and stale window) ran out, checking a bounded run of slots per call
+    def expire(self, limit: int = 100):
+        removed = 0
+        with self.lock:
+            now = time.time()
+            for _ in range(min(self.capacity, 10 * limit)):
+                slot = self.counters[SWEEP]
+                self.counters[SWEEP] = (slot + 1) % self.capacity
+                if self.used[slot] and self.stale_until[slot] and now >= self.stale_until[slot]:
+                    position, _ = self.find(self.key_at(slot), self.hashes[slot])
+                    self.remove_at(position, slot)
+                    removed += 1
+                    if removed >= limit:
+                        break
+            self.counters[EXPIRATIONS] += removed
+        return removed
+
+    # Whether key is in the table, without counting an access or setting its reference bit
+    def contains(self, key):
+        key_bytes = str(key).encode("utf-8")
+        with self.lock:
+            return self.find(key_bytes, zlib.crc32(key_bytes))[1] >= 0
+
+    def calculate_statistics(self):
+        accesses = self.counters[ACCESSES]
+        hit_ratio = self.counters[HITS] / accesses if accesses > 0 else 0
+        miss_ratio = self.counters[MISSES] / accesses if accesses > 0 else 0
+        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": self.counters[SIZE],
+                "evictions": self.counters[EVICTIONS], "expirations": self.counters[EXPIRATIONS],
+                "resident_bytes": self.counters[RESIDENT]}
+
+    def log_metrics(self, event_type, key, latency, extra=None):
+        if not self.log_events:
+            return
+        accesses = self.counters[ACCESSES]
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "latency": latency,
+            "hit_rate": self.counters[HITS] / accesses if accesses > 0 else 0,
+            "cache_size": self.counters[SIZE],
+            "capacity": self.capacity,
+            "pid": os.getpid()
+        }
+        if extra:
+            log_entry.update(extra)
+        shared_logger.info(log_entry)
+
+    def close(self):
+        for view in [self.counters, self.table] + [getattr(self, name) for name, _ in SLOT_ARRAYS]:
+            view.release()
+        self.mm.close()
+        os.close(self.fd)
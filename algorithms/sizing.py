@@ -0,0 +1,8 @@
+import json
+
+
+# Default weight of a cached value: the length of its JSON encoding, roughly what it costs to hold and send
+def json_size(value):
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return len(json.dumps(value, default=str))
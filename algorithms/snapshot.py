@@ -0,0 +1,116 @@
+import gc
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+
+# Snapshots of the cache contents so a restarted replica starts warm. The file is a stream of pickles:
+# a header, then for every cache a section with the policy's metadata (settings, counters, p, ...) of all its
+# shards, followed by the entries of each shard in chunks and a None. Loading unpickles one chunk at a time straight into the policy's structures,
+# nothing is parsed as a whole and nothing goes through put(), so a restore does not run any eviction logic.
+
+SNAPSHOT_VERSION = 2  # 2: the metas of all shards come first, so a cache is checked before any shard is loaded
+CHUNK_SIZE = 4096  # entries per pickle
+COUNTERS = ("hits", "misses", "accesses", "evictions", "expirations")
+
+
+def dump_counters(cache):
+    return {name: getattr(cache, name) for name in COUNTERS}
+
+
+def load_counters(cache, counters):
+    for name in COUNTERS:
+        setattr(cache, name, counters.get(name, 0))
+
+
+# The cyclic garbage collector would run over and over while millions of entries are copied or unpickled,
+# pausing it makes saving and loading 2-3x faster (reference counting still frees everything as usual)
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# Write the state of every cache (name -> ShardedCache) to path, atomically (readers never see a half written file)
+def save_snapshot(path, caches):
+    start = time.time()
+    temporary = f"{path}.{os.getpid()}.tmp"  # workers sharing a path each write their own file
+    entries_written = 0
+    with gc_paused(), open(temporary, "wb") as file:
+        pickle.dump({"version": SNAPSHOT_VERSION, "saved_at": start}, file, pickle.HIGHEST_PROTOCOL)
+        for name, cache in caches.items():
+            states = cache.dump_state()
+            if states is None:  # policy without snapshots (the shared memory cache outlives the workers anyway)
+                continue
+            pickle.dump({"cache": name, "metas": [meta for meta, _ in states]}, file, pickle.HIGHEST_PROTOCOL)
+            for _, entries in states:
+                for offset in range(0, len(entries), CHUNK_SIZE):
+                    pickle.dump(entries[offset:offset + CHUNK_SIZE], file, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(None, file, pickle.HIGHEST_PROTOCOL)
+                entries_written += len(entries)
+        pickle.dump(None, file, pickle.HIGHEST_PROTOCOL)  # end of the caches
+    os.replace(temporary, path)
+    return {"entries": entries_written, "seconds": time.time() - start}
+
+
+# Entries of one shard, read chunk by chunk until the None that ends them
+def read_entries(file):
+    while True:
+        chunk = pickle.load(file)
+        if chunk is None:
+            return
+        yield from chunk
+
+
+# Restore the caches found in the snapshot, returns what was loaded. Caches whose settings changed since the
+# snapshot (policy, capacity, byte budget or number of shards) are skipped and start cold.
+def load_snapshot(path, caches):
+    start = time.time()
+    loaded, skipped = [], []
+    with gc_paused(), open(path, "rb") as file:
+        header = pickle.load(file)
+        if header.get("version") != SNAPSHOT_VERSION:
+            return {"loaded": loaded, "skipped": ["all (unknown version)"], "seconds": 0}
+        elapsed = max(0.0, start - header["saved_at"])  # time the entries' ttls kept running while we were down
+        while True:
+            section = pickle.load(file)
+            if section is None:
+                break
+            cache = caches.get(section["cache"])
+            compatible = cache is not None and cache.accepts_state(section["metas"])  # every shard or none is loaded
+            for index, meta in enumerate(section["metas"]):
+                entries = read_entries(file)
+                if compatible:
+                    cache.load_shard_state(index, meta, entries, elapsed)
+                for _ in entries:  # skip the rest of the entries when they were not loaded
+                    pass
+            (loaded if compatible else skipped).append(section["cache"])
+    return {"loaded": loaded, "skipped": skipped, "seconds": time.time() - start}
+
+
+# Background thread that saves a snapshot every interval seconds
+class SnapshotSaver(threading.Thread):
+    def __init__(self, path, caches, interval=60.0, on_error=None):
+        super().__init__(name="snapshot-saver", daemon=True)
+        self.path = path
+        self.caches = caches
+        self.interval = interval
+        self.on_error = on_error  # called with the exception of a failed save, the thread keeps going
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                save_snapshot(self.path, self.caches)
+            except Exception as error:
+                if self.on_error is not None:
+                    self.on_error(error)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,330 @@
+from collections import OrderedDict
+from algorithms.expiry import ExpiryTracker, STALE, EXPIRED
+from algorithms.sizing import json_size
+from algorithms.snapshot import dump_counters, load_counters
+from log import setup_log
+
+tinylfu_logger = setup_log("tinylfu_cache")
+
+SKETCH_WIDTH_FACTOR = 8  # counters per row per cached item: fewer collisions between the keys competing for the cache
+MIX = 0x9E3779B97F4A7C15  # odd multiplier that spreads hash() (the identity for small ints) over all 64 bits
+MAX_COUNT = 15  # counters saturate like 4 bit counters, old popularity is forgotten by halving anyway
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+HALVE = bytes(count >> 1 for count in range(256))  # translation table, halves every counter in one C level pass
+WINDOW_GHOSTS = 0.1  # keys remembered after the main area refused them, as a fraction of the capacity
+MAIN_GHOSTS = 0.25  # keys remembered after they were evicted from the main area, as a fraction of the capacity
+
+
+# Approximate access frequency of every key seen recently (including keys that are no longer cached)
+# in a fixed amount of memory: 4 rows of one byte counters, a key's estimate is its smallest counter.
+# A key's position in each row comes from one mixed hash (double hashing: a + row * b), so an access costs one
+# multiplication, and the 4 rows are written out instead of looped over since this runs on every access.
+# In front of the counters sits a doorkeeper, one bit per position: the first access of a key only sets its bit, so
+# the many keys seen once never reach (and never pollute) the counters. The estimate is counters + bit.
+class CountMinSketch:
+    def __init__(self, width: int, sample_size: int):
+        bits = max(1, (width - 1).bit_length())  # round the width up to a power of two
+        self.width = 1 << bits
+        self.mask = self.width - 1
+        self.shift = 64 - bits
+        self.table = bytearray(4 * self.width)
+        self.doorkeeper = bytearray(self.width)  # a byte per bit: cheaper to test and set than packed bits
+        self.additions = 0
+        self.sample_size = sample_size  # after this many increments all counters are halved (aging)
+
+    def increment(self, key):
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+        h = (hash(key) * MIX) & MASK_64
+        a = h >> self.shift
+        doorkeeper = self.doorkeeper
+        if not doorkeeper[a]:  # first access since the last reset
+            doorkeeper[a] = 1
+            return
+        b, mask, width, table = (h >> 17) | 1, self.mask, self.width, self.table
+        for index in (a, width + ((a + b) & mask), 2 * width + ((a + 2 * b) & mask), 3 * width + ((a + 3 * b) & mask)):
+            if table[index] < MAX_COUNT:
+                table[index] += 1
+
+    def estimate(self, key):
+        h = (hash(key) * MIX) & MASK_64
+        a, b, mask, width, table = h >> self.shift, (h >> 17) | 1, self.mask, self.width, self.table
+        return min(table[a], table[width + ((a + b) & mask)], table[2 * width + ((a + 2 * b) & mask)],
+                   table[3 * width + ((a + 3 * b) & mask)]) + self.doorkeeper[a]
+
+    # Halve every counter so the sketch follows changes in popularity, O(width) but only every sample_size accesses.
+    # The doorkeeper starts over empty.
+    def reset(self):
+        self.table = bytearray(self.table.translate(HALVE))
+        self.doorkeeper = bytearray(self.width)
+        self.additions //= 2
+
+
+# W-TinyLFU: a small LRU window in front of a segmented LRU (probation + protected) main area.
+# Items leaving the window only get into the main area if the sketch says they are accessed more often
+# than the item the main area would evict for them.
+# The window size adapts (climbs towards what would have hit, like ARC's target size): the keys recently dropped
+# from each area are remembered without their values, a miss on a key the main area refused means a larger window
+# would have kept it (the window grows by one), a miss on a key evicted from the main area means a larger main area
+# would have (the window shrinks by one). Recency heavy workloads end up with a large window (close to LRU),
+# frequency heavy ones with a small window (close to LFU).
+class TinyLFUCache:
+    policy = "TinyLFU"  # snapshot format
+    on_evict = None  # callback(key, value, remaining ttl, own ttl) for entries evicted or not admitted
+
+    def __init__(self, capacity: int, log_events: bool = True, default_ttl: float = None, stale_ttl: float = 0,
+                 max_bytes: int = None, sizer=json_size, window_ratio: float = 0.01, protected_ratio: float = 0.8,
+                 adaptive: bool = True):
+        self.capacity = capacity
+        self.log_events = log_events  # set to False to skip all logging (e.g. offline trace replay)
+        self.protected_ratio = protected_ratio
+        self.window = OrderedDict()  # new items, plain LRU
+        self.probation = OrderedDict()  # main area items accessed once since they were admitted
+        self.protected = OrderedDict()  # main area items accessed again while on probation
+        self.resize_window(max(1, int(capacity * window_ratio)))
+        self.sketch = CountMinSketch(width=SKETCH_WIDTH_FACTOR * capacity, sample_size=10 * capacity)
+        self.expiry = ExpiryTracker(default_ttl, stale_ttl)  # expiry times of entries with a ttl
+        self.max_bytes = max_bytes  # optional memory budget on top of the item count, None = count only
+        self.sizer = sizer  # value -> weight in bytes, only used with max_bytes
+        self.weights = {}  # key -> weight of its value, only with max_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.accesses = 0
+        self.evictions = 0  # entries removed to make room (including candidates refused by the main area)
+        self.expirations = 0  # entries removed because their ttl ran out
+        self.adaptive = adaptive and capacity > 1  # False = the window keeps window_ratio of the capacity
+        self.window_ghosts = OrderedDict()  # keys the main area refused, oldest first
+        self.main_ghosts = OrderedDict()  # keys evicted from the main area, oldest first
+        self.ghost_limits = {"window": max(1, int(capacity * WINDOW_GHOSTS)), "main": max(1, int(capacity * MAIN_GHOSTS))}
+
+    def log_event(self, event_type, key, extra=None):
+        if not self.log_events:
+            return
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "cache_size": len(self.window) + len(self.probation) + len(self.protected),
+            "capacity": self.capacity
+        }
+        if extra:  # if extra is not None, extra is a dictionary for any additional stuff we might want to log
+            log_entry.update(extra)
+        tinylfu_logger.info(log_entry)
+
+    def get(self, key: int):
+        self.accesses += 1
+        self.sketch.increment(key)  # every access counts towards the frequency, hit or miss
+        if key in self.expiry.deadlines:  # only entries with a ttl need checking
+            state = self.expiry.state(key)
+            if state == EXPIRED:
+                self.remove(key)
+                self.expirations += 1
+            elif state == STALE:
+                self.expiry.refresh(key)  # served below, refreshed in the background
+        if key in self.window:
+            self.hits += 1
+            self.window.move_to_end(key)
+            return self.window[key]
+        elif key in self.probation:  # second access in the main area, promote to protected
+            self.hits += 1
+            value = self.probation.pop(key)
+            self.protected[key] = value
+            if len(self.protected) > self.protected_capacity:  # protected is full, demote its LRU item back to probation
+                demoted_key, demoted_value = self.protected.popitem(last=False)
+                self.probation[demoted_key] = demoted_value
+            return value
+        elif key in self.protected:
+            self.hits += 1
+            self.protected.move_to_end(key)
+            return self.protected[key]
+        else:
+            self.misses += 1
+            if self.adaptive:
+                self.climb(key)
+            return "Not Found"
+
+    def put(self, key: int, value: any, ttl: float = None):
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if weight > self.max_bytes:  # could never fit, don't cache it (and drop the old value)
+                self.remove(key)
+                return
+
+        self.insert(key, value)
+        self.expiry.set(key, ttl)  # ttl overrides the default ttl for this entry
+
+        if self.max_bytes is not None:
+            self.resident_bytes += weight - self.weights.get(key, 0)
+            self.weights[key] = weight
+            while self.resident_bytes > self.max_bytes:
+                self.shrink(keep=key)
+
+    # Swap in the refreshed value of a stale entry and start its ttl over. It stays where it is in its segment and
+    # the sketch is not incremented. False if the key left the cache meanwhile or the value outgrew the budget.
+    def refresh(self, key, value):
+        segment = next((segment for segment in (self.window, self.probation, self.protected) if key in segment), None)
+        if segment is None:
+            return False
+        if self.max_bytes is not None:
+            weight = self.sizer(value)
+            if self.resident_bytes - self.weights[key] + weight > self.max_bytes:
+                self.remove(key)
+                return False
+            self.resident_bytes += weight - self.weights[key]
+            self.weights[key] = weight
+        segment[key] = value
+        self.expiry.renew(key)
+        return True
+
+    # Missed key: if one of the areas dropped it recently, move the boundary by one so that area would have kept it
+    def climb(self, key):
+        if key in self.window_ghosts:
+            del self.window_ghosts[key]
+            if self.window_capacity < self.capacity - 1:
+                self.resize_window(self.window_capacity + 1)
+        elif key in self.main_ghosts:
+            del self.main_ghosts[key]
+            if self.window_capacity > 1:
+                self.resize_window(self.window_capacity - 1)
+
+    # Move the window/main boundary. Items cross it without an admission contest: the window's LRU items join
+    # probation when it shrinks, the main area's LRU items join the window when it grows.
+    def resize_window(self, window_capacity):
+        self.window_capacity = window_capacity
+        self.main_capacity = self.capacity - window_capacity
+        self.protected_capacity = int(self.main_capacity * self.protected_ratio)
+        while len(self.window) > self.window_capacity:
+            key, value = self.window.popitem(last=False)
+            self.probation[key] = value
+        while self.probation and len(self.probation) + len(self.protected) > self.main_capacity:
+            key, value = self.probation.popitem(last=False)
+            self.window[key] = value
+        while len(self.protected) > self.protected_capacity:
+            key, value = self.protected.popitem(last=False)
+            if len(self.probation) + len(self.protected) >= self.main_capacity:  # main area still full, to the window
+                self.window[key] = value
+            else:
+                self.probation[key] = value
+
+    def insert(self, key, value):
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:  # update in place, keep the item in its segment
+                segment[key] = value
+                segment.move_to_end(key)
+                return
+
+        self.window[key] = value
+        if len(self.window) > self.window_capacity:  # the window's LRU item is a candidate for the main area
+            candidate_key, candidate_value = self.window.popitem(last=False)
+            self.admit(candidate_key, candidate_value)
+
+    # Evict for the byte budget: main area victims first (probation, then protected), then the window's LRU item.
+    # keep is the item just put, it fits on its own so another item is always left.
+    def shrink(self, keep):
+        for segment, area in ((self.probation, "main"), (self.protected, "main"), (self.window, "window")):
+            for candidate in segment:
+                if candidate != keep:
+                    self.evict(candidate, area, segment.pop(candidate))
+                    return
+
+    def admit(self, candidate_key, candidate_value):
+        if len(self.probation) + len(self.protected) < self.main_capacity:  # main area has room, no contest
+            self.probation[candidate_key] = candidate_value
+            return
+        if self.main_capacity == 0:  # capacity is too small for a main area, the window is the whole cache
+            self.evict(candidate_key, "window", candidate_value)
+            return
+
+        victim_segment = self.probation if self.probation else self.protected
+        victim_key = next(iter(victim_segment))  # LRU item of the main area
+        if self.sketch.estimate(candidate_key) > self.sketch.estimate(victim_key):
+            self.evict(victim_key, "main", victim_segment.pop(victim_key))
+            self.probation[candidate_key] = candidate_value
+        else:  # the candidate is not more popular than the victim, drop the candidate
+            self.evict(candidate_key, "window", candidate_value)
+
+    def evict(self, key, area, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value, self.expiry.remaining(key), self.expiry.ttls.get(key))
+        if self.adaptive:
+            ghosts = self.window_ghosts if area == "window" else self.main_ghosts
+            ghosts[key] = None
+            if len(ghosts) > self.ghost_limits[area]:
+                ghosts.popitem(last=False)
+        self.forget(key)
+        self.evictions += 1
+        self.log_event("evict", key, {"area": area})
+
+    def remove(self, key):
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:
+                del segment[key]
+                break
+        self.forget(key)
+
+    # Drop the bookkeeping of a key that left the cache
+    def forget(self, key):
+        self.expiry.discard(key)
+        if self.weights:
+            self.resident_bytes -= self.weights.pop(key, 0)
+
+    # Remove up to limit entries whose ttl (and stale window) ran out, returns how many were removed
+    def expire(self, limit: int = 100):
+        keys = self.expiry.due(limit)
+        for key in keys:
+            self.remove(key)
+        self.expirations += len(keys)
+        return len(keys)
+
+    # Full state for a snapshot: settings and counters, then (segment, key, value, remaining ttl) for the window,
+    # probation and protected segments, each from least to most recently used. The sketch is not saved, its
+    # counters depend on hash() which is salted per process, so it relearns the frequencies after a restart.
+    def dump_state(self):
+        meta = {"policy": self.policy, "capacity": self.capacity, "max_bytes": self.max_bytes, "counters": dump_counters(self),
+                "window_capacity": self.window_capacity}
+        remaining = self.expiry.remaining
+        return meta, [(name, key, value, remaining(key)) for name, segment in
+                      (("window", self.window), ("probation", self.probation), ("protected", self.protected))
+                      for key, value in segment.items()]
+
+    # Restore a dump_state() into this empty cache, entries whose ttl ran out while we were down are left out
+    def load_state(self, meta, entries, elapsed=0):
+        load_counters(self, meta["counters"])
+        if "window_capacity" in meta:  # snapshots from before the window adapted don't have it
+            self.resize_window(meta["window_capacity"])
+        segments = {"window": self.window, "probation": self.probation, "protected": self.protected}
+        for name, key, value, remaining in entries:
+            if self.expiry.restore(key, remaining, elapsed):
+                segments[name][key] = value
+                if self.max_bytes is not None:
+                    self.weights[key] = self.sizer(value)
+                    self.resident_bytes += self.weights[key]
+
+    # Is key in any segment? No sketch increment, so asking does not make a key look popular
+    def contains(self, key):
+        return key in self.window or key in self.probation or key in self.protected
+
+    def calculate_statistics(self):
+        hit_ratio = self.hits / self.accesses if self.accesses > 0 else 0
+        miss_ratio = self.misses / self.accesses if self.accesses > 0 else 0
+        cache_size = len(self.window) + len(self.probation) + len(self.protected)
+        return {"hit_ratio": hit_ratio, "miss_ratio": miss_ratio, "cache_size": cache_size,
+                "evictions": self.evictions, "expirations": self.expirations, "resident_bytes": self.resident_bytes,
+                "window_size": len(self.window), "window_capacity": self.window_capacity, "probation_size": len(self.probation), "protected_size": len(self.protected)}
+
+    def log_metrics(self, event_type, key, latency, extra=None):
+        if not self.log_events:
+            return
+        hit_rate = self.hits / self.accesses if self.accesses > 0 else 0
+        log_entry = {
+            "event_type": event_type,
+            "key": key,
+            "latency": latency,
+            "hit_rate": hit_rate,
+            "cache_size": len(self.window) + len(self.probation) + len(self.protected),
+            "capacity": self.capacity
+        }
+        if extra:  # e.g. the hit/miss counts of a batch request
+            log_entry.update(extra)
+        tinylfu_logger.info(log_entry)  # log metrics
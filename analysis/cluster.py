@@ -0,0 +1,215 @@
+import argparse
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import tempfile
+from analysis.simulator import POLICIES, read_trace
+import routing
+from routing import HashRing
+
+# In-process cluster: replays a key trace through several "replicas" (one cache each, like the fastapi1/2/3
+# containers) and compares round robin routing (what nginx.conf does) with consistent hashing on the key
+# (nginx-hash.conf or ROUTING_MODE=forward). Run from the project root:
+#   python -m analysis.cluster --nodes 1,2,3,4,6 --capacity 50
+#   python -m analysis.cluster logs/fastapi1/lru_cache.log --policy ARC
+# With --app the replicas are instances of the app itself (main.py loaded once per node with its NODE_NAME,
+# CLUSTER_NODES and ROUTING_MODE, requests through a TestClient each), so the requests go through the routing
+# middleware: round robin over the nodes with ROUTING_MODE off, forward and redirect. Slower, use a shorter trace:
+#   python -m analysis.cluster --app --nodes 1,2,3,4 --capacity 50 --accesses 5000
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+APP_POLICIES = {"LRU": "lru", "LFU": "lfu", "ARC": "arc", "TinyLFU": "tinylfu"}  # policy -> path of its endpoints
+APP_MODES = ("off", "forward", "redirect")
+
+
+# Zipf-like trace over num_keys keys, the usual shape of cache traffic when no real trace is given
+def zipf_trace(num_keys, accesses, skew, seed=0):
+    rng = random.Random(seed)
+    keys = [str(key) for key in range(1, num_keys + 1)]
+    weights = [1 / rank ** skew for rank in range(1, num_keys + 1)]
+    return rng.choices(keys, weights, k=accesses)
+
+
+# Replay the trace on num_nodes caches of the given capacity, returns the aggregate hit ratio
+def replay_cluster(cache_class, num_nodes, capacity, trace, routing):
+    nodes = [f"node{i}" for i in range(1, num_nodes + 1)]
+    caches = {node: cache_class(capacity=capacity, log_events=False) for node in nodes}
+    ring = HashRing(nodes)
+    owners = {}  # key -> owner, the ring lookup is the same for every access of a key
+    hits = 0
+    for i, key in enumerate(trace):
+        if routing == "hash":
+            node = owners.get(key)
+            if node is None:
+                node = owners[key] = ring.owner(key)
+        else:  # round robin
+            node = nodes[i % num_nodes]
+        cache = caches[node]
+        if cache.get(key) == "Not Found":
+            cache.put(key, key)
+        else:
+            hits += 1
+    return hits / len(trace)
+
+
+# Share of the distinct keys that change owner when one more node joins the ring (ideally 1 / (nodes + 1))
+def remapped_fraction(keys, num_nodes):
+    before = HashRing([f"node{i}" for i in range(1, num_nodes + 1)])
+    after = HashRing([f"node{i}" for i in range(1, num_nodes + 2)])
+    moved = sum(before.owner(key) != after.owner(key) for key in keys)
+    return moved / len(keys)
+
+
+# Stands in for the requests.Session of Router.forward: sends a forwarded request to the TestClient of its node
+class InProcessSession:
+    def __init__(self, clients):
+        self.clients = clients  # base url -> TestClient
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        base_url = next(base_url for base_url in self.clients if url.startswith(base_url + "/"))
+        return self.clients[base_url].request(method, url[len(base_url):], headers=headers, content=data)
+
+
+# A fresh instance of the app (its own caches and router) for node, routing.py reads its settings at import
+def load_node(node, cluster_nodes, mode, capacity, data_path):
+    os.environ.update({"NODE_NAME": node, "CLUSTER_NODES": cluster_nodes, "ROUTING_MODE": mode,
+                       "CACHE_CAPACITY": str(capacity), "DATA_PATH": data_path})
+    importlib.reload(routing)
+    spec = importlib.util.spec_from_file_location(f"cluster_{node}", MAIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Replay the trace round robin over num_nodes app instances in one routing mode, returns the aggregate hit ratio of
+# the nodes' caches and the router counters summed over the nodes
+def replay_app_cluster(policy, num_nodes, capacity, trace, mode, data_path):
+    from fastapi.testclient import TestClient  # only needed with --app
+
+    nodes = [f"node{i}" for i in range(1, num_nodes + 1)]
+    base_urls = {node: f"http://{node}" for node in nodes}
+    cluster_nodes = ",".join(f"{node}={url}" for node, url in base_urls.items())
+    environ = dict(os.environ)
+    try:
+        apps = {node: load_node(node, cluster_nodes, mode, capacity, data_path) for node in nodes}
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        importlib.reload(routing)
+    clients = {base_urls[node]: TestClient(app.app) for node, app in apps.items()}
+    for app in apps.values():
+        if app.router.session is not None:
+            app.router.session = InProcessSession(clients)
+
+    entry_points = list(clients.values())
+    path = APP_POLICIES[policy]
+    for i, key in enumerate(trace):
+        response = entry_points[i % num_nodes].get(f"/{path}/{key}", follow_redirects=False)
+        if response.status_code == 307:  # redirect mode, the client asks the owner itself
+            location = response.headers["location"]
+            base_url = next(base_url for base_url in clients if location.startswith(base_url + "/"))
+            response = clients[base_url].get(location[len(base_url):])
+        if response.status_code != 200:
+            raise RuntimeError(f"GET /{path}/{key} answered {response.status_code}")
+
+    hits = accesses = 0
+    counters = {"local": 0, "forwarded": 0, "redirected": 0, "errors": 0}
+    for app in apps.values():
+        cache = getattr(app, f"{path}_cache")
+        hits += sum(shard.hits for shard in cache.shards)
+        accesses += sum(shard.accesses for shard in cache.shards)
+        for name in counters:
+            counters[name] += getattr(app.router, name)
+    return {"hit_ratio": hits / accesses if accesses > 0 else 0, **counters}
+
+
+def run_app(trace, node_counts, capacity, policy):
+    # the origin of the nodes: one item per key of the trace
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+        json.dump({key: {"name": f"Product {key}", "description": "", "price": 10} for key in set(trace)}, file)
+    logging.disable(logging.INFO)  # every node would log every request to the same files under logs/
+    try:
+        return [{"nodes": num_nodes, "mode": mode, **replay_app_cluster(policy, num_nodes, capacity, trace, mode, file.name)}
+                for num_nodes in node_counts for mode in APP_MODES]
+    finally:
+        logging.disable(logging.NOTSET)
+        os.unlink(file.name)
+
+
+def run(trace, node_counts, capacity, policy):
+    cache_class = POLICIES[policy]
+    keys = set(trace)
+    results = []
+    for num_nodes in node_counts:
+        results.append({
+            "nodes": num_nodes,
+            "round_robin_hit_ratio": replay_cluster(cache_class, num_nodes, capacity, trace, "round_robin"),
+            "hash_hit_ratio": replay_cluster(cache_class, num_nodes, capacity, trace, "hash"),
+            "remapped_on_add": remapped_fraction(keys, num_nodes),
+        })
+    return results
+
+
+def print_results(results, policy, capacity, accesses):
+    print(f"{policy}, capacity {capacity} per node, {accesses} accesses")
+    print(f"{'nodes':>6}{'round robin':>14}{'hash':>10}{'moved on +1':>14}")
+    for row in results:
+        print(f"{row['nodes']:>6}{row['round_robin_hit_ratio']:>14.4f}{row['hash_hit_ratio']:>10.4f}"
+              f"{row['remapped_on_add']:>14.3f}")
+
+
+def print_app_results(results, policy, capacity, accesses):
+    print(f"{policy} app nodes, capacity {capacity} per node, {accesses} requests round robin over the nodes")
+    print(f"{'nodes':>6}{'routing':>10}{'hit ratio':>11}{'local':>9}{'forwarded':>11}{'redirected':>12}{'errors':>8}")
+    for row in results:
+        print(f"{row['nodes']:>6}{row['mode']:>10}{row['hit_ratio']:>11.4f}{row['local']:>9}{row['forwarded']:>11}"
+              f"{row['redirected']:>12}{row['errors']:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare round robin and consistent hash routing across cache replicas")
+    parser.add_argument("trace", nargs='*', help="trace files like the simulator takes, a zipf trace is generated if none")
+    parser.add_argument("--nodes", default="1,2,3,4,6,8", help="comma separated node counts")
+    parser.add_argument("--capacity", type=int, default=100, help="capacity of each node's cache")
+    parser.add_argument("--policy", default="LRU", help="cache policy of the nodes")
+    parser.add_argument("--keys", type=int, default=2000, help="distinct keys of the generated trace")
+    parser.add_argument("--accesses", type=int, default=200000, help="length of the generated trace")
+    parser.add_argument("--skew", type=float, default=0.9, help="zipf exponent of the generated trace")
+    parser.add_argument("--app", action="store_true",
+                        help="run app instances with ROUTING_MODE off, forward and redirect instead of bare caches")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    names = {name.upper(): name for name in POLICIES}
+    if args.policy.upper() not in names:
+        parser.error(f"unknown policy: {args.policy}")
+    policy = names[args.policy.upper()]
+    if args.app and policy not in APP_POLICIES:
+        parser.error(f"the app has no endpoints for {policy}, use one of {', '.join(APP_POLICIES)}")
+
+    trace = []
+    for path in args.trace:
+        trace.extend(read_trace(path))
+    if args.trace and not trace:
+        parser.error("no keys found in the trace")
+    if not trace:
+        trace = zipf_trace(args.keys, args.accesses, args.skew)
+
+    node_counts = [int(count) for count in args.nodes.split(',')]
+    if args.app:
+        results = run_app(trace, node_counts, args.capacity, policy)
+        print_app_results(results, policy, args.capacity, len(trace))
+    else:
+        results = run(trace, node_counts, args.capacity, policy)
+        print_results(results, policy, args.capacity, len(trace))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"policy": policy, "capacity": args.capacity, "accesses": len(trace), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,232 @@
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
+import argparse
+import io
 import json
-import requests
+import os
+from itertools import islice
 from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Streaming analysis of the per-cache logs of a load test. Every log file is read in chunks of lines and each
+# chunk is reduced to per second aggregates (a latency histogram, hits, misses, latency sum), so memory does not
+# grow with the length of the test. The aggregates and the byte offset read so far are cached in an .npz file
+# per node and policy, a re-run only reads what was appended since. Run from the project root:
+#   python -m analysis.script                    # summary table of logs/fastapi*/ and logs/
+#   python -m analysis.script --plot             # latency and hit rate over time
+#   python -m analysis.script --stats-url http://localhost/stats
+
+POLICIES = ("lru", "lfu", "arc", "tinylfu")
+LATENCY_EDGES = np.logspace(-6, 1, 29)  # bucket upper bounds, 1 µs to 10 s with 4 buckets per decade (+1 overflow bucket)
+BUCKETS = len(LATENCY_EDGES) + 1
+CHUNK_LINES = 200000
+CACHE_VERSION = 1
+METRIC_EVENTS = ["hit", "miss", "batch_get"]  # log_metrics records, one per request (or per batch)
+SERIES_FIELDS = ("seconds", "histogram", "hits", "misses", "latency_sum")
+
+
+# Log files of the cache policies: logs/<node>/<policy>_cache.log (the fastapi1/2/3 volumes) and logs/<policy>_cache.log
+def find_logs(log_folder):
+    logs = []
+    for policy in POLICIES:
+        for path in sorted(log_folder.glob(f"*/{policy}_cache.log")):
+            logs.append((path.parent.name, policy, path))
+        path = log_folder / f"{policy}_cache.log"
+        if path.exists():
+            logs.append(("local", policy, path))
+    return logs
+
+
+def empty_series():
+    return {"seconds": np.zeros(0, dtype=np.int64), "histogram": np.zeros((0, BUCKETS), dtype=np.int64),
+            "hits": np.zeros(0), "misses": np.zeros(0), "latency_sum": np.zeros(0)}
+
+
+# Parse a chunk of raw lines, only JSON lines count (plain text lines like the app log format are skipped)
+def parse_chunk(lines):
+    json_lines = [line for line in lines if line.startswith("{")]
+    if not json_lines:
+        return None
+    try:  # one vectorized parse for the whole chunk
+        return pd.read_json(io.StringIO("\n".join(json_lines)), lines=True, dtype=False, convert_dates=False)
+    except ValueError:  # a truncated or broken line, fall back to parsing line by line and skip the bad ones
+        records = []
+        for line in json_lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return pd.DataFrame(records) if records else None
+
+
+# Per second aggregates of the metric records of a chunk. Aggregated records (LOG_AGGREGATE=1) count `count`
+# times at their mean latency, batch records count their hits and misses.
+def aggregate_chunk(df):
+    if df is None or "latency" not in df.columns or "timestamp" not in df.columns:
+        return empty_series()
+    df = df[df["event_type"].isin(METRIC_EVENTS) & df["latency"].notna()]
+    if df.empty:
+        return empty_series()
+
+    seconds = pd.to_datetime(df["timestamp"], format="ISO8601").to_numpy().astype("datetime64[s]").astype(np.int64)
+    latency = df["latency"].to_numpy(dtype=float)
+    count = df["count"].fillna(1).to_numpy(dtype=float) if "count" in df.columns else np.ones(len(df))
+    event = df["event_type"].to_numpy()
+    hits = np.where(event == "hit", count, 0.0)
+    misses = np.where(event == "miss", count, 0.0)
+    if "hits" in df.columns:  # batch_get records
+        batch = event == "batch_get"
+        hits[batch] = df["hits"].to_numpy(dtype=float)[batch]
+        misses[batch] = df["misses"].to_numpy(dtype=float)[batch]
+
+    unique_seconds, index = np.unique(seconds, return_inverse=True)
+    histogram = np.zeros((len(unique_seconds), BUCKETS), dtype=np.int64)
+    np.add.at(histogram, (index, np.searchsorted(LATENCY_EDGES, latency)), count.astype(np.int64))
+    return {"seconds": unique_seconds, "histogram": histogram,
+            "hits": np.bincount(index, weights=hits, minlength=len(unique_seconds)),
+            "misses": np.bincount(index, weights=misses, minlength=len(unique_seconds)),
+            "latency_sum": np.bincount(index, weights=latency * count, minlength=len(unique_seconds))}
+
+
+# Add two per second series (a second present in both, e.g. at a chunk boundary, is summed)
+def merge_series(a, b):
+    if len(a["seconds"]) == 0:
+        return b
+    if len(b["seconds"]) == 0:
+        return a
+    seconds = np.union1d(a["seconds"], b["seconds"])
+    merged = {"seconds": seconds}
+    for name in SERIES_FIELDS[1:]:
+        shape = (len(seconds),) + a[name].shape[1:]
+        values = np.zeros(shape, dtype=a[name].dtype)
+        np.add.at(values, np.searchsorted(seconds, a["seconds"]), a[name])
+        np.add.at(values, np.searchsorted(seconds, b["seconds"]), b[name])
+        merged[name] = values
+    return merged
+
+
+# Whole lines from offset on, CHUNK_LINES at a time, with the offset after each chunk. A last line without a
+# newline is still being written and is left for the next run.
+def read_chunks(path, offset):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while True:
+            lines = list(islice(file, CHUNK_LINES))
+            if not lines:
+                return
+            if not lines[-1].endswith(b"\n"):
+                lines.pop()
+            if not lines:
+                return
+            offset += sum(len(line) for line in lines)
+            yield [line.decode("utf-8", errors="replace").rstrip("\n") for line in lines], offset
 
-# Path to logs folder
-log_folder = Path('../logs')
-
-# Read JSON logs into pandas DataFrame
-def read_logs(log_pattern):
-    all_logs = pd.DataFrame()
-    for log_file in log_folder.glob(log_pattern):
-        with open(log_file, 'r') as file:
-            data = [json.loads(line) for line in file]
-            df = pd.DataFrame(data)
-            # Only convert 'latency' to numeric if it exists in the DataFrame
-            if 'latency' in df.columns:
-                df['latency'] = pd.to_numeric(df['latency'], errors='coerce')
-            all_logs = pd.concat([all_logs, df], ignore_index=True)
-    return all_logs
-
-# get all the logs
-lru_logs = read_logs('fastapi*/lru_cache.log')
-lfu_logs = read_logs('fastapi*/lfu_cache.log')
-arc_logs = read_logs('fastapi*/arc_cache.log')
-
-# Example plot: Cache hit rates over time
-def plot_latency(logs, title):
-    if 'latency' in logs.columns:
-        logs['timestamp'] = pd.to_datetime(logs['timestamp'])
-        logs.set_index('timestamp', inplace=True)
-        latency_series = logs['latency'].resample('s').mean()
-        latency_series.plot(title=title)
-        plt.ylabel('Latency (s)')
-        plt.xlabel('Time')
-        plt.show()
 
-plot_latency(lru_logs, 'LRU Cache Latency')
-plot_latency(lfu_logs, 'LFU Cache Latency')
-plot_latency(arc_logs, 'ARC Cache Latency')
+def cache_path(cache_folder, node, policy):
+    return cache_folder / f"{node}-{policy}.npz"
+
+
+# Cached aggregates of a log file, or empty ones (offset 0) if there are none or the file was rotated/truncated
+def load_cached(path, log_stat):
+    if not path.exists():
+        return empty_series(), 0
+    with np.load(path) as cached:
+        offset = int(cached["offset"])
+        if int(cached["version"]) != CACHE_VERSION or int(cached["inode"]) != log_stat.st_ino or log_stat.st_size < offset:
+            return empty_series(), 0
+        return {name: cached[name] for name in SERIES_FIELDS}, offset
+
+
+# Per second aggregates of one log file, reading only the part not in the cache yet
+def read_logs(node, policy, log_path, cache_folder):
+    log_stat = os.stat(log_path)
+    path = cache_path(cache_folder, node, policy)
+    series, offset = load_cached(path, log_stat)
+    start_offset = offset
+    for lines, offset in read_chunks(log_path, offset):
+        series = merge_series(series, aggregate_chunk(parse_chunk(lines)))
+    if offset != start_offset or not path.exists():
+        cache_folder.mkdir(parents=True, exist_ok=True)
+        np.savez(path, offset=offset, inode=log_stat.st_ino, version=CACHE_VERSION, **series)
+    return series
+
+
+# Latency at quantile q of every row of a histogram (upper bound of the bucket it falls in)
+def histogram_quantile(histogram, q):
+    histogram = np.atleast_2d(histogram)
+    totals = histogram.sum(axis=1)
+    cumulative = histogram.cumsum(axis=1)
+    buckets = (cumulative >= np.maximum(totals, 1)[:, None] * q).argmax(axis=1)
+    upper = np.append(LATENCY_EDGES, LATENCY_EDGES[-1])  # the overflow bucket is reported at the last edge
+    return np.where(totals > 0, upper[buckets], np.nan)
+
+
+def summarize(results):
+    rows = []
+    for (node, policy), series in results.items():
+        requests = series["histogram"].sum()
+        accesses = series["hits"].sum() + series["misses"].sum()
+        total = series["histogram"].sum(axis=0)
+        rows.append({
+            "node": node,
+            "policy": policy,
+            "seconds": len(series["seconds"]),
+            "requests": int(requests),
+            "hit_rate": series["hits"].sum() / accesses if accesses else np.nan,
+            "mean_latency": series["latency_sum"].sum() / requests if requests else np.nan,
+            "p50": histogram_quantile(total, 0.5)[0],
+            "p95": histogram_quantile(total, 0.95)[0],
+            "p99": histogram_quantile(total, 0.99)[0],
+        })
+    return pd.DataFrame(rows)
+
+
+# Latency (mean and p99) and hit rate per second, one figure per policy with a line per node
+def plot_latency(results, save_folder=None):
+    import matplotlib.pyplot as plt  # only needed for plotting
+
+    for policy in POLICIES:
+        nodes = {node: series for (node, name), series in results.items() if name == policy and len(series["seconds"])}
+        if not nodes:
+            continue
+        fig, (latency_ax, hit_ax) = plt.subplots(2, 1, figsize=(10, 7), sharex=True)
+        for node, series in nodes.items():
+            times = pd.to_datetime(series["seconds"], unit="s")
+            requests = series["histogram"].sum(axis=1)
+            accesses = series["hits"] + series["misses"]
+            latency_ax.plot(times, series["latency_sum"] / np.maximum(requests, 1), label=f"{node} mean")
+            latency_ax.plot(times, histogram_quantile(series["histogram"], 0.99), linestyle="--", label=f"{node} p99")
+            hit_ax.plot(times, np.divide(series["hits"], accesses, out=np.full(len(accesses), np.nan), where=accesses > 0),
+                        label=node)
+        latency_ax.set_yscale("log")
+        latency_ax.set_ylabel("Latency (s)")
+        latency_ax.set_title(f"{policy.upper()} Cache Latency")
+        latency_ax.legend()
+        hit_ax.set_ylabel("Hit Rate")
+        hit_ax.set_xlabel("Time")
+        hit_ax.legend()
+        plt.tight_layout()
+        if save_folder:
+            fig.savefig(Path(save_folder) / f"{policy}_latency.png")
+            plt.close(fig)
+        else:
+            plt.show()
 
 
 # Function to fetch stats from the /stats endpoint
-def fetch_stats():
-    response = requests.get('http://localhost/stats')  # http://127.0.0.1:8000/stats when running locally, http://localhost/stats when running in Docker
+def fetch_stats(url):
+    import requests  # only needed for --stats-url
+
+    response = requests.get(url)  # http://127.0.0.1:8000/stats when running locally, http://localhost/stats when running in Docker
     stats = response.json()
     print("Cache Stats:", stats)
     return stats
 
 
-# Fetch and print stats
-stats = fetch_stats()
-
-
 # graph all the stats
-def plot_stats(stats):
-    algorithms = ['LRU', 'LFU', 'ARC']
+def plot_stats(stats, save_folder=None):
+    import matplotlib.pyplot as plt
+
+    algorithms = [algo for algo in ('LRU', 'LFU', 'ARC', 'TinyLFU') if algo in stats]
     hit_ratios = [stats[algo]['hit_ratio'] for algo in algorithms]
     miss_ratios = [stats[algo]['miss_ratio'] for algo in algorithms]
 
@@ -77,7 +247,44 @@ def plot_stats(stats):
     ax.legend()
 
     plt.tight_layout()
-    plt.show()
+    if save_folder:
+        fig.savefig(Path(save_folder) / "stats.png")
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per second latency and hit rate of the cache logs")
+    parser.add_argument("--logs", default="logs", help="logs folder (with fastapi1/2/3 sub folders)")
+    parser.add_argument("--cache", help="folder for the cached aggregates, defaults to <logs>/.analysis")
+    parser.add_argument("--rebuild", action="store_true", help="ignore the cached aggregates and read everything again")
+    parser.add_argument("--plot", action="store_true", help="plot latency and hit rate over time")
+    parser.add_argument("--save", help="save the plots as PNG files in this folder instead of showing them")
+    parser.add_argument("--output", help="write the summary as CSV to this file")
+    parser.add_argument("--stats-url", help="also fetch and plot /stats, e.g. http://localhost/stats")
+    args = parser.parse_args(argv)
+
+    log_folder = Path(args.logs)
+    cache_folder = Path(args.cache) if args.cache else log_folder / ".analysis"
+    results = {}
+    for node, policy, path in find_logs(log_folder):
+        if args.rebuild:
+            cache_path(cache_folder, node, policy).unlink(missing_ok=True)
+        results[(node, policy)] = read_logs(node, policy, path, cache_folder)
+    if not results:
+        parser.error(f"no cache logs found in {log_folder}")
+
+    summary = summarize(results)
+    with pd.option_context("display.width", 120, "display.float_format", "{:.6f}".format):
+        print(summary.to_string(index=False))
+    if args.output:
+        summary.to_csv(args.output, index=False)
+    if args.plot or args.save:
+        plot_latency(results, args.save)
+    if args.stats_url:
+        plot_stats(fetch_stats(args.stats_url), args.save)
 
 
-plot_stats(stats)
+if __name__ == "__main__":
+    main()
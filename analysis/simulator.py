@@ -0,0 +1,148 @@
+import argparse
+import json
+from pathlib import Path
+from timeit import default_timer as timer
+from algorithms.lru_cache import LRUCache
+from algorithms.lfu_cache import LFUCache
+from algorithms.arc_cache import ARCCache
+from algorithms.tinylfu_cache import TinyLFUCache
+
+# Offline trace replay: feeds a key trace straight into the cache classes (no HTTP, no logging)
+# Run from the project root so the algorithms package (and ./logs) can be found:
+#   python -m analysis.simulator logs/fastapi1/lru_cache.log --capacities 2,3,5,8
+
+POLICIES = {
+    "LRU": LRUCache,
+    "LFU": LFUCache,
+    "ARC": ARCCache,
+    "TinyLFU": TinyLFUCache,
+}
+
+RAW_KEY_SUFFIXES = {"", ".txt", ".csv"}  # files where every non-JSON line is a key
+
+
+# Read a key trace from a file, one access per line
+def read_trace(path):
+    path = Path(path)
+    keys = []
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # skip truncated/broken lines
+                if "event_type" in record:
+                    # per-cache logs: only log_metrics records (they have a latency) are one per request,
+                    # log_event records (evict, miss) would double count
+                    if "latency" not in record or record["event_type"] not in ("hit", "miss"):
+                        continue
+                    key = record.get("key")
+                else:
+                    key = record.get("item_id", record.get("key"))
+                if key is not None:
+                    keys.append(str(key))  # the endpoints receive item_id as a string
+            elif path.suffix in RAW_KEY_SUFFIXES:
+                keys.append(line.split(',')[0])
+    return keys
+
+
+# Replay a trace through one cache the same way handle_cache_request does (get, put on miss)
+def replay(cache_class, capacity, trace):
+    cache = cache_class(capacity=capacity, log_events=False)
+    get = cache.get  # bind once, attribute lookups add up over millions of accesses
+    put = cache.put
+    start = timer()
+    for key in trace:
+        if get(key) == "Not Found":
+            put(key, key)
+    elapsed = timer() - start
+    stats = cache.calculate_statistics()
+    return {
+        "capacity": capacity,
+        "hit_ratio": stats["hit_ratio"],
+        "ops_per_sec": len(trace) / elapsed if elapsed > 0 else 0,
+        "elapsed": elapsed,
+    }
+
+
+# Replay the trace for every policy and capacity, results are grouped by policy name
+def simulate(trace, capacities, policies=None):
+    policies = policies or list(POLICIES)
+    results = {}
+    for name in policies:
+        results[name] = [replay(POLICIES[name], capacity, trace) for capacity in capacities]
+    return results
+
+
+# Default sweep: a spread of capacities relative to the number of distinct keys
+def default_capacities(trace):
+    unique_keys = len(set(trace))
+    capacities = {max(1, int(unique_keys * fraction)) for fraction in (0.01, 0.05, 0.1, 0.25, 0.5, 0.75)}
+    return sorted(capacities)
+
+
+def print_results(results, accesses):
+    print(f"Replayed {accesses} accesses")
+    print(f"{'policy':<8}{'capacity':>10}{'hit ratio':>12}{'ops/sec':>14}")
+    for name, rows in results.items():
+        for row in rows:
+            print(f"{name:<8}{row['capacity']:>10}{row['hit_ratio']:>12.4f}{row['ops_per_sec']:>14,.0f}")
+
+
+# Hit ratio curve, one line per policy
+def plot_results(results):
+    import matplotlib.pyplot as plt  # only needed for plotting
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for name, rows in results.items():
+        ax.plot([row["capacity"] for row in rows], [row["hit_ratio"] for row in rows], marker='o', label=name)
+    ax.set_xscale('log')
+    ax.set_xlabel('Capacity (items)')
+    ax.set_ylabel('Hit Ratio')
+    ax.set_title('Hit Ratio by Cache Capacity')
+    ax.legend()
+    plt.tight_layout()
+    plt.show()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a key trace through the cache algorithms")
+    parser.add_argument("trace", nargs='+', help="trace files (JSON lines with key/item_id, cache logs, or one key per line)")
+    parser.add_argument("--capacities", help="comma separated capacities, defaults to a sweep based on the number of distinct keys")
+    parser.add_argument("--policies", default=",".join(POLICIES), help="comma separated policies to replay")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--plot", action="store_true", help="plot the hit ratio curves")
+    args = parser.parse_args(argv)
+
+    trace = []
+    for path in args.trace:
+        trace.extend(read_trace(path))
+    if not trace:
+        parser.error("no keys found in the trace")
+
+    if args.capacities:
+        capacities = [int(capacity) for capacity in args.capacities.split(',')]
+    else:
+        capacities = default_capacities(trace)
+    names = {name.upper(): name for name in POLICIES}  # accept lru, tinylfu, ...
+    unknown = [name.strip() for name in args.policies.split(',') if name.strip().upper() not in names]
+    if unknown:
+        parser.error(f"unknown policies: {', '.join(unknown)}")
+    policies = [names[name.strip().upper()] for name in args.policies.split(',')]
+
+    results = simulate(trace, capacities, policies)
+    print_results(results, len(trace))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"accesses": len(trace), "results": results}, file, indent=2)
+    if args.plot:
+        plot_results(results)
+
+
+if __name__ == "__main__":
+    main()
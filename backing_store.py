@@ -0,0 +1,300 @@
+import asyncio
+from abc import ABC, abstractmethod
+import json
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from timeit import default_timer as timer
+
+# Stand-in for a slow origin (database, remote service) behind the caches, configured with environment variables:
+# ORIGIN_DELAY_MS: typical delay per fetch (0 = no delay, the old behaviour)
+# ORIGIN_DELAY_DIST: fixed, uniform (delay +/- ORIGIN_DELAY_JITTER_MS), exponential (mean delay) or lognormal (median delay)
+# ORIGIN_SQLITE: path of a SQLite file to read items from instead of data.json (filled from data.json if empty)
+ORIGIN_DELAY_MS = float(os.getenv("ORIGIN_DELAY_MS", "0"))
+ORIGIN_DELAY_DIST = os.getenv("ORIGIN_DELAY_DIST", "fixed")
+ORIGIN_DELAY_JITTER_MS = float(os.getenv("ORIGIN_DELAY_JITTER_MS", "0"))
+ORIGIN_DELAY_SIGMA = float(os.getenv("ORIGIN_DELAY_SIGMA", "0.5"))  # spread of the lognormal distribution
+ORIGIN_SQLITE = os.getenv("ORIGIN_SQLITE")
+
+
+# Returns a function that gives the delay (in seconds) of one fetch, or None when there is no delay
+def make_delay(distribution, delay_ms, jitter_ms=0, sigma=0.5):
+    delay = delay_ms / 1000
+    jitter = jitter_ms / 1000
+    if delay <= 0 and jitter <= 0:
+        return None
+    if distribution == "fixed":
+        return lambda: delay
+    if distribution == "uniform":
+        return lambda: random.uniform(max(0, delay - jitter), delay + jitter)
+    if distribution == "exponential":
+        return lambda: random.expovariate(1 / delay)
+    if distribution == "lognormal":
+        return lambda: random.lognormvariate(math.log(delay), sigma)
+    raise ValueError(f"Unknown delay distribution: {distribution}")
+
+
+# Base of the origins: subclasses implement load, fetching, delays and statistics are shared
+class BackingStore(ABC):
+    blocking = False  # True when load does I/O, fetch_async then runs it on a worker thread
+
+    def __init__(self, delay=None):
+        self.delay = delay  # function returning the seconds to wait per fetch, None for no delay
+        self.lock = threading.Lock()  # protects the statistics, fetches run in parallel
+        self.fetches = 0  # keys fetched, a batch counts each of its keys like the single fetches it replaces
+        self.round_trips = 0  # single fetches plus batches, what the fetch latency is averaged over
+        self.batches = 0
+        self.batch_fetches = 0  # keys fetched by batches (included in fetches)
+        self.not_found = 0
+        self.fetch_time = 0.0
+        self.max_fetch_time = 0.0
+
+    @abstractmethod
+    def load(self, key):  # return the value for key, or None if it does not exist
+        ...
+
+    def load_many(self, keys):  # return key -> value for the keys that exist
+        items = {}
+        for key in keys:
+            value = self.load(key)
+            if value is not None:
+                items[key] = value
+        return items
+
+    def fetch(self, key):
+        start = timer()
+        if self.delay:
+            time.sleep(self.delay())
+        value = self.load(key)
+        self.record_fetch(timer() - start, value is None)
+        return value
+
+    # Fetch several keys in one round trip (a single delay for the whole batch)
+    def fetch_many(self, keys):
+        start = timer()
+        if self.delay:
+            time.sleep(self.delay())
+        items = self.load_many(keys)
+        self.record_fetch(timer() - start, len(keys) - len(items), len(keys))
+        return items
+
+    # fetch/fetch_many for the async endpoints: the delay is awaited and a load that blocks (SQLite) runs on a
+    # worker thread, so a slow origin never holds up the event loop
+    async def fetch_async(self, key):
+        start = timer()
+        if self.delay:
+            await asyncio.sleep(self.delay())
+        value = await asyncio.to_thread(self.load, key) if self.blocking else self.load(key)
+        self.record_fetch(timer() - start, value is None)
+        return value
+
+    async def fetch_many_async(self, keys):
+        start = timer()
+        if self.delay:
+            await asyncio.sleep(self.delay())
+        items = await asyncio.to_thread(self.load_many, keys) if self.blocking else self.load_many(keys)
+        self.record_fetch(timer() - start, len(keys) - len(items), len(keys))
+        return items
+
+    # batch is the number of keys of a fetch_many, None for a single fetch
+    def record_fetch(self, elapsed, not_found, batch=None):
+        with self.lock:
+            self.fetches += 1 if batch is None else batch
+            self.round_trips += 1
+            if batch is not None:
+                self.batches += 1
+                self.batch_fetches += batch
+            self.not_found += not_found
+            self.fetch_time += elapsed
+            self.max_fetch_time = max(self.max_fetch_time, elapsed)
+
+    def statistics(self):
+        with self.lock:
+            return {
+                "fetches": self.fetches,
+                "batches": self.batches,
+                "batch_fetches": self.batch_fetches,
+                "not_found": self.not_found,
+                "avg_fetch_latency": self.fetch_time / self.round_trips if self.round_trips > 0 else 0,  # per round trip
+                "max_fetch_latency": self.max_fetch_time,
+            }
+
+
+# Items from the dictionary loaded from data.json
+class DictBackingStore(BackingStore):
+    def __init__(self, data, delay=None):
+        super().__init__(delay)
+        self.data = data
+
+    def load(self, key):
+        return self.data.get(key)
+
+
+# Items stored as JSON in a SQLite table, one connection per thread (sqlite3 connections are not shared across threads)
+class SQLiteBackingStore(BackingStore):
+    blocking = True
+
+    def __init__(self, path, delay=None, data=None):
+        super().__init__(delay)
+        self.path = path
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if data and connection.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 0:  # first run, seed it
+            connection.executemany("INSERT INTO items VALUES (?, ?)", [(key, json.dumps(value)) for key, value in data.items()])
+        connection.commit()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def load(self, key):
+        row = self.connection().execute("SELECT value FROM items WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_many(self, keys):
+        keys = list(keys)
+        items = {}
+        for start in range(0, len(keys), 500):  # stay under SQLite's limit on query parameters
+            chunk = keys[start:start + 500]
+            rows = self.connection().execute(f"SELECT key, value FROM items WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            items.update((key, json.loads(value)) for key, value in rows)
+        return items
+
+
+def create_backing_store(data):
+    delay = make_delay(ORIGIN_DELAY_DIST, ORIGIN_DELAY_MS, ORIGIN_DELAY_JITTER_MS, ORIGIN_DELAY_SIGMA)
+    if ORIGIN_SQLITE:
+        return SQLiteBackingStore(ORIGIN_SQLITE, delay, data)
+    return DictBackingStore(data, delay)
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.callbacks = []  # run once the call is done, on the thread that finished it (None after that)
+
+
+# Request coalescing: while a call for a key is running, other callers with the same key wait for its result
+# instead of starting their own. A caller can also lead calls it runs itself (start/start_many, then finish),
+# which is how a batch fetch registers its keys so single misses of those keys wait for it.
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Call in progress
+        self.coalesced = 0  # callers that waited on someone else's call
+
+    def do(self, key, fn, *args):
+        call, leader = self.start(key)
+        if not leader:
+            return self.wait(call)
+        try:
+            result = fn(*args)
+        except BaseException as error:
+            self.finish(key, call, error=error)
+            raise
+        self.finish(key, call, result)
+        return result
+
+    # (call in progress for key, False), or (new call, True): the caller leads it and must finish it
+    def start(self, key):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = self.calls[key] = Call()
+            return call, True
+
+    # start() for the keys of a batch, returns (key -> call the caller leads, key -> call someone else leads)
+    def start_many(self, keys):
+        led = {}
+        joined = {}
+        with self.lock:
+            for key in keys:
+                call = self.calls.get(key)
+                if call is not None:
+                    self.coalesced += 1
+                    joined[key] = call
+                else:
+                    led[key] = self.calls[key] = Call()
+        return led, joined
+
+    def finish(self, key, call, result=None, error=None):
+        call.result = result
+        call.error = error
+        with self.lock:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+            callbacks, call.callbacks = call.callbacks, None
+            call.done.set()
+        for callback in callbacks:
+            callback()
+
+    # finish() every call of a start_many(), results maps key -> result (missing keys get None)
+    def finish_many(self, calls, results=None, error=None):
+        for key, call in calls.items():
+            self.finish(key, call, None if results is None else results.get(key), error)
+
+    # Run callback once call is done, right away if it already is
+    def on_done(self, call, callback):
+        with self.lock:
+            if call.callbacks is not None:
+                call.callbacks.append(callback)
+                return
+        callback()
+
+    @staticmethod
+    def wait(call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+# SingleFlight for coroutines, sharing the calls of the sync callers' SingleFlight so a sync and an async miss of
+# the same key coalesce too. A coroutine that leads a call runs it as a task of its own and every caller, the
+# leader included, waits for the call without blocking the event loop. A caller that goes away (client disconnect)
+# does not cancel the call for the others.
+class AsyncSingleFlight:
+    def __init__(self, flight):
+        self.flight = flight
+        self.tasks = {}  # key -> task of a call led by a coroutine
+
+    async def do(self, key, fn, *args):
+        call, leader = self.flight.start(key)
+        if leader:
+            task = self.tasks[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda done: self.finished(key, call, done))
+        return await self.wait(call)
+
+    def finished(self, key, call, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+        if task.cancelled():
+            self.flight.finish(key, call, error=asyncio.CancelledError())
+        else:
+            self.flight.finish(key, call, None if task.exception() else task.result(), task.exception())
+
+    # Await a call that may be finished on another thread (a sync caller or batch leads it)
+    async def wait(self, call):
+        if not call.done.is_set():
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.flight.on_done(call, lambda: loop.call_soon_threadsafe(resolve, future))
+            await future
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+def resolve(future):
+    if not future.done():  # the waiter may have been cancelled
+        future.set_result(None)
@@ -0,0 +1,99 @@
+import argparse
+import json
+import sys
+from benchmarks.run import RESULT_KEY
+
+# Diff two benchmark reports (benchmarks/run.py) case by case and fail on regressions, e.g. in CI:
+#   python -m benchmarks.compare base.json head.json
+# The exit status is 1 when a case got slower or missed more than the thresholds allow.
+
+
+def load_results(path):
+    with open(path) as file:
+        report = json.load(file)
+    return report.get("meta", {}), {tuple(row.get(name) for name in RESULT_KEY): row for row in report["results"]}
+
+
+def relative_change(before, after):
+    if before is None or after is None or before == 0:
+        return None
+    return (after - before) / before
+
+
+# Regressions of one case: lower throughput, higher p99 (relative) or a lower hit ratio (absolute, the in-process
+# runs are deterministic so any drop is a real change of behaviour)
+def find_regressions(before, after, max_slowdown, max_p99_increase, max_hit_ratio_drop):
+    regressions = []
+    throughput = relative_change(before["ops_per_sec"], after["ops_per_sec"])
+    if throughput is not None and throughput < -max_slowdown:
+        regressions.append(f"throughput {throughput:+.1%}")
+    p99 = relative_change(before["p99"], after["p99"])
+    if p99 is not None and p99 > max_p99_increase:
+        regressions.append(f"p99 {p99:+.1%}")
+    if before["hit_ratio"] is not None and after["hit_ratio"] is not None:
+        drop = before["hit_ratio"] - after["hit_ratio"]
+        if drop > max_hit_ratio_drop:
+            regressions.append(f"hit ratio -{drop:.4f}")
+    return regressions
+
+
+def format_change(change):
+    return f"{change:+.1%}" if change is not None else "-"
+
+
+def compare(base, head, max_slowdown=0.1, max_p99_increase=0.25, max_hit_ratio_drop=0.001):
+    rows = []
+    for key in sorted(set(base) | set(head), key=lambda key: tuple(str(part) for part in key)):
+        before, after = base.get(key), head.get(key)
+        if before is None or after is None:
+            rows.append({"key": key, "status": "added" if before is None else "removed", "regressions": []})
+            continue
+        rows.append({
+            "key": key,
+            "status": "compared",
+            "hit_ratio": (before["hit_ratio"], after["hit_ratio"]),
+            "throughput": relative_change(before["ops_per_sec"], after["ops_per_sec"]),
+            "p50": relative_change(before["p50"], after["p50"]),
+            "p99": relative_change(before["p99"], after["p99"]),
+            "regressions": find_regressions(before, after, max_slowdown, max_p99_increase, max_hit_ratio_drop),
+        })
+    return rows
+
+
+def print_comparison(rows):
+    print(f"{'mode':<11}{'workload':<10}{'policy':<13}{'capacity':>9}{'hit ratio':>19}{'ops/sec':>9}{'p50':>9}{'p99':>9}")
+    for row in rows:
+        mode, workload, policy, capacity = row["key"]
+        line = f"{mode:<11}{workload:<10}{policy:<13}{str(capacity):>9}"
+        if row["status"] != "compared":
+            print(f"{line}  ({row['status']})")
+            continue
+        before, after = (f"{ratio:.4f}" if ratio is not None else "-" for ratio in row["hit_ratio"])
+        line += f"{before + ' -> ' + after:>19}{format_change(row['throughput']):>9}{format_change(row['p50']):>9}{format_change(row['p99']):>9}"
+        if row["regressions"]:
+            line += "  REGRESSION: " + ", ".join(row["regressions"])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument("base", help="report of the baseline (e.g. the main branch)")
+    parser.add_argument("head", help="report of the change")
+    parser.add_argument("--max-slowdown", type=float, default=0.1, help="allowed relative throughput drop")
+    parser.add_argument("--max-p99-increase", type=float, default=0.25, help="allowed relative p99 increase")
+    parser.add_argument("--max-hit-ratio-drop", type=float, default=0.001, help="allowed absolute hit ratio drop")
+    args = parser.parse_args(argv)
+
+    base_meta, base = load_results(args.base)
+    head_meta, head = load_results(args.head)
+    print(f"{args.base} ({base_meta.get('commit')}) -> {args.head} ({head_meta.get('commit')})")
+    rows = compare(base, head, args.max_slowdown, args.max_p99_increase, args.max_hit_ratio_drop)
+    print_comparison(rows)
+    regressions = sum(bool(row["regressions"]) for row in rows)
+    if regressions:
+        print(f"{regressions} regressed cases")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
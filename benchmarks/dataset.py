@@ -0,0 +1,61 @@
+import argparse
+import json
+import math
+import random
+import string
+
+# Synthetic data.json: num_items products like the ones in data.json, with a description padded so the encoded
+# items follow a size distribution. Point the app at it with DATA_PATH. Run from the project root:
+#   python -m benchmarks.dataset benchmarks/data-100k.json --items 100000 --sizes lognormal --mean-size 1024
+
+SIZE_DISTRIBUTIONS = ("fixed", "uniform", "lognormal", "pareto")
+MIN_SIZE = 64  # name and price alone take about this much
+
+
+# Target size of one item in bytes, mean_size on average for every distribution
+def item_size(rng, distribution, mean_size):
+    if distribution == "fixed":
+        size = mean_size
+    elif distribution == "uniform":
+        size = rng.uniform(0.5 * mean_size, 1.5 * mean_size)
+    elif distribution == "lognormal":  # most items small, some a lot larger (sigma 1)
+        size = rng.lognormvariate(math.log(mean_size) - 0.5, 1.0)
+    elif distribution == "pareto":  # heavy tail (alpha 1.5): a few items are orders of magnitude larger
+        size = mean_size / 3 * rng.paretovariate(1.5)
+    else:
+        raise ValueError(f"unknown size distribution {distribution!r}, expected one of {', '.join(SIZE_DISTRIBUTIONS)}")
+    return max(MIN_SIZE, int(size))
+
+
+def generate_dataset(num_items, distribution="fixed", mean_size=100, seed=0):
+    rng = random.Random(seed)
+    text = "".join(rng.choices(string.ascii_lowercase + " ", k=4096))  # sliced for the descriptions
+    data = {}
+    for i in range(1, num_items + 1):
+        item = {"name": f"Product {i}", "description": "", "price": i * 10}
+        padding = item_size(rng, distribution, mean_size) - len(json.dumps(item))
+        start = rng.randrange(len(text))
+        item["description"] = (text[start:] + text * (padding // len(text) + 1))[:max(0, padding)]
+        data[str(i)] = item
+    return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic data.json")
+    parser.add_argument("output", help="file to write, e.g. benchmarks/data-100k.json")
+    parser.add_argument("--items", type=int, default=10000, help="number of items (keys 1..items)")
+    parser.add_argument("--sizes", choices=SIZE_DISTRIBUTIONS, default="fixed", help="distribution of the item sizes")
+    parser.add_argument("--mean-size", type=int, default=100, help="mean size of an item in bytes (JSON encoded)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    data = generate_dataset(args.items, args.sizes, args.mean_size, args.seed)
+    with open(args.output, "w") as file:
+        json.dump(data, file)
+    sizes = sorted(len(json.dumps(item)) for item in data.values())
+    print(f"Wrote {len(data)} items to {args.output}: mean {sum(sizes) / len(sizes):.0f} bytes, "
+          f"median {sizes[len(sizes) // 2]}, max {sizes[-1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from time import perf_counter
+from algorithms.compact_cache import CompactLRUCache, CompactLFUCache
+from algorithms.metrics import LatencyHistogram
+from analysis.simulator import POLICIES
+from benchmarks.workloads import WORKLOADS, make_trace, parse_params
+
+# Benchmark runner: replays every workload through every policy and capacity in-process (get, put on a miss,
+# like handle_cache_request) and writes throughput, p50/p99 latency and hit ratio to a JSON report that
+# benchmarks/compare.py can diff between commits. Run from the project root:
+#   python -m benchmarks.run --output bench.json
+#   python -m benchmarks.run --workloads zipf,scan --keys 100000 --capacities 1000,10000 --data benchmarks/data-100k.json
+# Results of a Locust run over HTTP (locust --csv results) are added to the same report with:
+#   python -m benchmarks.run --locust-csv results_stats.csv --workload zipf --stats-url http://localhost/stats --output bench.json
+
+ENGINES = {**POLICIES, "CompactLRU": CompactLRUCache, "CompactLFU": CompactLFUCache}
+STATS_NAMES = {"lru": "LRU", "lfu": "LFU", "arc": "ARC", "tinylfu": "TinyLFU"}  # endpoint -> name in /stats
+RESULT_KEY = ("mode", "workload", "policy", "capacity")  # identifies a row when reports are compared
+
+
+# One replay, every access (the get and the put of a miss) is timed on its own
+def replay(cache_class, capacity, trace, values=None, max_bytes=None):
+    options = {"max_bytes": max_bytes} if max_bytes else {}
+    cache = cache_class(capacity=capacity, log_events=False, **options)
+    values = values or {}
+    get = cache.get
+    put = cache.put
+    histogram = LatencyHistogram()
+    record = histogram.record
+    start = perf_counter()
+    for key in trace:
+        begin = perf_counter()
+        if get(key) == "Not Found":
+            put(key, values.get(key, key))
+        record(perf_counter() - begin)
+    elapsed = perf_counter() - start
+    return {
+        "hit_ratio": cache.calculate_statistics()["hit_ratio"],
+        "ops_per_sec": len(trace) / elapsed if elapsed > 0 else 0,
+        "p50": histogram.quantile(0.5),
+        "p99": histogram.quantile(0.99),
+    }
+
+
+# repeat runs of one case, the median of the timings (the hit ratio is the same every time)
+def run_case(cache_class, capacity, trace, values, max_bytes, repeat):
+    runs = [replay(cache_class, capacity, trace, values, max_bytes) for _ in range(repeat)]
+    return {
+        "hit_ratio": runs[0]["hit_ratio"],
+        "ops_per_sec": statistics.median(run["ops_per_sec"] for run in runs),
+        "p50": statistics.median(run["p50"] for run in runs),
+        "p99": statistics.median(run["p99"] for run in runs),
+    }
+
+
+def run_in_process(workloads, policies, capacities, num_keys, accesses, seed=0, params=None, values=None,
+                   max_bytes=None, repeat=1):
+    results = []
+    for workload in workloads:
+        trace = make_trace(workload, num_keys, accesses, seed, **(params or {}).get(workload, {}))
+        for policy in policies:
+            for capacity in capacities:
+                row = {"mode": "in-process", "workload": workload, "policy": policy, "capacity": capacity, "accesses": len(trace)}
+                row.update(run_case(ENGINES[policy], capacity, trace, values, max_bytes, repeat))
+                results.append(row)
+    return results
+
+
+# Rows of a Locust stats CSV (locust --csv <prefix> writes <prefix>_stats.csv), one per cache endpoint.
+# Locust reports milliseconds, the report uses seconds like the in-process rows.
+def read_locust_csv(path, workload, stats=None, capacity=None):
+    results = []
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            parts = row["Name"].strip("/").split("/")
+            is_async = parts[0] == "async"  # /async/lru/... is the same cache as /lru/...
+            if is_async:
+                parts = parts[1:]
+            endpoint = parts[0]
+            if endpoint not in STATS_NAMES:  # Aggregated and any other endpoints
+                continue
+            policy = STATS_NAMES[endpoint]
+            if parts[1:2] == ["batch"]:
+                policy += " batch"
+            if is_async:
+                policy += " async"
+            results.append({
+                "mode": "http",
+                "workload": workload,
+                "policy": policy,
+                "capacity": capacity,
+                "accesses": int(row["Request Count"]),
+                "failures": int(row["Failure Count"]),
+                "hit_ratio": stats[STATS_NAMES[endpoint]]["hit_ratio"] if stats else None,
+                "ops_per_sec": float(row["Requests/s"]),
+                "p50": float(row["50%"]) / 1000,
+                "p99": float(row["99%"]) / 1000,
+            })
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Rows with the same key in an existing report are replaced, so in-process and HTTP runs can share one file
+def write_report(path, results, mode, settings):
+    report = {"results": []}
+    if os.path.exists(path):
+        with open(path) as file:
+            report = json.load(file)
+    new_keys = {tuple(row[name] for name in RESULT_KEY) for row in results}
+    kept = [row for row in report["results"] if tuple(row.get(name) for name in RESULT_KEY) not in new_keys]
+    report["meta"] = {"commit": git_commit(), "python": platform.python_version(), "machine": platform.machine(),
+                      "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    report.setdefault("settings", {})[mode] = settings  # arguments of the last run of each mode
+    report["results"] = kept + results
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def print_results(results):
+    print(f"{'mode':<11}{'workload':<10}{'policy':<13}{'capacity':>9}{'hit ratio':>11}{'ops/sec':>12}{'p50 (µs)':>10}{'p99 (µs)':>10}")
+    for row in results:
+        hit_ratio = f"{row['hit_ratio']:.4f}" if row["hit_ratio"] is not None else "-"
+        print(f"{row['mode']:<11}{row['workload']:<10}{row['policy']:<13}{str(row['capacity']):>9}{hit_ratio:>11}"
+              f"{row['ops_per_sec']:>12,.0f}{row['p50'] * 1e6:>10.2f}{row['p99'] * 1e6:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cache policies on synthetic workloads")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="comma separated workloads")
+    parser.add_argument("--policies", default=",".join(POLICIES), help=f"comma separated, any of {', '.join(ENGINES)}")
+    parser.add_argument("--keys", type=int, default=10000, help="distinct keys (1..keys, like the dataset)")
+    parser.add_argument("--accesses", type=int, default=200000, help="accesses per workload")
+    parser.add_argument("--capacities", default="100,1000", help="comma separated capacities")
+    parser.add_argument("--params", action="append", default=[],
+                        help="workload parameters, e.g. scan:scan_length=200,skew=0.8 (repeatable)")
+    parser.add_argument("--data", help="dataset (benchmarks/dataset.py) whose items are cached instead of the keys")
+    parser.add_argument("--max-bytes", type=int, help="byte budget of each cache, for datasets with large items")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the median timings are reported")
+    parser.add_argument("--locust-csv", help="add the results of a Locust run (its _stats.csv) instead of running in-process")
+    parser.add_argument("--workload", help="workload the Locust run used (its WORKLOAD)")
+    parser.add_argument("--stats-url", help="/stats of the app after the Locust run, for the hit ratios")
+    parser.add_argument("--capacity", type=int, help="CACHE_CAPACITY of the app during the Locust run")
+    parser.add_argument("--output", help="JSON report to write (rows of the same case in an existing report are replaced)")
+    args = parser.parse_args(argv)
+
+    if args.locust_csv:
+        stats = None
+        if args.stats_url:
+            import requests  # only needed for --stats-url
+            stats = requests.get(args.stats_url).json()
+        results = read_locust_csv(args.locust_csv, args.workload or os.getenv("WORKLOAD", "cycle"), stats, args.capacity)
+        mode, settings = "http", {"locust_csv": args.locust_csv, "stats_url": args.stats_url}
+    else:
+        workloads = [name.strip() for name in args.workloads.split(",")]
+        policies = [name.strip() for name in args.policies.split(",")]
+        unknown = [name for name in workloads if name not in WORKLOADS] + [name for name in policies if name not in ENGINES]
+        if unknown:
+            parser.error(f"unknown workloads/policies: {', '.join(unknown)}")
+        params = {}
+        for text in args.params:
+            workload, _, values = text.partition(":")
+            params[workload] = parse_params(values)
+        values = None
+        if args.data:
+            with open(args.data) as file:
+                values = json.load(file)
+        capacities = [int(capacity) for capacity in args.capacities.split(",")]
+        results = run_in_process(workloads, policies, capacities, args.keys, args.accesses, args.seed, params, values,
+                                 args.max_bytes, args.repeat)
+        mode, settings = "in-process", {"keys": args.keys, "accesses": args.accesses, "seed": args.seed, "params": params,
+                    "data": args.data, "max_bytes": args.max_bytes, "repeat": args.repeat}
+
+    print_results(results)
+    if args.output:
+        write_report(args.output, results, mode, settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import random
+from itertools import accumulate
+
+# Synthetic access patterns over the keys "1".."num_keys" (the keys of data.json and benchmarks/dataset.py).
+# Every generator takes the number of keys, the number of accesses, a seeded random.Random and its own
+# parameters, so the same arguments always give the same trace.
+
+
+def key_names(num_keys):
+    return [str(key) for key in range(1, num_keys + 1)]
+
+
+# Skewed popularity: the key of rank r is accessed in proportion to 1 / r^skew. The ranks are shuffled over the
+# keys so the hot keys are not all next to each other (shards, ranges of the dataset).
+def zipf(num_keys, accesses, rng, skew=0.99):
+    keys = key_names(num_keys)
+    rng.shuffle(keys)
+    cum_weights = list(accumulate(1 / rank ** skew for rank in range(1, num_keys + 1)))
+    return rng.choices(keys, cum_weights=cum_weights, k=accesses)
+
+
+def uniform(num_keys, accesses, rng):
+    return rng.choices(key_names(num_keys), k=accesses)
+
+
+# Zipf traffic polluted by sequential scans: every scan_every accesses, scan_length keys are read once in order
+# (a batch job or a crawler), continuing where the previous scan stopped. LRU lets a scan flush the hot keys.
+def scan(num_keys, accesses, rng, skew=0.99, scan_every=1000, scan_length=500):
+    trace = zipf(num_keys, accesses, rng, skew)
+    keys = key_names(num_keys)
+    position = 0
+    result = []
+    for start in range(0, accesses, scan_every):
+        result.extend(trace[start:start + scan_every])
+        result.extend(keys[(position + i) % num_keys] for i in range(scan_length))
+        position = (position + scan_length) % num_keys
+    return result[:accesses]
+
+
+# The same loop_size keys over and over in order, what load_tests/locustfile.py did with keys 1 to 10.
+# With a loop larger than the cache LRU never hits.
+def loop(num_keys, accesses, rng, loop_size=None):
+    keys = key_names(min(loop_size or num_keys, num_keys))
+    return [keys[i % len(keys)] for i in range(accesses)]
+
+
+# A hot set of hot_size keys gets hot_fraction of the accesses (the rest are uniform over all keys) and moves to
+# other keys every phase_length accesses, the way popular items change over a day. Tests how fast a policy adapts.
+def shifting(num_keys, accesses, rng, hot_size=None, hot_fraction=0.9, phase_length=10000):
+    keys = key_names(num_keys)
+    hot_size = min(hot_size or max(1, num_keys // 20), num_keys)
+    trace = []
+    while len(trace) < accesses:
+        hot = rng.sample(keys, hot_size)  # a fresh hot set for this phase
+        for _ in range(min(phase_length, accesses - len(trace))):
+            trace.append(rng.choice(hot) if rng.random() < hot_fraction else rng.choice(keys))
+    return trace
+
+
+WORKLOADS = {
+    "zipf": zipf,
+    "uniform": uniform,
+    "scan": scan,
+    "loop": loop,
+    "shifting": shifting,
+}
+
+
+def make_trace(workload, num_keys, accesses, seed=0, **params):
+    if workload not in WORKLOADS:
+        raise ValueError(f"unknown workload {workload!r}, expected one of {', '.join(WORKLOADS)}")
+    return WORKLOADS[workload](num_keys, accesses, random.Random(seed), **params)
+
+
+# "skew=0.8,scan_length=200" -> {"skew": 0.8, "scan_length": 200}
+def parse_params(text):
+    params = {}
+    for part in filter(None, (part.strip() for part in (text or "").split(","))):
+        name, value = part.split("=", 1)
+        number = float(value)
+        params[name.strip()] = int(number) if number.is_integer() and "." not in value else number
+    return params
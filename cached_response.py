@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+from fastapi import Response
+from algorithms.sizing import json_size
+
+# "object" caches the item dicts and lets FastAPI encode them on every request,
+# "bytes" caches the encoded JSON body (and its ETag) so a hit is returned as is
+RESPONSE_MODE = os.getenv("CACHE_RESPONSE_MODE", "object")
+
+CachedResponse = namedtuple("CachedResponse", ["body", "etag"])
+
+
+# Encode a value once, the same way FastAPI's JSONResponse would, and compute its ETag
+def encode_response(value):
+    body = json.dumps(value, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    return CachedResponse(body, etag)
+
+
+# What the caches store for a value in the current mode
+def cache_entry(value):
+    return encode_response(value) if RESPONSE_MODE == "bytes" else value
+
+
+# Weight of a cache entry for the byte budget, the encoded body is already there in bytes mode
+def entry_size(entry):
+    if isinstance(entry, CachedResponse):
+        return len(entry.body)
+    return json_size(entry)
+
+
+def etag_matches(etag, if_none_match):
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+# Response for a cached entry: the stored bytes, or 304 if the client already has this version
+def make_response(entry, if_none_match=None):
+    if not isinstance(entry, CachedResponse):  # object mode, FastAPI encodes it
+        return entry
+    if etag_matches(entry.etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": entry.etag})
+    return Response(content=entry.body, media_type="application/json", headers={"ETag": entry.etag})
+
+
+# One response for a batch get: per key whether it was a hit, whether it exists at all and its value.
+# In bytes mode the stored bodies are spliced into the JSON as they are instead of being decoded and re-encoded.
+def make_batch_response(entries, hit_keys):
+    hits = sum(key in hit_keys for key in entries)
+    misses = len(entries) - hits
+    if RESPONSE_MODE != "bytes":
+        items = {key: {"hit": key in hit_keys, "found": entry is not None, "value": entry} for key, entry in entries.items()}
+        return {"items": items, "hits": hits, "misses": misses}
+    parts = []
+    for key, entry in entries.items():
+        flags = b'{"hit":%s,"found":%s,"value":' % (b"true" if key in hit_keys else b"false",
+                                                    b"true" if entry is not None else b"false")
+        parts.append(encode_response(key).body + b":" + flags + (entry.body if entry is not None else b"null") + b"}")
+    body = b'{"items":{' + b",".join(parts) + b'},"hits":%d,"misses":%d}' % (hits, misses)
+    return Response(content=body, media_type="application/json")
@@ -1,16 +1,52 @@
+import itertools
 import os
+import sys
 from locust import HttpUser, task, between
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))  # the benchmarks package
+from benchmarks.workloads import make_trace, parse_params
+
+WORKLOAD = os.getenv('WORKLOAD')  # unset: keys 1 to 10 in order, otherwise one of benchmarks/workloads.py
+WAIT_TIME = [float(seconds) for seconds in os.getenv('WAIT_TIME', '1,2').split(',')]  # 0,0 for a throughput run
+
+user_numbers = itertools.count()  # every user replays its own trace (seed SEED + user number)
+
+
 class CacheTestingUser(HttpUser):
-    wait_time = between(1, 2)
+    wait_time = between(*WAIT_TIME)
     endpoint = os.getenv('ENDPOINT', '/lru')  # default to LRU
+    batch = os.getenv('BATCH') == '1'  # one batch request for the 10 items instead of 10 requests
+
+    def on_start(self):
+        if WORKLOAD:
+            seed = int(os.getenv('SEED', '0')) + next(user_numbers)
+            self.trace = make_trace(WORKLOAD, int(os.getenv('KEYS', '10')), int(os.getenv('TRACE_LENGTH', '10000')), seed,
+                                    **parse_params(os.getenv('WORKLOAD_PARAMS')))
+        else:
+            self.trace = [str(item_id) for item_id in range(1, 11)]  # 1 to 10 (inclusive) items to access
+        self.position = 0
+
+    # next count keys of the trace, from the start again at its end
+    def next_keys(self, count):
+        keys = [self.trace[(self.position + i) % len(self.trace)] for i in range(count)]
+        self.position = (self.position + count) % len(self.trace)
+        return keys
 
     @task
     def access_cache(self):
-        for item_id in range(1, 11):  # 1 to 10 (inclusive) items to access
+        keys = self.next_keys(10)
+        if self.batch:
+            self.client.post(f"{self.endpoint}/batch/get", json={"keys": keys})
+            return
+        for item_id in keys:
             self.client.get(f"{self.endpoint}/{item_id}", name=f"{self.endpoint}/[item_id]")
 
 # env variable to set the cache algorithm
 # ENDPOINT='/lru'
 # ENDPOINT='/lfu'
 # ENDPOINT='/arc'
+# ENDPOINT='/tinylfu'
+# BATCH=1
+# env variables for a benchmark workload (keys must exist in the app's DATA_PATH, see benchmarks/dataset.py)
+# WORKLOAD=zipf|uniform|scan|loop|shifting  KEYS=10000  TRACE_LENGTH=10000  SEED=0
+# WORKLOAD_PARAMS='skew=0.8'  WAIT_TIME=0,0
@@ -1,6 +1,159 @@
+import atexit
+import json
 import logging
+import os
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-def setup_log(name):
+# "sync" writes every record on the calling (request) thread, "queued" pushes records into an in-memory
+# buffer that a background thread writes to the file in batches
+LOG_MODE = os.getenv("LOG_MODE", "sync")
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", "10000"))  # records held before new ones are dropped
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))  # records written per batch
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.5"))  # seconds between background flushes
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # fraction of INFO/DEBUG records kept in queued mode
+LOG_AGGREGATE = os.getenv("LOG_AGGREGATE", "0") == "1"  # write one summary per event type per batch instead of every metric record
+
+queued_handlers = {}  # logger name -> QueuedHandler, used for the stats and to drain on exit
+
+
+# Cache loggers pass their log entry as a dict, it is only turned into JSON when it is written
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            log_entry = {"timestamp": datetime.fromtimestamp(record.created).isoformat()}
+            log_entry.update(record.msg)
+            return json.dumps(log_entry)
+        return super().format(record)
+
+
+class QueuedHandler(logging.Handler):
+    def __init__(self, target, buffer_size=LOG_BUFFER_SIZE, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL,
+                 sample_rate=LOG_SAMPLE_RATE, aggregate=LOG_AGGREGATE):
+        super().__init__(target.level)
+        self.target = target  # the handler that actually writes (FileHandler)
+        self.buffer = deque()  # bounded by buffer_size in emit (under the handler lock), the writer pops without it
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.aggregate = aggregate
+        self.written = 0
+        self.dropped = 0  # records lost because the buffer was full
+        self.sampled_out = 0  # records skipped by sampling
+        self.reported_dropped = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.run, name=f"log-writer-{target.baseFilename}", daemon=True)
+        self.writer.start()
+
+    def handle(self, record):
+        # the handler lock is only held by emit for its check and append, never while the file is written
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        sampled_out = self.sample_rate < 1.0 and record.levelno < logging.WARNING and random.random() >= self.sample_rate
+        with self.lock:  # many request threads emit at once, the counts and the size check need to agree
+            if sampled_out:
+                self.sampled_out += 1
+                return
+            if len(self.buffer) >= self.buffer_size:  # full, drop the new record instead of blocking the request
+                self.dropped += 1
+                return
+            self.buffer.append(record)
+            full_batch = len(self.buffer) >= self.batch_size
+        if full_batch:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush_buffer()
+        self.flush_buffer()  # drain whatever is left once stopped
+
+    def flush_buffer(self):
+        while self.buffer:
+            batch = []
+            while self.buffer and len(batch) < self.batch_size:
+                batch.append(self.buffer.popleft())
+            if self.aggregate:
+                batch = self.aggregate_batch(batch)
+            self.write([self.target.format(record) for record in batch])
+        with self.lock:
+            dropped = self.dropped
+        if dropped > self.reported_dropped:  # let the log itself show that records are missing
+            self.write([self.target.format(self.dropped_record(dropped))])
+            self.reported_dropped = dropped
+
+    def write(self, lines):
+        self.target.acquire()
+        try:
+            stream = self.target.stream
+            stream.write(self.target.terminator.join(lines) + self.target.terminator)
+            stream.flush()
+            self.written += len(lines)
+        finally:
+            self.target.release()
+
+    # Replace the metric records (dict entries with a latency) with one summary per event type
+    def aggregate_batch(self, batch):
+        records = []
+        summaries = {}
+        for record in batch:
+            entry = record.msg
+            if not isinstance(entry, dict) or "latency" not in entry:
+                records.append(record)
+                continue
+            summary = summaries.get(entry["event_type"])
+            if summary is None:
+                summary = summaries[entry["event_type"]] = {"count": 0, "latency_sum": 0.0, "latency_max": 0.0}
+            summary["count"] += 1
+            summary["latency_sum"] += entry["latency"]
+            summary["latency_max"] = max(summary["latency_max"], entry["latency"])
+            summary["last"] = record
+        for event_type, summary in summaries.items():
+            last = summary["last"]
+            log_entry = dict(last.msg)  # keep hit_rate, cache_size, capacity from the latest record
+            log_entry.update({
+                "event_type": event_type,
+                "key": None,
+                "count": summary["count"],
+                "latency": summary["latency_sum"] / summary["count"],  # mean latency so existing analysis still works
+                "latency_max": summary["latency_max"],
+                "aggregated": True,
+            })
+            records.append(logging.makeLogRecord({"name": last.name, "levelno": last.levelno, "levelname": last.levelname,
+                                                  "msg": log_entry, "created": last.created}))
+        return records
+
+    def dropped_record(self, dropped):
+        if isinstance(self.target.formatter, JsonFormatter):
+            msg = {"event_type": "log_dropped", "dropped": dropped}
+        else:
+            msg = f"Log buffer full, {dropped} records dropped so far"
+        return logging.makeLogRecord({"levelno": logging.WARNING, "levelname": "WARNING", "msg": msg})
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.writer.is_alive() and threading.current_thread() is not self.writer:
+            self.writer.join(timeout=5)
+        self.target.close()
+        super().close()
+
+    def statistics(self):
+        with self.lock:
+            return {"buffered": len(self.buffer), "written": self.written, "dropped": self.dropped, "sampled_out": self.sampled_out}
+
+
+def setup_log(name, mode=None):
     logger = logging.getLogger(name)   # create logger
 
     logger.setLevel(logging.DEBUG)  # set logger level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
@@ -10,8 +163,40 @@ def setup_log(name):
     log_handler.setLevel(logging.DEBUG)
     if name == "app":
         log_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        log_handler.setFormatter(log_format)
+    else:
+        log_format = JsonFormatter()  # cache loggers write one JSON object per line
+    log_handler.setFormatter(log_format)
+
+    if (mode or LOG_MODE) == "queued":
+        log_handler = QueuedHandler(log_handler)
+        queued_handlers[name] = log_handler
     logger.addHandler(log_handler)
 
     return logger
 
+
+log_thread = None  # writes the records of coroutines in sync mode, started on first use
+
+
+# Logging from a coroutine without blocking the event loop: a queued logger only appends to its buffer, a sync one
+# writes the file, so in sync mode the call is handed to one background thread (one, to keep the records in order)
+def log_without_blocking(fn, *args):
+    global log_thread
+    if LOG_MODE == "queued":
+        fn(*args)
+        return
+    if log_thread is None:
+        log_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log")
+    log_thread.submit(fn, *args)
+
+
+# Buffered/written/dropped counts for every queued logger
+def log_pipeline_stats():
+    return {name: handler.statistics() for name, handler in queued_handlers.items()}
+
+
+# Write out anything still buffered when the process exits
+@atexit.register
+def close_queued_handlers():
+    for handler in queued_handlers.values():
+        handler.close()
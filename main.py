@@ -1,13 +1,30 @@
 from typing import Union
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import RedirectResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import Any
+from typing import Any, Dict, List
 from algorithms.lru_cache import LRUCache
 from algorithms.lfu_cache import LFUCache
 from algorithms.arc_cache import ARCCache
+from algorithms.tinylfu_cache import TinyLFUCache
+from algorithms.compact_cache import CompactLRUCache, CompactLFUCache
+from algorithms.sharded_cache import ShardedCache
+from algorithms.expiry import ExpirySweeper
+from algorithms.snapshot import save_snapshot, load_snapshot, SnapshotSaver
+from algorithms.metrics import prometheus_text
+from algorithms.async_cache import AsyncShardedCache
+from algorithms.prefetch import Prefetcher
+from algorithms.disk_tier import DiskTier
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
-from log import setup_log
+from log import setup_log, log_pipeline_stats, log_without_blocking
+from backing_store import create_backing_store, SingleFlight, AsyncSingleFlight
+from routing import create_router
+from cached_response import cache_entry, entry_size, make_response, make_batch_response
+import asyncio
 import json
+import os
 import sys
 
 
@@ -20,17 +37,151 @@ class Item(BaseModel):
     value: Any
 
 
+# Bodies of the batch endpoints
+class BatchGet(BaseModel):
+    keys: List[str]
+
+
+class BatchPut(BaseModel):
+    items: Dict[str, Any]  # key -> value, stored like the value of a single PUT
+    ttl: Union[float, None] = None
+
+
 app = FastAPI()  # Initialize the FastAPI app
 
 
-# Load data at startup
-with open('data.json', 'r') as f:
+# Load data at startup, DATA_PATH can point at a generated dataset (benchmarks/dataset.py)
+DATA_PATH = os.getenv("DATA_PATH", "data.json")
+with open(DATA_PATH, 'r') as f:
     data = json.load(f)
 
+# Where misses are fetched from (data.json by default, optionally slowed down or backed by SQLite, see backing_store.py)
+origin = create_backing_store(data)
+fills = SingleFlight()  # concurrent misses (and batch fetches) for the same cache and key share one origin fetch
+async_fills = AsyncSingleFlight(fills)  # the same for the async endpoints, coalescing with the sync ones
+
+# LOG_REQUEST_METRICS=0 stops writing a metrics record per request to the cache logs, /metrics has the latencies anyway
+LOG_REQUEST_METRICS = os.getenv("LOG_REQUEST_METRICS", "1") == "1"
+
+# Number of independently locked shards per cache, the endpoints run on FastAPI's threadpool
+CACHE_SHARDS = int(os.getenv("CACHE_SHARDS", "1"))
+
+# Default time to live of cached items in seconds (unset = never expire) and how long an expired item
+# may still be served while it is refreshed in the background (stale-while-revalidate)
+CACHE_TTL = float(os.getenv("CACHE_TTL")) if os.getenv("CACHE_TTL") else None
+CACHE_STALE_TTL = float(os.getenv("CACHE_STALE_TTL", "0"))
+
+# Number of items each cache can store at a time, and optionally a memory budget in bytes on top of it
+# (each item weighs the length of its JSON encoding)
+CACHE_CAPACITY = int(os.getenv("CACHE_CAPACITY", "3"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES")) if os.getenv("CACHE_MAX_BYTES") else None
+
+cache_options = {
+    "shards": CACHE_SHARDS,
+    "default_ttl": CACHE_TTL,
+    "stale_ttl": CACHE_STALE_TTL,
+    "max_bytes": CACHE_MAX_BYTES,
+    "sizer": entry_size,
+}
+
+# CACHE_BACKEND=shared replaces the LRU cache with one in shared memory (algorithms/shared_cache.py) that every
+# uvicorn worker process maps, so `--workers N` shares one cache instead of splitting it N ways.
+# SHARED_CACHE_PATH is the file it lives in (plus a suffix for the format, capacity and slot size) and
+# SHARED_CACHE_SLOT_BYTES the largest (pickled) item it holds.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+# CACHE_ENGINE=compact uses the array based LRU/LFU classes (same eviction order, less memory per entry for LFU)
+CACHE_ENGINE = os.getenv("CACHE_ENGINE", "default")
+lru_class, lfu_class = (CompactLRUCache, CompactLFUCache) if CACHE_ENGINE == "compact" else (LRUCache, LFUCache)
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "/dev/shm/cache-lru")
+SHARED_CACHE_SLOT_BYTES = int(os.getenv("SHARED_CACHE_SLOT_BYTES", "1024"))
+
 # Initialize the caches and set their capacity (number of items they can store at a time)
-lru_cache = LRUCache(capacity=3)
-lfu_cache = LFUCache(capacity=3)
-arc_cache = ARCCache(capacity=3)
+if CACHE_BACKEND == "shared":
+    from algorithms.shared_cache import SharedMemoryCache  # needs fcntl, so only imported when used
+    shared_options = {**cache_options, "shards": 1}  # one file and one lock, the lock is shared by the processes anyway
+    lru_cache = ShardedCache(SharedMemoryCache, capacity=CACHE_CAPACITY, path=SHARED_CACHE_PATH,
+                             slot_bytes=SHARED_CACHE_SLOT_BYTES, **shared_options)
+else:
+    lru_cache = ShardedCache(lru_class, capacity=CACHE_CAPACITY, **cache_options)
+lfu_cache = ShardedCache(lfu_class, capacity=CACHE_CAPACITY, **cache_options)
+arc_cache = ShardedCache(ARCCache, capacity=CACHE_CAPACITY, **cache_options)
+tinylfu_cache = ShardedCache(TinyLFUCache, capacity=CACHE_CAPACITY, **cache_options)
+all_caches = [lru_cache, lfu_cache, arc_cache, tinylfu_cache]
+
+refresher = ThreadPoolExecutor(max_workers=4, thread_name_prefix="refresh")  # background refreshes of stale items
+sweeper = ExpirySweeper(all_caches)  # removes expired items a few at a time, started with the app
+
+# Warm start: with CACHE_SNAPSHOT_PATH set the caches are saved there every CACHE_SNAPSHOT_INTERVAL seconds
+# (0 = only on shutdown) and on SIGINT/shutdown, and loaded from it when the app starts
+CACHE_SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH")
+CACHE_SNAPSHOT_INTERVAL = float(os.getenv("CACHE_SNAPSHOT_INTERVAL", "60"))
+snapshot_caches = {"LRU": lru_cache, "LFU": lfu_cache, "ARC": arc_cache, "TinyLFU": tinylfu_cache}  # same names as /stats
+snapshot_saver = SnapshotSaver(CACHE_SNAPSHOT_PATH, snapshot_caches, CACHE_SNAPSHOT_INTERVAL,
+                               on_error=lambda error: app_logger.error("Saving the cache snapshot failed: %s", error))
+
+
+# L2_CACHE=1 puts a disk tier (algorithms/disk_tier.py) behind every cache: evicted items are appended to a segment
+# file in L2_DIR (default: the temp directory) and a miss looks there before going to the origin, moving the item
+# back into the cache. L2_MAX_BYTES bounds each file's live data. Not for the shared memory LRU cache
+# (CACHE_BACKEND=shared), its evictions happen in whichever worker process needs room.
+L2_CACHE = os.getenv("L2_CACHE", "0") == "1"
+L2_DIR = os.getenv("L2_DIR") or None
+L2_MAX_BYTES = int(os.getenv("L2_MAX_BYTES", str(1 << 30)))
+disk_tiers = {}  # ShardedCache -> DiskTier
+if L2_CACHE:
+    for name, cache in snapshot_caches.items():
+        if CACHE_BACKEND == "shared" and cache is lru_cache:
+            continue
+        disk_tiers[cache] = DiskTier(name, L2_DIR, L2_MAX_BYTES)
+        cache.set_on_evict(disk_tiers[cache].put)
+
+
+def save_cache_snapshot():
+    if not CACHE_SNAPSHOT_PATH:
+        return
+    try:
+        result = save_snapshot(CACHE_SNAPSHOT_PATH, snapshot_caches)
+        app_logger.info("Saved %d cache entries to %s in %.3fs", result["entries"], CACHE_SNAPSHOT_PATH, result["seconds"])
+    except OSError as error:
+        app_logger.error("Saving the cache snapshot failed: %s", error)
+
+
+def load_cache_snapshot():
+    if not CACHE_SNAPSHOT_PATH or not os.path.exists(CACHE_SNAPSHOT_PATH):
+        return
+    try:
+        result = load_snapshot(CACHE_SNAPSHOT_PATH, snapshot_caches)
+    except Exception as error:  # a broken snapshot must not keep the app from starting, it just starts cold
+        app_logger.error("Loading the cache snapshot failed, starting cold: %s", error)
+        return
+    app_logger.info("Loaded caches %s from %s in %.3fs (skipped, settings changed: %s)",
+                    result["loaded"], CACHE_SNAPSHOT_PATH, result["seconds"], result["skipped"])
+
+# Send requests for keys owned by another replica there (ROUTING_MODE=forward/redirect, see routing.py) so each key
+# is only cached by one replica and the cluster's capacity adds up instead of every replica caching the same keys
+router = create_router()
+
+if router.enabled():
+    @app.middleware("http")
+    async def route_to_owner(request: Request, call_next):
+        owner = router.remote_owner(request.url.path, request.headers)
+        if owner is None:
+            return await call_next(request)
+        if router.mode == "redirect":
+            router.redirected += 1
+            query = f"?{request.url.query}" if request.url.query else ""
+            return RedirectResponse(owner + request.url.path + query, status_code=307)  # 307 keeps the method and body
+        body = await request.body()
+        result = await run_in_threadpool(router.forward, owner, request.method, request.url.path, request.url.query,
+                                         dict(request.headers), body)
+        if result is None:  # owner unreachable, serve it here rather than fail
+            router.errors += 1
+            app_logger.warning("Forward of %s to %s failed, serving locally", request.url.path, owner)
+            return await call_next(request)
+        router.forwarded += 1
+        status, headers, content = result
+        return Response(content=content, status_code=status, headers=headers)
+
 
 @app.get("/")
 def read_root():
@@ -42,73 +193,424 @@ def read_item(item_id: int, q: Union[str, None] = None):
     return {"item_id": item_id, "q": q}
 
 
+# Move missed items from the cache's L2 tier back into the cache, returns key -> entry for the ones found there
+def promote_from_l2(cache, keys):
+    tier = disk_tiers.get(cache)
+    if tier is None:
+        return {}
+    promoted = {}
+    for key in keys:
+        start = timer()
+        found = tier.take(key, CACHE_STALE_TTL)
+        cache.metrics.record_l2(timer() - start, found is not None)
+        if found is not None:  # back with the ttl it was put with, expiring when it would have in L1
+            entry, remaining, ttl = found
+            cache.put(key, entry, ttl, remaining)
+            promoted[key] = entry
+    return promoted
+
+
+# Move missed items the prefetcher loaded ahead into the cache, returns key -> entry for the ones it had
+def promote_prefetched(cache, keys):
+    prefetcher = prefetchers.get(cache)
+    if prefetcher is None:
+        return {}
+    promoted = {}
+    for key in keys:
+        prefetched = prefetcher.take(key)
+        if prefetched is not None:
+            entry, remaining = prefetched
+            cache.put(key, entry, remaining=remaining)
+            promoted[key] = entry
+    return promoted
+
+
+# A write replaces the copies of an item outside the cache (prefetch area, L2 tier)
+def invalidate_copies(cache, keys):
+    for key in keys:
+        if cache in prefetchers:
+            prefetchers[cache].invalidate(key)
+        if cache in disk_tiers:
+            disk_tiers[cache].discard(key)
+
+
+# Fetch a missing item from the L2 tier or else the origin and add it to the cache (runs once per key for concurrent misses)
+def fill_from_origin(cache, item_id: str):
+    promoted = promote_from_l2(cache, [item_id])
+    if promoted:
+        return promoted[item_id]
+    item = origin.fetch(item_id)
+    if item is None:
+        return None
+    entry = cache_entry(item)  # encoded once here when CACHE_RESPONSE_MODE=bytes
+    cache.put(item_id, entry)
+    app_logger.info("Item %s fetched from origin and added to %s cache", item_id, cache.name)
+    return entry
+
+
+# Re-fetch a stale item, it keeps being served until this stores the fresh value (or its stale window ends).
+# cache.refresh keeps the entry's own ttl and its place in the policy, a refresh is not an access.
+def refresh_from_origin(cache, item_id: str):
+    item = origin.fetch(item_id)
+    if item is not None and cache.refresh(item_id, cache_entry(item)):
+        app_logger.info("Stale item %s refreshed in %s cache", item_id, cache.name)
+
+
+for cache in all_caches:
+    cache.set_on_stale(lambda cache, item_id: refresher.submit(refresh_from_origin, cache, item_id))
+
+
+# PREFETCH=1 puts a Prefetcher (algorithms/prefetch.py) beside every cache: it learns key strides and successors from
+# the requests and loads the likely next items in the background into a separate area of PREFETCH_AREA entries,
+# which only join the cache once requested. PREFETCH_DEPTH keys are predicted ahead, PREFETCH_TABLE_SIZE keys
+# have their successors remembered.
+PREFETCH = os.getenv("PREFETCH", "0") == "1"
+PREFETCH_AREA = int(os.getenv("PREFETCH_AREA", "64"))
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "2"))
+PREFETCH_TABLE_SIZE = int(os.getenv("PREFETCH_TABLE_SIZE", "10000"))
+
+
+def load_for_prefetch(item_id: str):
+    item = origin.fetch(item_id)
+    return cache_entry(item) if item is not None else None
+
+
+prefetchers = {}  # ShardedCache -> Prefetcher
+if PREFETCH:
+    prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+    prefetchers = {cache: Prefetcher(cache, load_for_prefetch, prefetch_executor, PREFETCH_AREA, PREFETCH_DEPTH,
+                                     PREFETCH_TABLE_SIZE, ttl=CACHE_TTL) for cache in all_caches}
+
+
 # Generic function to handle cache operations
-def handle_cache_request(cache, item_id: str):
+def handle_cache_request(cache, item_id: str, if_none_match: Union[str, None] = None):
     start = timer()  # start the timer
     result = cache.get(item_id)
     end = timer()  # stop the timer
+    cache.metrics.record_get(end - start, result != "Not Found")
+    prefetcher = prefetchers.get(cache)
+    if prefetcher:
+        prefetcher.access(item_id)
 
     if result == "Not Found":
-        if item_id in data:
-            app_logger.info(f"Cache Miss: {item_id} not found in {cache.__class__.__name__}")
-            item = data[item_id]
-            cache.put(item_id, item)
-            app_logger.info(f"Item {item_id} fetched from data and added to {cache.__class__.__name__} cache")
-            cache.log_metrics("miss", item_id, end - start)  # log miss metrics (latency, hit rate, cache size, etc.)
-            return item
+        prefetched = prefetcher.take(item_id) if prefetcher else None
+        if prefetched is not None:  # loaded ahead of this request, it joins the cache now that it was asked for
+            entry, remaining = prefetched
+            cache.put(item_id, entry, remaining=remaining)  # the default ttl, counted from when it was loaded
+        else:
+            entry = fills.do((cache.name, item_id), fill_from_origin, cache, item_id)
+        cache.metrics.record("fill", timer() - end)
+        if entry is not None:
+            app_logger.info("Cache Miss: %s not found in %s", item_id, cache.name)  # formatted by the log writer, not here
+            if LOG_REQUEST_METRICS:
+                cache.log_metrics("miss", item_id, end - start)  # log miss metrics (latency, hit rate, cache size, etc.)
+            return make_response(entry, if_none_match)
         else:
             raise HTTPException(status_code=404, detail="Item not found")
     else:
-        app_logger.info(f"Cache Hit: {item_id} retrieved from {cache.__class__.__name__}")
-        cache.log_metrics("hit", item_id, end - start)  # log hit metrics
-        return result
+        app_logger.info("Cache Hit: %s retrieved from %s", item_id, cache.name)
+        if LOG_REQUEST_METRICS:
+            cache.log_metrics("hit", item_id, end - start)  # log hit metrics
+        return make_response(result, if_none_match)  # stored bytes are returned without re-encoding
+
+
+def handle_cache_put(cache, item_id: str, item: Item, ttl: Union[float, None] = None):
+    start = timer()
+    cache.put(item_id, cache_entry(item.dict()), ttl)
+    cache.metrics.record("put", timer() - start)
+    invalidate_copies(cache, [item_id])
+    return {"item_id": item_id, "item": item.dict()}
+
+
+# Batch versions of the above: the hits are looked up taking each shard's lock once, all the misses are fetched
+# from the origin together and one aggregated metrics record is logged for the whole batch. The prefetcher learns
+# from the keys in request order and serves the misses it loaded ahead, like for single requests.
+def handle_batch_request(cache, keys):
+    keys = list(dict.fromkeys(keys))  # duplicates are looked up once
+    start = timer()
+    results = cache.get_many(keys)
+    end = timer()
+    prefetcher = prefetchers.get(cache)
+    if prefetcher:
+        for key in keys:
+            prefetcher.access(key)
+
+    entries = {key: value for key, value in results.items() if value != "Not Found"}
+    hit_keys = set(entries)
+    missing = [key for key in keys if key not in hit_keys]
+    entries.update(promote_prefetched(cache, missing))
+    entries.update(promote_from_l2(cache, [key for key in missing if key not in entries]))
+    # keys another request is already filling are waited for, the rest are fetched together in one round trip and
+    # registered as fills in progress first, so misses of those keys meanwhile wait for this fetch
+    led, joined = fills.start_many((cache.name, key) for key in missing if key not in entries)
+    if led:
+        try:
+            fetched = {key: cache_entry(item) for key, item in origin.fetch_many([key for _, key in led]).items()}
+            cache.put_many(fetched)
+        except BaseException as error:
+            fills.finish_many(led, error=error)
+            raise
+        fills.finish_many(led, {(cache.name, key): entry for key, entry in fetched.items()})
+        entries.update(fetched)
+    entries.update((key, fills.wait(call)) for (_, key), call in joined.items())
+    entries = {key: entries.get(key) for key in keys}  # request order, None for keys the origin does not have
+
+    cache.metrics.record_batch(end - start, len(hit_keys), len(missing))
+    app_logger.info("Batch of %d keys from %s: %d hits", len(keys), cache.name, len(hit_keys))
+    if LOG_REQUEST_METRICS:
+        cache.log_metrics("batch_get", None, end - start, {"keys": len(keys), "hits": len(hit_keys), "misses": len(missing)})
+    return make_batch_response(entries, hit_keys)
+
+
+def handle_batch_put(cache, batch: BatchPut):
+    start = timer()
+    cache.put_many({key: cache_entry({"value": value}) for key, value in batch.items.items()}, batch.ttl)
+    cache.metrics.record("batch_put", timer() - start)
+    invalidate_copies(cache, batch.items)
+    return {"items": {key: {"value": value} for key, value in batch.items.items()}}
 
 
 # LRU Cache Endpoints
+@app.post("/lru/batch/get")
+def batch_get_using_lru(batch: BatchGet):
+    return handle_batch_request(lru_cache, batch.keys)
+
+
+@app.post("/lru/batch/put")
+def batch_put_using_lru(batch: BatchPut):
+    return handle_batch_put(lru_cache, batch)
+
+
 @app.get("/lru/{item_id}")
-def get_using_lru(item_id: str):
-    return handle_cache_request(lru_cache, item_id)
+def get_using_lru(item_id: str, if_none_match: Union[str, None] = Header(default=None)):
+    return handle_cache_request(lru_cache, item_id, if_none_match)
 
 
 @app.put("/lru/{item_id}")
-def update_using_lru(item_id: str, item: Item):
-    lru_cache.put(item_id, item.dict())
-    return {"item_id": item_id, "item": item.dict()}
+def update_using_lru(item_id: str, item: Item, ttl: Union[float, None] = None):
+    return handle_cache_put(lru_cache, item_id, item, ttl)
 
 
 # LFU Cache Endpoints
+@app.post("/lfu/batch/get")
+def batch_get_using_lfu(batch: BatchGet):
+    return handle_batch_request(lfu_cache, batch.keys)
+
+
+@app.post("/lfu/batch/put")
+def batch_put_using_lfu(batch: BatchPut):
+    return handle_batch_put(lfu_cache, batch)
+
+
 @app.get("/lfu/{item_id}")
-def get_using_lfu(item_id: str):
-    return handle_cache_request(lfu_cache, item_id)
+def get_using_lfu(item_id: str, if_none_match: Union[str, None] = Header(default=None)):
+    return handle_cache_request(lfu_cache, item_id, if_none_match)
 
 
 @app.put("/lfu/{item_id}")
-def update_using_lfu(item_id: str, item: Item):
-    lfu_cache.put(item_id, item.dict())
-    return {"item_id": item_id, "item": item.dict()}
+def update_using_lfu(item_id: str, item: Item, ttl: Union[float, None] = None):
+    return handle_cache_put(lfu_cache, item_id, item, ttl)
 
 
 # ARC Cache Endpoints
+@app.post("/arc/batch/get")
+def batch_get_using_arc(batch: BatchGet):
+    return handle_batch_request(arc_cache, batch.keys)
+
+
+@app.post("/arc/batch/put")
+def batch_put_using_arc(batch: BatchPut):
+    return handle_batch_put(arc_cache, batch)
+
+
 @app.get("/arc/{item_id}")
-def get_using_arc(item_id: str):
-    return handle_cache_request(arc_cache, item_id)
+def get_using_arc(item_id: str, if_none_match: Union[str, None] = Header(default=None)):
+    return handle_cache_request(arc_cache, item_id, if_none_match)
 
 
 @app.put("/arc/{item_id}")
-def update_using_arc(item_id: str, item: Item):
-    arc_cache.put(item_id, item.dict())
+def update_using_arc(item_id: str, item: Item, ttl: Union[float, None] = None):
+    return handle_cache_put(arc_cache, item_id, item, ttl)
+
+
+# W-TinyLFU Cache Endpoints
+@app.post("/tinylfu/batch/get")
+def batch_get_using_tinylfu(batch: BatchGet):
+    return handle_batch_request(tinylfu_cache, batch.keys)
+
+
+@app.post("/tinylfu/batch/put")
+def batch_put_using_tinylfu(batch: BatchPut):
+    return handle_batch_put(tinylfu_cache, batch)
+
+
+@app.get("/tinylfu/{item_id}")
+def get_using_tinylfu(item_id: str, if_none_match: Union[str, None] = Header(default=None)):
+    return handle_cache_request(tinylfu_cache, item_id, if_none_match)
+
+
+@app.put("/tinylfu/{item_id}")
+def update_using_tinylfu(item_id: str, item: Item, ttl: Union[float, None] = None):
+    return handle_cache_put(tinylfu_cache, item_id, item, ttl)
+
+# Async versions of the cache endpoints under /async (e.g. /async/lru/1): they run on the event loop instead of
+# taking a threadpool thread, a miss awaits its origin fetch, and concurrent misses for a key await one fill task.
+# They share the caches (and counters) with the endpoints above.
+async_caches = {name.lower(): AsyncShardedCache(cache) for name, cache in snapshot_caches.items()}
+
+
+def async_cache_for(policy: str):
+    if policy not in async_caches:
+        raise HTTPException(status_code=404, detail="Unknown cache")
+    return async_caches[policy]
+
+
+async def fill_from_origin_async(cache, item_id: str):
+    if cache.cache in disk_tiers:  # a disk read, off the event loop
+        promoted = await asyncio.to_thread(promote_from_l2, cache.cache, [item_id])
+        if promoted:
+            return promoted[item_id]
+    item = await origin.fetch_async(item_id)
+    if item is None:
+        return None
+    entry = cache_entry(item)
+    await cache.put(item_id, entry)
+    log_without_blocking(app_logger.info, "Item %s fetched from origin and added to %s cache", item_id, cache.name)
+    return entry
+
+
+@app.post("/async/{policy}/batch/get")
+async def batch_get_async(policy: str, batch: BatchGet):
+    cache = async_cache_for(policy)
+    keys = list(dict.fromkeys(batch.keys))
+    start = timer()
+    results = await cache.get_many(keys)
+    end = timer()
+    prefetcher = prefetchers.get(cache.cache)
+    if prefetcher:
+        for key in keys:
+            prefetcher.access(key)
+
+    entries = {key: value for key, value in results.items() if value != "Not Found"}
+    hit_keys = set(entries)
+    missing = [key for key in keys if key not in hit_keys]
+    for key in missing if prefetcher else []:
+        prefetched = prefetcher.take(key)
+        if prefetched is not None:
+            entry, remaining = prefetched
+            await cache.put(key, entry, remaining=remaining)
+            entries[key] = entry
+    not_prefetched = [key for key in missing if key not in entries]
+    if not_prefetched and cache.cache in disk_tiers:
+        entries.update(await asyncio.to_thread(promote_from_l2, cache.cache, not_prefetched))
+    led, joined = fills.start_many((cache.name, key) for key in missing if key not in entries)
+    if led:
+        try:
+            items = await origin.fetch_many_async([key for _, key in led])
+            fetched = {key: cache_entry(item) for key, item in items.items()}
+            await cache.put_many(fetched)
+        except BaseException as error:
+            fills.finish_many(led, error=error)
+            raise
+        fills.finish_many(led, {(cache.name, key): entry for key, entry in fetched.items()})
+        entries.update(fetched)
+    for (_, key), call in joined.items():
+        entries[key] = await async_fills.wait(call)
+    entries = {key: entries.get(key) for key in keys}
+
+    cache.metrics.record_batch(end - start, len(hit_keys), len(missing))
+    log_without_blocking(app_logger.info, "Batch of %d keys from %s: %d hits", len(keys), cache.name, len(hit_keys))
+    if LOG_REQUEST_METRICS:
+        log_without_blocking(cache.log_metrics, "batch_get", None, end - start,
+                             {"keys": len(keys), "hits": len(hit_keys), "misses": len(missing)})
+    return make_batch_response(entries, hit_keys)
+
+
+@app.post("/async/{policy}/batch/put")
+async def batch_put_async(policy: str, batch: BatchPut):
+    cache = async_cache_for(policy)
+    start = timer()
+    await cache.put_many({key: cache_entry({"value": value}) for key, value in batch.items.items()}, batch.ttl)
+    cache.metrics.record("batch_put", timer() - start)
+    invalidate_copies(cache.cache, batch.items)
+    return {"items": {key: {"value": value} for key, value in batch.items.items()}}
+
+
+@app.get("/async/{policy}/{item_id}")
+async def get_async(policy: str, item_id: str, if_none_match: Union[str, None] = Header(default=None)):
+    cache = async_cache_for(policy)
+    start = timer()
+    result = await cache.get(item_id)
+    end = timer()
+    cache.metrics.record_get(end - start, result != "Not Found")
+    prefetcher = prefetchers.get(cache.cache)  # only takes its lock briefly, the loads run on its executor
+    if prefetcher:
+        prefetcher.access(item_id)
+
+    if result == "Not Found":
+        prefetched = prefetcher.take(item_id) if prefetcher else None
+        if prefetched is not None:
+            entry, remaining = prefetched
+            await cache.put(item_id, entry, remaining=remaining)
+        else:
+            entry = await async_fills.do((cache.name, item_id), fill_from_origin_async, cache, item_id)
+        cache.metrics.record("fill", timer() - end)
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        log_without_blocking(app_logger.info, "Cache Miss: %s not found in %s", item_id, cache.name)
+        if LOG_REQUEST_METRICS:
+            log_without_blocking(cache.log_metrics, "miss", item_id, end - start)
+        return make_response(entry, if_none_match)
+    log_without_blocking(app_logger.info, "Cache Hit: %s retrieved from %s", item_id, cache.name)
+    if LOG_REQUEST_METRICS:
+        log_without_blocking(cache.log_metrics, "hit", item_id, end - start)
+    return make_response(result, if_none_match)
+
+
+@app.put("/async/{policy}/{item_id}")
+async def put_async(policy: str, item_id: str, item: Item, ttl: Union[float, None] = None):
+    cache = async_cache_for(policy)
+    start = timer()
+    await cache.put(item_id, cache_entry(item.dict()), ttl)
+    cache.metrics.record("put", timer() - start)
+    invalidate_copies(cache.cache, [item_id])
     return {"item_id": item_id, "item": item.dict()}
 
+
+# Hit ratio and latency of L1 (the cache) and L2 (its disk tier), L2's hit ratio is over the L1 misses it was asked for
+def tier_statistics(cache):
+    histograms = cache.metrics.histograms()
+    l1, l2 = histograms[("get", "hit")], histograms[("l2", "hit")]
+    return {
+        "l1": {"hit_ratio": cache.calculate_statistics()["hit_ratio"], "p50": l1.quantile(0.5), "p99": l1.quantile(0.99)},
+        "l2": {**disk_tiers[cache].statistics(), "p50": l2.quantile(0.5), "p99": l2.quantile(0.99)},
+    }
+
+
 @app.get("/stats")
 def get_statistics():
     stats = {
         "LRU": lru_cache.calculate_statistics(),
         "LFU": lfu_cache.calculate_statistics(),
-        "ARC": arc_cache.calculate_statistics()
+        "ARC": arc_cache.calculate_statistics(),
+        "TinyLFU": tinylfu_cache.calculate_statistics(),
+        "origin": {**origin.statistics(), "coalesced": fills.coalesced},  # fetches the caches did not save us from
+        "logging": log_pipeline_stats(),  # only filled in when LOG_MODE=queued
+        "routing": router.statistics(),
+        "tiers": {name: tier_statistics(cache) for name, cache in snapshot_caches.items() if cache in disk_tiers},
+        "prefetch": {name: prefetchers[cache].statistics() for name, cache in snapshot_caches.items() if cache in prefetchers},
+        "async": {"fills_in_flight": len(async_fills.tasks),
+                  "contended": {name: cache.contended for name, cache in async_caches.items()}}
     }
     return stats
 
 
+# Latency percentiles, rolling hit ratios, evictions and bytes of every cache in the Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(prometheus_text(snapshot_caches), media_type="text/plain; version=0.0.4")
+
+
 # for testing purposes - default data endpoint
 @app.get("/data/{item_id}")
 def get_data(item_id: str):
@@ -118,15 +620,34 @@ def get_data(item_id: str):
         raise HTTPException(status_code=404, detail="Item not found")
 
 
+previous_sigint = None  # the SIGINT handler that was installed before ours (uvicorn's graceful shutdown)
+
+
+# Only starts the shutdown, shutdown_event saves the snapshot. The handler runs on the main thread, which is also the
+# event loop thread holding shard locks in the async endpoints, so it must not touch the caches itself.
 def receive_signal(signalNumber, frame):
     print('Received:', signalNumber)
-    sys.exit()
+    if callable(previous_sigint):
+        previous_sigint(signalNumber, frame)
+    else:
+        sys.exit()
 
 
 
 @app.on_event("startup")
 async def startup_event():
+    global previous_sigint
     import signal
-    signal.signal(signal.SIGINT, receive_signal)
+    previous_sigint = signal.signal(signal.SIGINT, receive_signal)
+    load_cache_snapshot()  # before the first request is served
+    sweeper.start()
+    if CACHE_SNAPSHOT_PATH and CACHE_SNAPSHOT_INTERVAL > 0:
+        snapshot_saver.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    snapshot_saver.stop()
+    save_cache_snapshot()
 
 
@@ -0,0 +1,119 @@
+import bisect
+import hashlib
+import os
+import re
+
+# Cache-aware routing between the app replicas, configured with environment variables:
+# NODE_NAME: name of this replica in the ring (e.g. fastapi1)
+# CLUSTER_NODES: comma separated replicas, name=base_url or just name (then http://name:80), e.g. fastapi1,fastapi2,fastapi3
+# ROUTING_MODE: off (every replica serves every key, the old behaviour), forward (proxy a request for a key owned
+# by another replica to it) or redirect (answer with a 307 to the owner)
+NODE_NAME = os.getenv("NODE_NAME", "")
+CLUSTER_NODES = os.getenv("CLUSTER_NODES", "")
+ROUTING_MODE = os.getenv("ROUTING_MODE", "off")
+RING_VNODES = int(os.getenv("RING_VNODES", "160"))
+
+FORWARDED_HEADER = "X-Cache-Forwarded"  # set on forwarded requests, the receiver serves them itself (no loops)
+ITEM_PATH = re.compile(r"^(?:/async)?/(lru|lfu|arc|tinylfu)/([^/]+)$")  # single item endpoints (sync and async), batches are served locally
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+# Consistent hash ring: every node is placed at vnodes points on a 64 bit circle and a key belongs to the first
+# point clockwise from its hash. Adding or removing a node only moves the keys next to its points (about 1/n of them),
+# and the virtual nodes keep the share of each node close to even.
+class HashRing:
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self.points = []  # sorted hashes of the virtual nodes
+        self.owners = []  # node of each point, same order
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        for i in range(self.vnodes):
+            point = ring_hash(f"{node}#{i}")
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove_node(self, node):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def nodes(self):
+        return set(self.owners)
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, ring_hash(str(key)))
+        return self.owners[index % len(self.points)]
+
+
+# Parse CLUSTER_NODES into name -> base url
+def parse_nodes(spec):
+    nodes = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, url = entry.partition("=")
+        nodes[name] = (url or f"http://{name}:80").rstrip("/")
+    return nodes
+
+
+# Owner lookup for the request paths of this replica, only active when ROUTING_MODE is not off
+class Router:
+    def __init__(self, node_name, nodes, mode, vnodes=160):
+        self.node_name = node_name
+        self.nodes = nodes  # name -> base url
+        self.mode = mode
+        self.ring = HashRing(nodes, vnodes)
+        self.session = None  # keeps connections to the other replicas open
+        if mode == "forward" and self.enabled():
+            import requests  # only needed with ROUTING_MODE=forward
+            self.session = requests.Session()
+        self.local = 0  # requests for keys this replica owns
+        self.forwarded = 0
+        self.redirected = 0
+        self.errors = 0  # forwards that failed, served locally instead
+        # the counters are only updated from the event loop (the middleware), forward() itself runs in the threadpool
+
+    def enabled(self):
+        return self.mode != "off" and len(self.nodes) > 1 and self.node_name in self.nodes
+
+    # Base url of the replica that should serve this path, or None to serve it here
+    def remote_owner(self, path, headers):
+        match = ITEM_PATH.match(path)
+        if match is None or FORWARDED_HEADER.lower() in headers:
+            return None
+        owner = self.ring.owner(match.group(2))
+        if owner == self.node_name:
+            self.local += 1
+            return None
+        return self.nodes[owner]
+
+    # Proxy a request to the owner (blocking, run it in the threadpool), returns (status, headers, body) or None
+    def forward(self, base_url, method, path, query, headers, body):
+        import requests
+        headers = {name: value for name, value in headers.items() if name.lower() in ("content-type", "if-none-match")}
+        headers[FORWARDED_HEADER] = self.node_name
+        url = base_url + path + (f"?{query}" if query else "")
+        try:
+            response = self.session.request(method, url, headers=headers, data=body, timeout=5)
+        except requests.RequestException:
+            return None
+        kept = {name: value for name, value in response.headers.items() if name.lower() in ("content-type", "etag")}
+        return response.status_code, kept, response.content
+
+    def statistics(self):
+        return {"mode": self.mode if self.enabled() else "off", "node": self.node_name, "local": self.local,
+                "forwarded": self.forwarded, "redirected": self.redirected, "errors": self.errors}
+
+
+def create_router():
+    return Router(NODE_NAME, parse_nodes(CLUSTER_NODES), ROUTING_MODE, RING_VNODES)